@@ -7,32 +7,340 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 from __future__ import annotations
-import argparse
+import bisect
+import contextlib
+import functools
+import itertools
 import os
 import sys
-from typing import Any, Dict, List, Optional
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, TYPE_CHECKING,
+    Union)
 
-from .formatter import formatAst
-from .tokenizer import Tokenizer
-from .parser import parseTokens
-from .settings import Settings
+# modules that are only needed by some functions (argparse, multiprocessing, subprocess, the
+# result cache, ...) are imported in these functions to keep the startup time short, as
+# mformat is often started once per file
+from .formatter import formatAst, formatStatements, iterFormatStatements, writeFormattedAst
+from .memo import formatStatementsWithMemo, StatementMemo, writeStatementsWithMemo
+from .tokenizer import ByteTokenizer, openingTokenKinds, Tokenizer, TokenKind
+from .parser import (AstNode, BlockContextBuilder, getBlockKeyword, iterParseTokens,
+    parseStatement, parseTokens, splitIntoStatements)
+from .session import FormatSession
+from .settings import Settings, settingsFileCache
+from .stats import FormatStats
+
+if TYPE_CHECKING:
+  import mmap
+
+def formatFile(filePath: str, dictSettings: Dict[str, Any] = {}, useCache: bool = False,
+      stats: Optional[FormatStats] = None, memoryMap: bool = False) -> str:
+  # if memoryMap is True, the file is formatted with formatMappedFile if possible
+  if memoryMap and ((result := formatMappedFile(filePath, dictSettings, useCache, stats))
+        is not None):
+    return result[0]
 
-def formatFile(filePath: str, dictSettings: Dict[str, Any] = {}) -> str:
   with open(filePath, "r") as f: code = f.read()
+  return formatCodeOfFile(code, filePath, dictSettings, useCache, stats)
+
+def formatMappedFile(filePath: str, dictSettings: Dict[str, Any] = {}, useCache: bool = False,
+      stats: Optional[FormatStats] = None,
+      memo: Optional[StatementMemo] = None) -> Optional[Tuple[str, bool]]:
+  # Same as formatFile, but the file is memory-mapped and tokenized by a ByteTokenizer, so
+  # that the code is neither read into a string nor copied into the tokens, which saves memory
+  # for very large files. The file has to be UTF-8 encoded. Returns the formatted code and
+  # whether it differs from the file, or None if the file is empty (which cannot be mapped) or
+  # contains carriage returns (which are only translated when reading the file as text). See
+  # formatCode for memo.
+  with openMappedFile(filePath) as buffer:
+    if buffer is None: return None
+    settings = Settings()
+    settingsFilePath = settings.searchAndLoad(filePath)
+    settings.applyDict(dictSettings)
+    formattedCode = formatCodeWithCache(buffer, settings, settingsFilePath, useCache,
+        ByteTokenizer(), stats, memo)
+    return formattedCode, not checkIfCodesAreEqual(formattedCode, buffer)
+
+@contextlib.contextmanager
+def openMappedFile(filePath: str) -> Iterator[Optional[mmap.mmap]]:
+  # yields None if the file cannot be mapped or contains carriage returns (see formatMappedFile)
+  import mmap
+
+  with open(filePath, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      yield None
+      return
+
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+      yield (buffer if buffer.find(b"\r") == -1 else None)
+
+def writeFormattedFile(filePath: str, stream: TextIO, dictSettings: Dict[str, Any] = {},
+      useCache: bool = False, stats: Optional[FormatStats] = None,
+      memoryMap: bool = False) -> None:
+  # Same as formatFile, but the formatted code is written to stream in chunks instead of being
+  # returned, so that it is never held in memory as a whole. This is not possible if useCache
+  # is True (the formatted code has to be compared with the code) or if stats is given (the
+  # formatted code is counted), in which case the code is formatted with formatFile.
+  if useCache or (stats is not None):
+    stream.write(formatFile(filePath, dictSettings, useCache, stats, memoryMap))
+    return
+
   settings = Settings()
   settings.searchAndLoad(filePath)
   settings.applyDict(dictSettings)
-  return formatCode(code, settings)
 
-def formatCode(code: str, settings: Optional[Settings] = None) -> str:
+  if memoryMap:
+    with openMappedFile(filePath) as buffer:
+      if buffer is not None:
+        writeFormattedCodeWithTokenizer(buffer, settings, ByteTokenizer(), stream)
+        return
+
+  with open(filePath, "r") as f: code = f.read()
+  writeFormattedCodeWithTokenizer(code, settings, Tokenizer(), stream)
+
+def formatCodeOfFile(code: str, filePath: str, dictSettings: Dict[str, Any] = {},
+      useCache: bool = False, stats: Optional[FormatStats] = None,
+      memo: Optional[StatementMemo] = None) -> str:
+  # if useCache is True, files that are already formatted are remembered in a ResultCache next
+  # to the settings file (if there is one) and not formatted again; see formatCode for memo
+  settings = Settings()
+  settingsFilePath = settings.searchAndLoad(filePath)
+  settings.applyDict(dictSettings)
+  return formatCodeWithCache(code, settings, settingsFilePath, useCache, Tokenizer(), stats,
+      memo)
+
+def formatCodeWithCache(code: Union[str, bytes, mmap.mmap], settings: Settings,
+      settingsFilePath: Optional[str], useCache: bool, tokenizer: Tokenizer,
+      stats: Optional[FormatStats] = None, memo: Optional[StatementMemo] = None) -> str:
+  # settings have to be the settings of settingsFilePath, the cache of which is used; code may
+  # be UTF-8 encoded if tokenizer is a ByteTokenizer
+  if (not useCache) or (settingsFilePath is None):
+    return formatCodeWithTokenizer(code, settings, tokenizer, stats, memo)
+
+  from .cache import ResultCache
+  cache = ResultCache.getForDirectory(os.path.dirname(settingsFilePath))
+  cacheKey = ResultCache.getKey(code, settings)
+
+  if cache.contains(cacheKey):
+    if stats is not None: stats.numberOfCacheHits += 1
+    return (code if isinstance(code, str) else code[:].decode())
+
+  formattedCode = formatCodeWithTokenizer(code, settings, tokenizer, stats, memo)
+  if checkIfCodesAreEqual(formattedCode, code): cache.add(cacheKey)
+  return formattedCode
+
+def checkIfCodesAreEqual(code: str, otherCode: Union[str, bytes, mmap.mmap]) -> bool:
+  # otherCode may be UTF-8 encoded, in which case it is compared without copying it
+  if isinstance(otherCode, str): return code == otherCode
+  with memoryview(otherCode) as view: return view == code.encode()
+
+def writeFileAtomically(filePath: str, code: str) -> None:
+  # the code is written to a temporary file in the same directory, which replaces the file,
+  # so that the file is never left half-written
+  import shutil
+  import tempfile
+  fileDescriptor, tempFilePath = tempfile.mkstemp(
+      prefix=f".{os.path.basename(filePath)}.", dir=os.path.dirname(os.path.abspath(filePath)))
+
+  try:
+    with os.fdopen(fileDescriptor, "w") as f: f.write(code)
+    shutil.copymode(filePath, tempFilePath)
+    os.replace(tempFilePath, filePath)
+  except BaseException:
+    os.remove(tempFilePath)
+    raise
+
+class FileResult(object):
+  def __init__(self, formattedCode: Optional[str] = None, changed: bool = False,
+        errorMessage: Optional[str] = None, stats: Optional[FormatStats] = None) -> None:
+    # formattedCode is only set in print mode, to not pass all code back from worker processes
+    self.formattedCode = formattedCode
+    self.changed = changed
+    self.errorMessage = errorMessage
+    self.stats = stats
+
+  def toDict(self) -> Dict[str, Any]:
+    return {"formattedCode" : self.formattedCode, "changed" : self.changed,
+        "errorMessage" : self.errorMessage,
+        "stats" : (self.stats.toDict() if self.stats is not None else None)}
+
+  @staticmethod
+  def fromDict(dictResult: Dict[str, Any]) -> FileResult:
+    dictStats = dictResult.get("stats")
+    return FileResult(dictResult["formattedCode"], dictResult["changed"],
+        dictResult["errorMessage"], (FormatStats.fromDict(dictStats) if dictStats is not None
+          else None))
+
+def processFile(filePath: str, dictSettings: Dict[str, Any] = {}, useCache: bool = False,
+      mode: str = "print", stats: Optional[FormatStats] = None, memoryMap: bool = False,
+      memo: Optional[StatementMemo] = None) -> FileResult:
+  # mode is "print", "inplace" (write the file if it changes), or "check" (don't write);
+  # errors are returned, so that errors of one file do not stop the formatting of the other
+  # files (e.g., in worker processes); if stats is given, the stats of the file are added to it
+  # and it is returned in the result; if memoryMap is True, see formatFile; the formatted code
+  # is returned instead of being written to a stream (see writeFormattedFile), so that nothing
+  # is printed for files that cannot be formatted; see formatCode for memo
+  try:
+    result = (formatMappedFile(filePath, dictSettings, useCache, stats, memo) if memoryMap
+        else None)
+
+    if result is not None:
+      formattedCode, changed = result
+    else:
+      with open(filePath, "r") as f: code = f.read()
+      formattedCode = formatCodeOfFile(code, filePath, dictSettings, useCache, stats, memo)
+      changed = (formattedCode != code)
+
+    if (mode == "inplace") and changed: writeFileAtomically(filePath, formattedCode)
+    return FileResult((formattedCode if mode == "print" else None), changed, stats=stats)
+  except Exception as e:
+    import traceback
+    return FileResult(errorMessage=traceback.format_exception_only(type(e), e)[-1].strip())
+
+def formatCode(code: str, settings: Optional[Settings] = None,
+      stats: Optional[FormatStats] = None, memo: Optional[StatementMemo] = None) -> str:
+  # If stats is given, the times of the stages and the sizes of their results are added to it.
+  # The formatted code of every statement is memoized in memo, so that repeated statements are
+  # only parsed and formatted once; pass the same memo to format many codes that share
+  # statements (by default, the memo only lives as long as the call).
+  if settings is None: settings = Settings()
+  return formatCodeWithTokenizer(code, settings, Tokenizer(), stats, memo)
+
+def writeFormattedCode(code: str, stream: TextIO, settings: Optional[Settings] = None) -> None:
+  # same as formatCode, but the formatted code is written to stream in chunks
+  if settings is None: settings = Settings()
+  writeFormattedCodeWithTokenizer(code, settings, Tokenizer(), stream)
+
+def formatMany(codes: Iterable[str], settings: Optional[Settings] = None,
+      stats: Optional[FormatStats] = None) -> Iterator[str]:
+  # formats the codes one after the other with the same tokenizer and settings, yielding every
+  # formatted code as soon as it is formatted (codes is only iterated as far as needed); the
+  # codes also share one StatementMemo
   if settings is None: settings = Settings()
   tokenizer = Tokenizer()
-  tokens = tokenizer.tokenizeCode(code)
-  ast = parseTokens(tokens, settings)
-  formattedCode = formatAst(ast, settings)
+  memo = StatementMemo()
+  for code in codes: yield formatCodeWithTokenizer(code, settings, tokenizer, stats, memo)
+
+def formatFiles(filePaths: Iterable[str], dictSettings: Dict[str, Any] = {},
+      useCache: bool = False, stats: Optional[FormatStats] = None) -> Iterator[str]:
+  # Same as formatFile for every file, yielding every formatted code as soon as it is
+  # formatted. The files share one tokenizer and one StatementMemo, and the settings are only
+  # resolved once per settings file, so changes of the settings files while iterating are not
+  # noticed.
+  tokenizer = Tokenizer()
+  memo = StatementMemo()
+  # settings file path (None if there is none) -> settings
+  settingsOfSettingsFiles: Dict[Optional[str], Settings] = {}
+
+  for filePath in filePaths:
+    with open(filePath, "r") as f: code = f.read()
+    settingsFilePath = Settings.search(filePath)
+    settings = settingsOfSettingsFiles.get(settingsFilePath)
+
+    if settings is None:
+      settings = Settings()
+      if settingsFilePath is not None: settings.applyDict(settingsFileCache.load(settingsFilePath))
+      settings.applyDict(dictSettings)
+      settingsOfSettingsFiles[settingsFilePath] = settings
+
+    yield formatCodeWithCache(code, settings, settingsFilePath, useCache, tokenizer, stats,
+        memo)
+
+def formatCodeWithTokenizer(code: Union[str, bytes, mmap.mmap], settings: Settings,
+      tokenizer: Tokenizer, stats: Optional[FormatStats] = None,
+      memo: Optional[StatementMemo] = None) -> str:
+  # the tokenizer is reset for every code, so it can be reused; code may be UTF-8 encoded if
+  # tokenizer is a ByteTokenizer
+  if memo is None: memo = StatementMemo()
+  if stats is not None: return formatCodeWithStats(code, settings, tokenizer, stats, memo)
+  statements = splitIntoStatements(tokenizer.tokenizeCode(code))
+  return formatStatementsWithMemo(statements, settings, memo)
+
+def writeFormattedCodeWithTokenizer(code: Union[str, bytes, mmap.mmap], settings: Settings,
+      tokenizer: Tokenizer, stream: TextIO) -> None:
+  statements = splitIntoStatements(tokenizer.tokenizeCode(code))
+  writeStatementsWithMemo(statements, settings, StatementMemo(), stream)
+
+def formatCodeWithStats(code: Union[str, bytes, mmap.mmap], settings: Settings,
+      tokenizer: Tokenizer, stats: FormatStats, memo: StatementMemo) -> str:
+  # same as formatCodeWithTokenizer, but with the stages measured and counted (the AST nodes
+  # of statements that are found in memo are not counted, as they are not parsed)
+  with stats.measure("tokenize"): tokens = tokenizer.tokenizeCode(code)
+  with stats.measure("splitIntoStatements"): statements = splitIntoStatements(tokens)
+  formattedCode = formatStatementsWithMemo(statements, settings, memo, stats)
+
+  stats.numberOfFiles += 1
+  stats.numberOfTokens += len(tokens)
+  stats.numberOfStatements += len(statements)
+  stats.numberOfBytesIn += (len(code.encode()) if isinstance(code, str) else len(code))
+  stats.numberOfBytesOut += len(formattedCode.encode())
+  stats.maxGroupDepth = max([stats.maxGroupDepth] + [x.groupDepth + 1 for x in tokens
+      if x.kind in openingTokenKinds])
   return formattedCode
 
+def formatRange(code: str, startLine: int, endLine: int,
+      settings: Optional[Settings] = None) -> Tuple[int, int, str]:
+  # Formats the statements that intersect the lines [startLine, endLine) (zero-based), extended
+  # to whole lines. Returns (s, e, formattedCode) such that formattedCode replaces the lines
+  # [s, e) of code. Only these statements are parsed and formatted, and only the block keywords
+  # of the statements before them are looked at (and of the statements after them if it is not
+  # known yet whether functions have end); tokenizing and splitting into statements still needs
+  # the whole code.
+  if settings is None: settings = Settings()
+  tokenizer = Tokenizer()
+  statements = splitIntoStatements(tokenizer.tokenizeCode(code))
+
+  def getLine(pos: int) -> int:
+    return tokenizer.lineIndex.getLineAndColumn(pos)[0]
+
+  def getLineStartPos(line: int) -> int:
+    # lines after the last line start after the end of the code
+    if line >= tokenizer.lineIndex.getNumberOfLines(): return len(code) + 1
+    return tokenizer.lineIndex.getLineStartPos(max(line, 0))
+
+  # the start positions of the first and of the last tokens of the statements are increasing
+  firstIndex = bisect.bisect_left([x[-1].startPos for x in statements],
+      getLineStartPos(startLine))
+  lastIndex = bisect.bisect_left([x[0].startPos for x in statements],
+      getLineStartPos(endLine)) - 1
+  if firstIndex > lastIndex: return startLine, startLine, ""
+
+  # the first statement has to start a line and the last statement has to end one
+  while (firstIndex > 0) and (statements[firstIndex - 1][-1].kind != TokenKind.newline):
+    firstIndex -= 1
+
+  while ((lastIndex < len(statements) - 1)
+        and (statements[lastIndex][-1].kind != TokenKind.newline)):
+    lastIndex += 1
+
+  builder = BlockContextBuilder(settings)
+  statementNodes = []
+
+  for i in range(lastIndex + 1):
+    keyword = getBlockKeyword(statements[i])
+
+    if builder.dependsOnFunctionsHaveEnd(keyword):
+      builder.setFunctionsHaveEnd(builder.findFunctionsHaveEnd(
+          getBlockKeyword(x) for x in itertools.islice(statements, i, None)))
+
+    if i < firstIndex:
+      builder.add(AstNode("statement"), keyword)
+    else:
+      statementNodes.append(builder.add(parseStatement(statements[i]), keyword))
+
+  atEndOfFile = (lastIndex == len(statements) - 1)
+  formattedCode = formatStatements(statementNodes, settings, atEndOfFile)
+  rangeStartLine = getLine(statements[firstIndex][0].startPos)
+  rangeEndLine = (tokenizer.lineIndex.getNumberOfLines() if atEndOfFile
+      else getLine(statements[lastIndex][-1].startPos) + 1)
+  return rangeStartLine, rangeEndLine, formattedCode
+
+def iterFormatCode(code: str, settings: Optional[Settings] = None) -> Iterator[str]:
+  if settings is None: settings = Settings()
+  tokenizer = Tokenizer()
+  nodes = iterParseTokens(tokenizer.iterTokens(code), settings)
+  return iterFormatStatements(nodes, settings)
+
 def main() -> None:
+  import argparse
   parser = argparse.ArgumentParser(description="Format *.m files (MATLAB/Octave source code")
   defaultSettings = vars(Settings())
 
@@ -58,14 +366,65 @@ def main() -> None:
           metavar=settingMetaData.type_.__name__.upper(),
           help=f"{settingMetaData.description} (default: {repr(defaultSettings[name])})")
 
-  parser.add_argument("path", metavar="PATH", help="Path to *.m source file")
+  parser.add_argument("--jobs", type=int, default=1, metavar="N",
+      help="Number of processes to format the files of a directory in parallel "
+        "(0: number of CPUs, default: 1)")
+  parser.add_argument("--cache", action="store_true",
+      # ResultCache.fileName, the cache module is not imported only for the help
+      help="Skip files that are known to be formatted, using the file '.mformat-cache' "
+        "next to the settings file")
+  parser.add_argument("--mmap", action="store_true", dest="memoryMap",
+      help="Memory-map the files instead of reading them, which needs less memory for very "
+        "large files (the files must be UTF-8 encoded)")
+  modeGroup = parser.add_mutually_exclusive_group()
+  modeGroup.add_argument("--inplace", action="store_true",
+      help="Write formatted code back to the files instead of printing it, "
+        "but only if it differs")
+  modeGroup.add_argument("--check", action="store_true",
+      help="Don't write or print anything, but exit with status 1 if any file would change")
+  parser.add_argument("--changed-since", metavar="REV", dest="changedSince",
+      help="Only format files that changed relative to the given revision of the Git "
+        "repository of PATH (including uncommitted and untracked files)")
+  parser.add_argument("--stats", action="store_true",
+      help="Print the times of the stages of formatting and the numbers of tokens, statements, "
+        "etc. summed over all files")
+  parser.add_argument("--profile", metavar="DIR",
+      help="Profile every stage of formatting with cProfile and save the profiles to "
+        "DIR/<stage>.prof (disables --jobs and --socket)")
+  parser.add_argument("--server", action="store_true",
+      help="Run as a server that formats code sent as JSON-RPC requests on stdin/stdout (or on "
+        "the Unix socket given by --socket) instead of formatting PATH")
+  parser.add_argument("--socket", metavar="SOCKET",
+      help="Path of the Unix socket of the server; without --server, the files are formatted by "
+        "the server listening on SOCKET, if there is one")
+  parser.add_argument("path", metavar="PATH", nargs="?", help="Path to *.m source file")
   args = parser.parse_args()
 
+  if args.server:
+    from .server import FormatServer
+    server = FormatServer()
+
+    if args.socket is not None:
+      server.serveSocket(args.socket)
+    else:
+      server.serveStream(sys.stdin, sys.stdout)
+
+    return
+  elif args.path is None:
+    parser.error("the following arguments are required: PATH")
+
   settingNames = [x.name for x in Settings.metaData]
   dictSettings = {x : y for x, y in vars(args).items() if (x in settingNames) and (y is not None)}
 
-  if os.path.isdir(args.path):
-    filePaths: List[str] = []
+  if args.changedSince is not None:
+    import subprocess
+    # the files are taken from Git instead of walking the whole directory
+    try:
+      filePaths = getChangedFilePaths(args.path, args.changedSince)
+    except (OSError, subprocess.CalledProcessError) as e:
+      parser.error(f"could not determine changed files: {e}")
+  elif os.path.isdir(args.path):
+    filePaths = []
 
     for rootDirPath, folderNames, fileNames in os.walk(args.path):
       folderNames.sort()
@@ -73,7 +432,98 @@ def main() -> None:
   else:
     filePaths = [args.path]
 
-  for filePath in filePaths:
+  # profiles cannot be passed between processes
+  numberOfJobs = (args.jobs if args.jobs > 0 else (os.cpu_count() or 1))
+  numberOfJobs = (min(numberOfJobs, len(filePaths)) if args.profile is None else 1)
+  mode = ("inplace" if args.inplace else ("check" if args.check else "print"))
+  collectStats = (args.stats or (args.profile is not None))
+  stats = (FormatStats(profile=(args.profile is not None)) if collectStats else None)
+  client = None
+
+  if (args.socket is not None) and (args.profile is None):
+    from .server import FormatClient
+    client = FormatClient.connect(args.socket)
+
+  if client is not None:
+    # the server resolves paths relative to its own working directory
+    with client:
+      results: Iterable[FileResult] = (FileResult.fromDict(client.request("processFile",
+          {"path": os.path.abspath(x), "settings": dictSettings, "useCache": args.cache,
+            "mode": mode, "memoryMap": args.memoryMap, "collectStats": collectStats}))
+          for x in filePaths)
+      success = printResults(filePaths, collectFileStats(results, stats), mode)
+  elif numberOfJobs > 1:
+    import multiprocessing
+    # every file gets its own stats, which are added in this process
+    processFunction = functools.partial((processFileWithStats if collectStats else processFile),
+        dictSettings=dictSettings, useCache=args.cache, mode=mode, memoryMap=args.memoryMap)
+    # imap returns the results in the order of filePaths
+    chunkSize = max(1, min(16, len(filePaths) // (4 * numberOfJobs)))
+
+    with multiprocessing.Pool(numberOfJobs) as pool:
+      results = pool.imap(processFunction, filePaths, chunkSize)
+      success = printResults(filePaths, collectFileStats(results, stats), mode)
+  else:
+    processFunction = functools.partial(processFile, dictSettings=dictSettings,
+        useCache=args.cache, mode=mode, stats=stats, memoryMap=args.memoryMap)
+    success = printResults(filePaths, map(processFunction, filePaths), mode)
+
+  if stats is not None:
+    if args.stats: print(stats.formatTable(), file=sys.stderr)
+
+    if args.profile is not None:
+      for filePath in stats.dumpProfiles(args.profile):
+        print(f"Saved profile to '{filePath}'", file=sys.stderr)
+
+  if not success: sys.exit(1)
+
+def processFileWithStats(filePath: str, dictSettings: Dict[str, Any] = {},
+      useCache: bool = False, mode: str = "print", memoryMap: bool = False) -> FileResult:
+  return processFile(filePath, dictSettings, useCache, mode, FormatStats(), memoryMap)
+
+def collectFileStats(results: Iterable[FileResult],
+      stats: Optional[FormatStats]) -> Iterator[FileResult]:
+  # adds the stats of the results to stats while iterating over them
+  for result in results:
+    if (stats is not None) and (result.stats is not None): stats.add(result.stats)
+    yield result
+
+def getChangedFilePaths(path: str, revision: str) -> List[str]:
+  # returns the sorted real paths of the *.m files in path (a directory or a file) that were
+  # changed relative to revision or are untracked in the Git repository of path (deleted files
+  # are omitted)
+  import subprocess
+  realPath = os.path.realpath(path)
+  dirPath = (realPath if os.path.isdir(realPath) else os.path.dirname(realPath))
+
+  def runGit(*args: str) -> str:
+    return subprocess.run(["git", "-C", dirPath, *args], check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True).stdout
+
+  repositoryPath = runGit("rev-parse", "--show-toplevel").rstrip("\n")
+  relativeFilePaths = (runGit("diff", "--name-only", "-z", "--diff-filter=d", revision, "--")
+      + runGit("ls-files", "-z", "--others", "--exclude-standard", "--full-name"))
+  filePaths = {os.path.realpath(os.path.join(repositoryPath, x))
+      for x in relativeFilePaths.split("\0") if x.endswith(".m")}
+  return sorted(x for x in filePaths
+      if (x == realPath) or x.startswith(os.path.join(realPath, "")))
+
+def printResults(filePaths: List[str], results: Iterable[FileResult], mode: str) -> bool:
+  success = True
+
+  for filePath, result in zip(filePaths, results):
     print(f"Processing '{filePath}'...", file=sys.stderr)
-    code = formatFile(filePath, dictSettings)
-    print(code)
+
+    if result.errorMessage is not None:
+      print(f"Error while processing '{filePath}': {result.errorMessage}", file=sys.stderr)
+      success = False
+    elif mode == "print":
+      print(result.formattedCode)
+    elif result.changed:
+      if mode == "inplace":
+        print(f"Reformatted '{filePath}'", file=sys.stderr)
+      else:
+        print(f"Would reformat '{filePath}'", file=sys.stderr)
+        success = False
+
+  return success
@@ -0,0 +1,16 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Benchmark of the stages of mformat on generated code (run with python -m mformat.benchmark);
+# not imported by mformat itself
+
+from __future__ import annotations
+
+from .corpus import CorpusGenerator, CorpusParameters, generateCode
+from .harness import (compareResults, fitExponent, measureStages, runBenchmark, runStages,
+    stageNames)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from __future__ import annotations
+import argparse
+import json
+import os
+import sys
+
+from .corpus import CorpusParameters
+from .harness import compareResults, runBenchmark
+
+
+
+defaultBaselineFilePath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "baseline.json")
+
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Benchmark the tokenizer, the parser, and the "
+      "formatter of mformat on generated code of increasing size")
+  defaultParameters = CorpusParameters()
+  parser.add_argument("--sizes", type=int, nargs="+", default=[250, 500, 1000, 2000],
+      metavar="N", help="Numbers of statements of the generated codes "
+        "(default: 250 500 1000 2000)")
+  parser.add_argument("--repetitions", type=int, default=3, metavar="N",
+      help="Number of runs per size, of which the fastest is used (default: 3)")
+  parser.add_argument("--max-block-depth", type=int, dest="maxBlockDepth",
+      default=defaultParameters.maxBlockDepth, metavar="N",
+      help=f"Maximum nesting depth of blocks (default: {defaultParameters.maxBlockDepth})")
+  parser.add_argument("--expression-width", type=int, dest="expressionWidth",
+      default=defaultParameters.expressionWidth, metavar="N",
+      help=f"Maximum number of operands of expressions "
+        f"(default: {defaultParameters.expressionWidth})")
+  parser.add_argument("--comment-density", type=float, dest="commentDensity",
+      default=defaultParameters.commentDensity, metavar="P",
+      help=f"Probability of comments before and after statements "
+        f"(default: {defaultParameters.commentDensity})")
+  parser.add_argument("--functions", type=int, dest="numberOfFunctions",
+      default=defaultParameters.numberOfFunctions, metavar="N",
+      help=f"Number of functions, 0 for a script "
+        f"(default: {defaultParameters.numberOfFunctions})")
+  parser.add_argument("--nested-functions", action="store_true", dest="nestedFunctions",
+      help="Nest all functions in the first function")
+  parser.add_argument("--seed", type=int, default=defaultParameters.seed, metavar="N",
+      help=f"Seed of the generator (default: {defaultParameters.seed})")
+  parser.add_argument("--output", metavar="FILE", help="Save the results as JSON to FILE")
+  parser.add_argument("--baseline", metavar="FILE", default=defaultBaselineFilePath,
+      help="Compare the results with the results in FILE and exit with status 1 if there are "
+        "regressions (default: the baseline stored with the benchmark)")
+  parser.add_argument("--save-baseline", action="store_true", dest="saveBaseline",
+      help="Save the results to the baseline file instead of comparing them")
+  parser.add_argument("--time-tolerance", type=float, dest="timeTolerance", default=1.5,
+      metavar="F", help="Maximum ratio of times to the baseline, 0 to only compare the growth "
+        "(default: 1.5)")
+  parser.add_argument("--memory-tolerance", type=float, dest="memoryTolerance", default=1.25,
+      metavar="F", help="Maximum ratio of peak memory to the baseline (default: 1.25)")
+  parser.add_argument("--exponent-tolerance", type=float, dest="exponentTolerance",
+      default=0.2, metavar="E", help="Maximum increase of the exponent of the growth of "
+        "times and peak memory with the size of the code (default: 0.2)")
+  args = parser.parse_args()
+
+  parameters = CorpusParameters(maxBlockDepth=args.maxBlockDepth,
+      expressionWidth=args.expressionWidth, commentDensity=args.commentDensity,
+      numberOfFunctions=args.numberOfFunctions, nestedFunctions=args.nestedFunctions,
+      seed=args.seed)
+  results = runBenchmark(args.sizes, parameters, args.repetitions,
+      log=lambda x: print(x, file=sys.stderr))
+
+  if args.output is not None:
+    with open(args.output, "w") as f: json.dump(results, f, indent=2)
+
+  if args.saveBaseline:
+    with open(args.baseline, "w") as f: json.dump(results, f, indent=2)
+    return
+  elif not os.path.isfile(args.baseline):
+    print(f"Baseline '{args.baseline}' does not exist, use --save-baseline to create it",
+        file=sys.stderr)
+    return
+
+  with open(args.baseline, "r") as f: baseline = json.load(f)
+
+  try:
+    regressions = compareResults(results, baseline, args.timeTolerance, args.memoryTolerance,
+        args.exponentTolerance)
+  except ValueError as e:
+    parser.error(f"could not compare with baseline '{args.baseline}': {e}")
+
+  for regression in regressions: print(f"Regression: {regression}", file=sys.stderr)
+  if len(regressions) > 0: sys.exit(1)
+  print("No regressions", file=sys.stderr)
+
+
+
+if __name__ == "__main__": main()
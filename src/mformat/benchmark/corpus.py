@@ -0,0 +1,256 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from __future__ import annotations
+import random
+from typing import Any, Dict, List
+
+
+
+class CorpusParameters(object):
+  def __init__(self, numberOfStatements: int = 1000, maxBlockDepth: int = 3,
+        expressionWidth: int = 4, commentDensity: float = 0.1, numberOfFunctions: int = 1,
+        nestedFunctions: bool = False, seed: int = 0) -> None:
+    # approximate number of statements (block keywords count as statements)
+    self.numberOfStatements = numberOfStatements
+    self.maxBlockDepth = maxBlockDepth
+    # maximum number of operands of an expression (not counting subexpressions)
+    self.expressionWidth = expressionWidth
+    # probability that a statement is preceded by a comment or followed by a trailing comment
+    self.commentDensity = commentDensity
+    # 0: script without functions
+    self.numberOfFunctions = numberOfFunctions
+    # if True, every function except the first is nested in the first function
+    self.nestedFunctions = nestedFunctions
+    self.seed = seed
+
+  def toDict(self) -> Dict[str, Any]:
+    return dict(vars(self))
+
+
+
+class CorpusGenerator(object):
+  # Generates MATLAB code with the given parameters. The code is deterministic for the same
+  # parameters, and it is badly formatted on purpose (irregular whitespace, missing and
+  # superfluous semicolons, several statements in one line, line continuations), so that all
+  # stages of the formatter have work to do.
+
+  # no power operators, as the parser does not know their precedence
+  _binaryOperators = ["+", "-", "*", ".*", "/", "./", "\\", ".\\", "==", "~=", "<", "<=", ">",
+      ">=", "&", "|", "&&", "||"]
+  _identifiers = ["a", "b", "c", "x", "y", "z", "alpha", "beta", "result", "data", "value",
+      "count", "index", "matrix", "vec"]
+  _functionNames = ["f", "g", "sum", "max", "zeros", "ones", "numel", "size", "compute"]
+  _commentTexts = ["TODO: check this", "compute the result", "see above", "loop over all items",
+      "handle the special case", "normalize"]
+
+  def __init__(self, parameters: CorpusParameters) -> None:
+    self.parameters = parameters
+    self._random = random.Random(parameters.seed)
+    self._lines: List[str] = []
+    self._numberOfStatements = 0
+    self._hasBlockComment = False
+
+  def generate(self) -> str:
+    parameters = self.parameters
+    self._random.seed(parameters.seed)
+    self._lines = []
+    self._numberOfStatements = 0
+    self._hasBlockComment = False
+
+    if parameters.numberOfFunctions == 0:
+      self._generateStatements(parameters.numberOfStatements, 0)
+    else:
+      numberOfStatementsPerFunction = max(
+          parameters.numberOfStatements // parameters.numberOfFunctions - 2, 1)
+
+      for i in range(parameters.numberOfFunctions):
+        self._generateFunctionHeader(i)
+        self._generateStatements(numberOfStatementsPerFunction, 0)
+        if (not parameters.nestedFunctions) or (i > 0): self._lines.append("end")
+        if not parameters.nestedFunctions: self._lines.append("")
+
+      if parameters.nestedFunctions: self._lines.append("end")
+
+    return "\n".join(self._lines) + "\n"
+
+  def _generateFunctionHeader(self, index: int) -> None:
+    random_ = self._random
+    arguments = ",".join(random_.sample(self._identifiers, random_.randint(0, 3)))
+    outputs = random_.sample(self._identifiers, random_.randint(0, 2))
+
+    if len(outputs) == 0:
+      header = f"function fun{index}({arguments})"
+    elif len(outputs) == 1:
+      header = f"function {outputs[0]} = fun{index}({arguments})"
+    else:
+      header = f"function [{','.join(outputs)}]=fun{index}( {arguments} )"
+
+    self._appendComment()
+    self._lines.append(header)
+    self._numberOfStatements += 1
+
+  def _generateStatements(self, numberOfStatements: int, blockDepth: int) -> None:
+    targetNumberOfStatements = self._numberOfStatements + numberOfStatements
+
+    while self._numberOfStatements < targetNumberOfStatements:
+      remaining = targetNumberOfStatements - self._numberOfStatements
+
+      if ((blockDepth < self.parameters.maxBlockDepth) and (remaining >= 4)
+            and (self._random.random() < 0.2)):
+        self._generateBlock(min(remaining - 2, self._random.randint(2, 12)), blockDepth)
+      else:
+        self._generateSimpleStatements()
+
+  def _generateBlock(self, numberOfStatements: int, blockDepth: int) -> None:
+    random_ = self._random
+    kind = random_.choice(["if", "for", "while", "switch", "try"])
+    separator = random_.choice(["", ";"])
+    self._appendComment()
+    self._numberOfStatements += 1
+
+    if kind == "if":
+      self._lines.append(f"if {self._generateExpression(0)}{separator}")
+      branchKeywords = ["elseif", "else"][:random_.randint(0, 2)]
+    elif kind == "for":
+      self._lines.append(f"for {random_.choice(self._identifiers)}="
+          f"{self._generateOperand(1)}:{self._generateOperand(1)}{separator}")
+      branchKeywords = []
+    elif kind == "while":
+      self._lines.append(f"while {self._generateExpression(0)}{separator}")
+      branchKeywords = []
+    elif kind == "switch":
+      self._lines.append(f"switch {random_.choice(self._identifiers)}")
+      branchKeywords = ["case"] * random_.randint(1, 3) + ["otherwise"]
+    else:
+      self._lines.append("try")
+      branchKeywords = ["catch"]
+
+    numberOfBranches = len(branchKeywords) + (0 if kind == "switch" else 1)
+    numberOfStatementsPerBranch = max(
+        (numberOfStatements - numberOfBranches) // numberOfBranches, 1)
+    if kind != "switch": self._generateStatements(numberOfStatementsPerBranch, blockDepth + 1)
+
+    for keyword in branchKeywords:
+      self._numberOfStatements += 1
+
+      if keyword == "elseif":
+        self._lines.append(f"elseif {self._generateExpression(0)}")
+      elif keyword == "case":
+        self._lines.append(f"case {random_.randint(0, 9)}")
+      elif keyword == "catch":
+        self._lines.append(f"catch {random_.choice(['', 'err'])}")
+      else:
+        self._lines.append(keyword)
+
+      self._generateStatements(numberOfStatementsPerBranch, blockDepth + 1)
+
+    self._numberOfStatements += 1
+    self._lines.append(random_.choice(["end", "end;", "end ", "  end"]))
+
+  def _generateSimpleStatements(self) -> None:
+    random_ = self._random
+    self._appendComment()
+    numberOfStatements = (random_.randint(2, 3) if random_.random() < 0.1 else 1)
+    statements = []
+
+    for i in range(numberOfStatements):
+      self._numberOfStatements += 1
+      # keywords only at the end of lines, as they cannot be followed by semicolons (see below)
+      kind = random_.random()
+      if i < numberOfStatements - 1: kind = min(kind, 0.89)
+
+      if kind < 0.75:
+        target = self._generateOperand(2, assignable=True)
+        statement = f"{target}{random_.choice(['=', ' = ', '  =', '= '])}"
+        statement += self._generateExpression(0)
+      elif kind < 0.9:
+        statement = self._generateCall(1)
+      else:
+        statement = random_.choice(["break", "continue", "return"])
+
+      # no semicolons after keywords, as "return;" is formatted as "return ;", which the parser
+      # does not support
+      terminator = ("" if kind >= 0.9 else random_.choice([";", ";", ";", "", " ;", ";;"]))
+      # statements in the same line have to be separated
+      if (terminator == "") and (i < numberOfStatements - 1): terminator = ";"
+      statements.append(statement + terminator)
+
+    line = random_.choice(["", " ", "  "]).join(statements)
+    line = random_.choice(["", "", "  ", "\t"]) + line + random_.choice(["", "", "  "])
+
+    if random_.random() < self.parameters.commentDensity:
+      line += f"  % {random_.choice(self._commentTexts)}"
+
+    self._lines.append(line)
+
+  def _appendComment(self) -> None:
+    random_ = self._random
+    if random_.random() >= self.parameters.commentDensity: return
+
+    # at most one block comment, as a block comment extends to the last "%}" of the code
+    if (not self._hasBlockComment) and (random_.random() < 0.1):
+      self._lines.extend(["%{", random_.choice(self._commentTexts), "%}"])
+      self._hasBlockComment = True
+    else:
+      self._lines.append(f"% {random_.choice(self._commentTexts)}")
+
+  def _generateExpression(self, depth: int) -> str:
+    random_ = self._random
+    numberOfOperands = random_.randint(1, max(self.parameters.expressionWidth, 1))
+    code = self._generateOperand(depth)
+
+    for i in range(1, numberOfOperands):
+      operator = random_.choice(self._binaryOperators)
+      # "1.*x" would be tokenized as "1." and "*x"
+      space = random_.choice([" ", "  "] if operator.startswith(".") else ["", " ", "  "])
+      # line continuations in long expressions
+      continuation = (" ...\n    " if (i % 4 == 0) and (random_.random() < 0.3) else "")
+      code += f"{space}{operator}{continuation}{space}{self._generateOperand(depth)}"
+
+    return code
+
+  def _generateOperand(self, depth: int, assignable: bool = False) -> str:
+    random_ = self._random
+    kind = random_.random()
+    identifier = random_.choice(self._identifiers)
+    if (depth >= 2) and (not assignable): kind = min(kind, 0.49)
+
+    if kind < 0.3:
+      return identifier
+    elif (kind < 0.5) and (not assignable):
+      # no decimal fractions, as the tokenizer splits "0.5" into "0" and ".5"
+      return random_.choice([str(random_.randint(0, 100)), f"{random_.randint(1, 9)}e3",
+          f"'str{random_.randint(0, 9)}'"])
+    elif kind < 0.6:
+      return f"{identifier}.{random_.choice(self._identifiers)}"
+    elif kind < 0.75:
+      return f"{identifier}({self._generateArguments(depth + 1)})"
+    elif assignable:
+      return f"{identifier}{{{random_.randint(1, 9)}}}"
+    elif kind < 0.85:
+      return f"({self._generateExpression(depth + 1)})"
+    elif kind < 0.95:
+      # only one row, as the parser splits statements at all semicolons
+      return f"[{self._generateArguments(depth + 1)}]"
+    else:
+      return self._generateCall(depth + 1)
+
+  def _generateArguments(self, depth: int) -> str:
+    random_ = self._random
+    arguments = [(self._generateExpression(depth) if depth < 2 else self._generateOperand(depth))
+        for _ in range(random_.randint(1, 3))]
+    return random_.choice([",", ", ", " , "]).join(arguments)
+
+  def _generateCall(self, depth: int) -> str:
+    return f"{self._random.choice(self._functionNames)}({self._generateArguments(depth + 1)})"
+
+
+
+def generateCode(parameters: CorpusParameters) -> str:
+  return CorpusGenerator(parameters).generate()
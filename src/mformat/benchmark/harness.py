@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from __future__ import annotations
+import gc
+import io
+import math
+import platform
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from ..formatter import formatAst
+from ..memo import parseStatementsWithMemo, StatementMemo, writeMemoizedStatements
+from ..parser import parseTokens, splitIntoStatements
+from ..settings import Settings
+from ..tokenizer import Tokenizer
+from .corpus import CorpusParameters, generateCode
+
+T = TypeVar("T")
+
+
+
+# tokenize, parse (parseTokens) and format (formatAst) are the stages of the AST; the other
+# stages are the stages of formatCode with an empty StatementMemo on the same tokens
+stageNames = ["tokenize", "parse", "format", "splitIntoStatements", "parseWithMemo",
+    "formatWithMemo"]
+resultsVersion = 2
+
+
+
+def measureStages(code: str, settings: Optional[Settings] = None,
+      repetitions: int = 3) -> Dict[str, Dict[str, float]]:
+  # returns stage name -> {"time": minimum time in seconds, "peakMemory": peak of the memory
+  # allocated during the stage in bytes}; memory is measured in a separate run, as tracing
+  # allocations slows down the stages
+  if settings is None: settings = Settings()
+  times: Dict[str, List[float]] = {x : [] for x in stageNames}
+
+  for _ in range(repetitions):
+    for stageName, stageTime in runStages(code, settings, False).items():
+      times[stageName].append(stageTime)
+
+  peakMemories = runStages(code, settings, True)
+  return {x : {"time" : min(times[x]), "peakMemory" : peakMemories[x]} for x in stageNames}
+
+
+
+def runStages(code: str, settings: Settings, measureMemory: bool) -> Dict[str, float]:
+  # runs tokenizer, parser, and formatter one after the other, each on the output of the
+  # previous stage, and then the stages of formatCode on the same tokens (see stageNames), and
+  # returns the time or the peak memory of every stage; parseWithMemo includes looking up the
+  # statements in the memo
+  measurements: Dict[str, float] = {}
+
+  def measure(stageName: str, function: Callable[[], T]) -> T:
+    gc.collect()
+
+    if measureMemory:
+      tracemalloc.start()
+
+      try:
+        result = function()
+        measurements[stageName] = tracemalloc.get_traced_memory()[1]
+      finally:
+        tracemalloc.stop()
+    else:
+      startTime = time.perf_counter()
+      result = function()
+      measurements[stageName] = time.perf_counter() - startTime
+
+    return result
+
+  tokens = measure("tokenize", lambda: Tokenizer().tokenizeCode(code))
+  ast = measure("parse", lambda: parseTokens(tokens, settings))
+  measure("format", lambda: formatAst(ast, settings, inPlace=True))
+
+  # formatting does not modify the tokens
+  memo = StatementMemo()
+  statements = measure("splitIntoStatements", lambda: splitIntoStatements(tokens))
+  memoizedStatements = measure("parseWithMemo",
+      lambda: parseStatementsWithMemo(statements, settings, memo))
+  measure("formatWithMemo", lambda: writeMemoizedStatements(memoizedStatements, settings, memo,
+      io.StringIO()))
+  return measurements
+
+
+
+def runBenchmark(sizes: Sequence[int], parameters: Optional[CorpusParameters] = None,
+      repetitions: int = 3, log: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+  # generates a code for every size (number of statements) with the other parameters and
+  # measures the stages for it; the returned results can be saved as JSON
+  if parameters is None: parameters = CorpusParameters()
+  corpus = parameters.toDict()
+  del corpus["numberOfStatements"]
+  entries = []
+
+  for size in sizes:
+    code = generateCode(CorpusParameters(**corpus, numberOfStatements=size))
+    entry = {"numberOfStatements" : size, "numberOfCharacters" : len(code),
+        "stages" : measureStages(code, repetitions=repetitions)}
+    entries.append(entry)
+    if log is not None: log(formatEntry(entry))
+
+  return {"version" : resultsVersion, "python" : platform.python_version(),
+      "platform" : platform.platform(), "corpus" : corpus, "repetitions" : repetitions,
+      "results" : entries}
+
+
+
+def formatEntry(entry: Dict[str, Any]) -> str:
+  stages = entry["stages"]
+  return (f"{entry['numberOfStatements']:>7} statements "
+      f"{entry['numberOfCharacters']:>9} characters  "
+      + "  ".join(f"{x} {1000 * stages[x]['time']:8.1f} ms "
+        f"{stages[x]['peakMemory'] / 2**20:6.1f} MiB" for x in stageNames))
+
+
+
+def fitExponent(points: Sequence[Tuple[float, float]]) -> Optional[float]:
+  # returns the slope of the least-squares line through (log x, log y), i.e., the exponent k of
+  # y ~ x^k, or None if there are less than two distinct x
+  logPoints = [(math.log(x), math.log(max(y, 1e-9))) for x, y in points]
+  if len({x for x, _ in logPoints}) < 2: return None
+  meanX = sum(x for x, _ in logPoints) / len(logPoints)
+  meanY = sum(y for _, y in logPoints) / len(logPoints)
+  return (sum((x - meanX) * (y - meanY) for x, y in logPoints)
+      / sum((x - meanX)**2 for x, _ in logPoints))
+
+
+
+def compareResults(results: Dict[str, Any], baseline: Dict[str, Any],
+      timeTolerance: float = 1.5, memoryTolerance: float = 1.25,
+      exponentTolerance: float = 0.2) -> List[str]:
+  # Returns a description of every regression of results compared with baseline (empty if
+  # there are none). For every stage and metric, the exponent of the growth with the size of
+  # the code is compared, which catches super-linear regressions independently of the speed
+  # of the machine. In addition, the values of every size contained in both results are
+  # compared (timeTolerance = 0 disables this for times, which depend on the machine).
+  if results.get("version") != baseline.get("version"):
+    raise ValueError("results and baseline have different versions")
+  elif results["corpus"] != baseline["corpus"]:
+    raise ValueError("results and baseline were measured with different corpus parameters")
+
+  baselineEntries = {x["numberOfStatements"] : x for x in baseline["results"]}
+  entries = [x for x in results["results"] if x["numberOfStatements"] in baselineEntries]
+  regressions = []
+
+  for stageName in stageNames:
+    for metricName, tolerance in [("time", timeTolerance), ("peakMemory", memoryTolerance)]:
+      exponent = fitExponent([(x["numberOfCharacters"], x["stages"][stageName][metricName])
+          for x in entries])
+      baselineExponent = fitExponent([(x["numberOfCharacters"],
+          x["stages"][stageName][metricName])
+          for x in (baselineEntries[y["numberOfStatements"]] for y in entries)])
+
+      if ((exponent is not None) and (baselineExponent is not None)
+            and (exponent > baselineExponent + exponentTolerance)):
+        regressions.append(f"{stageName} {metricName} grows with exponent {exponent:.2f} "
+            f"instead of {baselineExponent:.2f}")
+
+      if tolerance <= 0: continue
+
+      for entry in entries:
+        value = entry["stages"][stageName][metricName]
+        baselineValue = baselineEntries[entry["numberOfStatements"]]["stages"][stageName][
+            metricName]
+
+        if value > tolerance * baselineValue:
+          regressions.append(f"{stageName} {metricName} for {entry['numberOfStatements']} "
+              f"statements is {value / baselineValue:.2f} times the baseline")
+
+  return regressions
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Optional, TYPE_CHECKING, Union
+
+from .settings import Settings
+
+if TYPE_CHECKING:
+  import mmap
+
+
+
+class ResultCache(object):
+  # Stores the keys of codes that are already formatted, so that they do not have to be
+  # tokenized again. A key is a hash of the code, the settings and the source code of mformat
+  # itself (there is no version number that changes with every change of the formatter).
+  # The cache is an SQLite database, which serializes writes of concurrent processes. If the
+  # database cannot be used, the cache is disabled silently, as it only saves time.
+
+  fileName = ".mformat-cache"
+  maxNumberOfEntries = 65536
+  _instances: Dict[str, ResultCache] = {}
+  _formatterHash: Optional[str] = None
+
+  def __init__(self, filePath: str) -> None:
+    self.filePath = filePath
+    self._connection: Optional[sqlite3.Connection] = None
+    # upper bound of the number of entries, counted on the first add and then incremented, so
+    # that the entries are only counted again when eviction might be needed (entries added by
+    # other processes are only noticed then)
+    self._numberOfEntries: Optional[int] = None
+
+    try:
+      self._connection = sqlite3.connect(filePath, timeout=30.0, isolation_level=None)
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._connection.execute("PRAGMA synchronous=NORMAL")
+      self._connection.execute(
+          "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, lastUsed REAL)")
+    except sqlite3.Error:
+      self._disable()
+
+  @staticmethod
+  def getForDirectory(dirPath: str) -> ResultCache:
+    filePath = os.path.join(os.path.abspath(dirPath), ResultCache.fileName)
+
+    if filePath not in ResultCache._instances:
+      ResultCache._instances[filePath] = ResultCache(filePath)
+
+    return ResultCache._instances[filePath]
+
+  @staticmethod
+  def getKey(code: Union[str, bytes, mmap.mmap], settings: Settings) -> str:
+    # UTF-8 encoded code has the same key as the code
+    hash_ = hashlib.sha256()
+    hash_.update(ResultCache._getFormatterHash().encode())
+    hash_.update(json.dumps(vars(settings), sort_keys=True).encode())
+    hash_.update(code.encode() if isinstance(code, str) else code)
+    return hash_.hexdigest()
+
+  @staticmethod
+  def _getFormatterHash() -> str:
+    if ResultCache._formatterHash is None:
+      hash_ = hashlib.sha256()
+      dirPath = os.path.dirname(os.path.abspath(__file__))
+
+      for fileName in sorted(os.listdir(dirPath)):
+        if not fileName.endswith(".py"): continue
+        with open(os.path.join(dirPath, fileName), "rb") as f: hash_.update(f.read())
+
+      ResultCache._formatterHash = hash_.hexdigest()
+
+    return ResultCache._formatterHash
+
+  def contains(self, key: str) -> bool:
+    if self._connection is None: return False
+
+    try:
+      # the update marks the entry as recently used for eviction
+      cursor = self._connection.execute(
+          "UPDATE entries SET lastUsed = ? WHERE key = ?", (time.time(), key))
+      return cursor.rowcount > 0
+    except sqlite3.Error:
+      self._disable()
+      return False
+
+  def add(self, key: str) -> None:
+    if self._connection is None: return
+
+    try:
+      self._connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?)", (key, time.time()))
+
+      if self._numberOfEntries is None:
+        self._numberOfEntries = self._countEntries()
+      else:
+        self._numberOfEntries += 1
+
+      if self._numberOfEntries <= self.maxNumberOfEntries: return
+      self._numberOfEntries = self._countEntries()
+
+      if self._numberOfEntries > self.maxNumberOfEntries:
+        # evict the least recently used entries, with some headroom to not evict on every add
+        numberOfEvictedEntries = self._numberOfEntries - (3 * self.maxNumberOfEntries) // 4
+        self._connection.execute("DELETE FROM entries WHERE key IN "
+            "(SELECT key FROM entries ORDER BY lastUsed LIMIT ?)", (numberOfEvictedEntries,))
+        self._numberOfEntries -= numberOfEvictedEntries
+    except sqlite3.Error:
+      self._disable()
+
+  def _countEntries(self) -> int:
+    assert self._connection is not None
+    return int(self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0])
+
+  def _disable(self) -> None:
+    if self._connection is not None:
+      try:
+        self._connection.close()
+      except sqlite3.Error:
+        pass
+
+    self._connection = None
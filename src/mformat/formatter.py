@@ -7,138 +7,434 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 from __future__ import annotations
-import copy
-import re
-from typing import Optional, Tuple
+import io
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
 
 from .parser import AstNode
 from .settings import Settings
-from .tokenizer import Token
+from .tokenizer import Token, TokenKind
 
 
 
 class ArtificialToken(Token):
-  startPos = -1
+  __slots__ = ()
+  artificialStartPos = -1
 
-  def __init__(self, code: str, className: str) -> None:
-    Token.__init__(self, code, ArtificialToken.startPos, className)
+  def __init__(self, code: str, kind: Union[TokenKind, str]) -> None:
+    Token.__init__(self, code, ArtificialToken.artificialStartPos, kind)
 
 
 
-def formatAst(ast: AstNode, settings: Settings) -> str:
-  ast = copy.deepcopy(ast)
+def formatAst(ast: AstNode, settings: Settings, inPlace: bool = False,
+      passTimes: Optional[Dict[str, float]] = None) -> str:
+  # if inPlace is True, ast is modified, which is cheaper if the caller does not need it anymore;
+  # if passTimes is given, the seconds spent in each pass are added to it
+  stream = io.StringIO()
+  writeFormattedAst(ast, settings, stream, inPlace, passTimes)
+  return stream.getvalue()
 
-  removeWhitespaces(ast)
-  insertNewlinesBetweenStatements(ast)
-  removeSuperfluousSemicolons(ast)
-  indent(ast, settings)
-  insertWhitespaces(ast, settings)
 
-  code = str(ast)
-  code = re.sub(r"([^ ]|^) +$", r"\1", code, flags=re.MULTILINE)
 
-  code = code.rstrip()
-  if settings.newlineAtEndOfFile: code += "\n"
+def writeFormattedAst(ast: AstNode, settings: Settings, stream: TextIO, inPlace: bool = False,
+      passTimes: Optional[Dict[str, float]] = None) -> None:
+  # same as formatAst, but the code is written to stream in chunks (see writeAst)
+  if not inPlace:
+    startTime = time.perf_counter()
+    ast = ast.copy()
+    addPassTime(passTimes, "copy", time.perf_counter() - startTime)
+
+  runFormattingPasses(ast, createCleanupPasses(), passTimes)
+  runFormattingPasses(ast, createSpacingPasses(settings), passTimes)
+
+  startTime = time.perf_counter()
+  # trailing whitespace at the end of the file is never flushed
+  writeAst(ast, TrailingWhitespaceRemover(), stream)
+  if settings.newlineAtEndOfFile: stream.write("\n")
+  addPassTime(passTimes, "render", time.perf_counter() - startTime)
+
+
+
+class TrailingWhitespaceRemover(object):
+  def __init__(self, pendingWhitespace: str = "") -> None:
+    # pendingWhitespace continues where a remover with this pending whitespace stopped
+    self._pendingWhitespace = pendingWhitespace
+
+  def getPendingWhitespace(self) -> str:
+    return self._pendingWhitespace
+
+  def process(self, code: str) -> str:
+    # whitespace at the end is held back until it is known whether it is trailing
+    if ((len(self._pendingWhitespace) == 0) and (len(code) > 0)
+          and (not code[-1].isspace()) and (" \n" not in code)):
+      return code
+
+    code = self._pendingWhitespace + code
+    strippedCode = code.rstrip()
+    self._pendingWhitespace = code[len(strippedCode):]
+
+    if " \n" in strippedCode:
+      strippedCode = "\n".join(x.rstrip(" ") for x in strippedCode.split("\n"))
+
+    return strippedCode
+
+  def flush(self) -> str:
+    # returns the held back whitespace, for when no code follows that would have to be checked
+    pendingWhitespace = self._pendingWhitespace
+    self._pendingWhitespace = ""
+    return "\n".join(x.rstrip(" ") for x in pendingWhitespace.split("\n"))
+
+
+
+def renderAst(ast: AstNode, trailingWhitespaceRemover: TrailingWhitespaceRemover) -> str:
+  process = trailingWhitespaceRemover.process
+  return "".join(process(x.token.code) for x in ast.iterPreOrder() if x.token is not None)
+
+
+
+def writeAst(ast: AstNode, trailingWhitespaceRemover: TrailingWhitespaceRemover,
+      stream: TextIO, chunkSize: int = 4096) -> None:
+  # same as renderAst, but the code is written to stream in chunks of the code of chunkSize
+  # tokens, so that neither every token is written on its own nor the whole code is joined
+  process = trailingWhitespaceRemover.process
+  chunk: List[str] = []
+
+  for node in ast.iterPreOrder():
+    if node.token is None: continue
+    chunk.append(process(node.token.code))
+
+    if len(chunk) >= chunkSize:
+      stream.write("".join(chunk))
+      chunk.clear()
+
+  stream.write("".join(chunk))
+
+
+
+def iterFormatStatements(statementNodes: Iterable[AstNode], settings: Settings) -> Iterator[str]:
+  # formats statement nodes with parents and block depths (see iterParseTokens) one after the
+  # other; every statement is formatted once the next one is known, which is needed to decide on
+  # the newline between them (see NewlineInsertionPass)
+  trailingWhitespaceRemover = TrailingWhitespaceRemover()
+  prevStatementNode = None
+
+  for statementNode in statementNodes:
+    runFormattingPasses(statementNode, createCleanupPasses())
+
+    if prevStatementNode is not None:
+      if ((prevStatementNode.goToDescendant("newline", excludeNode=True) is None)
+            and (str(statementNode) != "\n")):
+        prevStatementNode.appendNewAstNodeAsChild(ArtificialToken("\n", TokenKind.newline))
+
+      runFormattingPasses(prevStatementNode, createSpacingPasses(settings))
+      code = trailingWhitespaceRemover.process(str(prevStatementNode))
+      if len(code) > 0: yield code
+
+    prevStatementNode = statementNode
+
+  if prevStatementNode is not None:
+    runFormattingPasses(prevStatementNode, createSpacingPasses(settings))
+    code = trailingWhitespaceRemover.process(str(prevStatementNode))
+    if len(code) > 0: yield code
+
+  if settings.newlineAtEndOfFile: yield "\n"
+
+
+
+def formatStatements(statementNodes: List[AstNode], settings: Settings,
+      atEndOfFile: bool) -> str:
+  # formats consecutive statements of a tree whose block depths have been computed; the text
+  # of the statements is returned, with the end of the file handled as in formatAst if
+  # atEndOfFile is True
+  runFormattingPasses(statementNodes, createCleanupPasses())
+  runFormattingPasses(statementNodes, createSpacingPasses(settings))
+  trailingWhitespaceRemover = TrailingWhitespaceRemover()
+  code = "".join(renderAst(x, trailingWhitespaceRemover) for x in statementNodes)
+
+  if not atEndOfFile:
+    code += trailingWhitespaceRemover.flush()
+  elif settings.newlineAtEndOfFile:
+    code += "\n"
 
   return code
 
 
 
-def removeWhitespaces(node: AstNode) -> None:
-  oldChildren = list(node.children)
+def formatStatementCopy(statementNode: AstNode, settings: Settings, appendNewline: bool) -> str:
+  # Formats a copy of a statement of a tree whose block depths have been computed, without
+  # modifying the tree. The copy keeps the parent of the statement for passes that check
+  # ancestors, but it is not one of its children. Newlines between statements are only inserted
+  # if appendNewline is True, and trailing whitespace is not removed.
+  statementNodeCopy = statementNode.copy()
+  statementNodeCopy.parent = statementNode.parent
+  return formatDetachedStatement(statementNodeCopy, settings, appendNewline)
 
-  for i, child in enumerate(oldChildren[::-1]):
-    if child.className in ["lineContinuationComment", "whitespace"]:
-      del node.children[len(oldChildren) - i - 1]
 
-  for child in node.children: removeWhitespaces(child)
 
+def formatDetachedStatement(statementNode: AstNode, settings: Settings,
+      appendNewline: bool, passTimes: Optional[Dict[str, float]] = None) -> str:
+  # same as formatStatementCopy, but statementNode is modified instead of a copy; its parent
+  # has to be set, but it does not have to be one of the children of its parent
+  if appendNewline:
+    statementNode.appendNewAstNodeAsChild(ArtificialToken("\n", TokenKind.newline))
 
+  runFormattingPasses(statementNode, createCleanupPasses(), passTimes)
+  runFormattingPasses(statementNode, createSpacingPasses(settings), passTimes)
+  return str(statementNode)
 
-def insertNewlinesBetweenStatements(ast: AstNode) -> None:
-  curStatementNode = ast.goToDescendant("statement")
-  if curStatementNode is None: return
-  nextStatementNode = curStatementNode.goToNext("statement")
 
-  while nextStatementNode is not None:
-    newlineNode = curStatementNode.goToNext("newline")
-    numberOfNewlines = 0
 
-    while (newlineNode is not None) and (newlineNode < nextStatementNode):
-      numberOfNewlines += 1
-      newlineNode = newlineNode.goToNext("newline")
+class FormattingPass(object):
+  # A pass is a node visitor. The passes given to runFormattingPasses are run together in a
+  # single pre-order walk: for every node, the visit methods of the passes that accept its class
+  # name are called in the order of the passes, and only then the children of the node are
+  # visited. A pass may modify the children of the visited node (and the node itself), and it
+  # stops descending into the subtree by returning False. finish is called after the walk.
 
-    if (numberOfNewlines == 0) and (str(nextStatementNode) != "\n"):
-      curStatementNode.appendNewAstNodeAsChild(ArtificialToken("\n", "newline"))
+  name = ""
 
-    curStatementNode = nextStatementNode
-    nextStatementNode = nextStatementNode.goToNext("statement")
+  def acceptsClassName(self, className: str) -> bool:
+    return True
 
+  def visit(self, node: AstNode) -> bool:
+    return True
 
+  def finish(self) -> None:
+    pass
+
+
+
+def runFormattingPasses(ast: Union[AstNode, List[AstNode]], passes: List[FormattingPass],
+      passTimes: Optional[Dict[str, float]] = None) -> None:
+  # ast may also be a list of disjoint subtrees, which are walked in order as if they were
+  # consecutive subtrees of one tree
+  startTime = time.perf_counter()
+  visitTimes = [0.0] * len(passes)
+  acceptingPassIndices: Dict[str, Tuple[int, ...]] = {}
+  # number of subtrees in which a pass has stopped descending and that are not left yet; an
+  # integer i on the stack marks the end of such a subtree of the i-th pass
+  skipCounts = [0] * len(passes)
+  nodeStack: List[Union[AstNode, int]] = ([ast] if isinstance(ast, AstNode) else ast[::-1])
+
+  while len(nodeStack) > 0:
+    node = nodeStack.pop()
+
+    if isinstance(node, int):
+      skipCounts[node] -= 1
+      continue
+
+    passIndices = acceptingPassIndices.get(node.className)
+
+    if passIndices is None:
+      passIndices = tuple(i for i, x in enumerate(passes) if x.acceptsClassName(node.className))
+      acceptingPassIndices[node.className] = passIndices
+
+    for i in passIndices:
+      if skipCounts[i] > 0: continue
+
+      if passTimes is None:
+        descend = passes[i].visit(node)
+      else:
+        visitStartTime = time.perf_counter()
+        descend = passes[i].visit(node)
+        visitTimes[i] += time.perf_counter() - visitStartTime
+
+      if not descend:
+        skipCounts[i] += 1
+        nodeStack.append(i)
+
+    nodeStack.extend(reversed(node.children))
+
+  for i, pass_ in enumerate(passes):
+    finishStartTime = time.perf_counter()
+    pass_.finish()
+    visitTimes[i] += time.perf_counter() - finishStartTime
+
+  if passTimes is not None:
+    for pass_, visitTime in zip(passes, visitTimes): addPassTime(passTimes, pass_.name, visitTime)
+    addPassTime(passTimes, "traversal", time.perf_counter() - startTime - sum(visitTimes))
+
+
+
+def addPassTime(passTimes: Optional[Dict[str, float]], name: str, seconds: float) -> None:
+  if passTimes is not None: passTimes[name] = passTimes.get(name, 0.0) + seconds
 
-def removeSuperfluousSemicolons(ast: AstNode) -> None:
-  blockNode = ast.goToDescendant("Block")
 
-  while blockNode is not None:
-    if blockNode.className == "functionBlock":
-      statementNodes = []
+
+def createCleanupPasses() -> List[FormattingPass]:
+  return [WhitespaceRemovalPass(), NewlineInsertionPass(), SemicolonRemovalPass()]
+
+
+
+def createSpacingPasses(settings: Settings) -> List[FormattingPass]:
+  # run after the cleanup passes, as the argument lengths of WhitespaceInsertionPass must not
+  # include removed whitespace
+  return [IndentationPass(settings), WhitespaceInsertionPass(settings)]
+
+
+
+class WhitespaceRemovalPass(FormattingPass):
+  name = "removeWhitespaces"
+  _removedClassNames = frozenset(["lineContinuationComment", "whitespace"])
+
+  def acceptsClassName(self, className: str) -> bool:
+    # the parser puts all irrelevant tokens in irrelevantTokens nodes
+    return className == "irrelevantTokens"
+
+  def visit(self, node: AstNode) -> bool:
+    # children are removed before they are visited, so that no other pass sees them
+    children = node.children
+
+    if any(x.className in self._removedClassNames for x in children):
+      children[:] = [x for x in children if x.className not in self._removedClassNames]
+      node.invalidateLength()
+
+    return True
+
+
+
+class NewlineInsertionPass(FormattingPass):
+  # Statements do not contain statements, so a newline is between two consecutive statements
+  # if and only if it is contained in the first one. Newlines are inserted in finish, when the
+  # whitespace of all statements has been removed.
+
+  name = "insertNewlinesBetweenStatements"
+
+  def __init__(self) -> None:
+    self._curStatementNode: Optional[AstNode] = None
+    self._curStatementContainsNewline = False
+    self._statementNodePairs: List[Tuple[AstNode, AstNode]] = []
+
+  def acceptsClassName(self, className: str) -> bool:
+    return className in ["statement", "newline"]
+
+  def visit(self, node: AstNode) -> bool:
+    if node.className == "newline":
+      self._curStatementContainsNewline = True
     else:
-      statementNodes = ([x for x in blockNode.children if x.className == "statement"] +
-          [y for x in blockNode.children for y in x.children if y.className == "statement"])
+      if (self._curStatementNode is not None) and (not self._curStatementContainsNewline):
+        self._statementNodePairs.append((self._curStatementNode, node))
+
+      self._curStatementNode = node
+      self._curStatementContainsNewline = False
+
+    return True
+
+  def finish(self) -> None:
+    for curStatementNode, nextStatementNode in self._statementNodePairs:
+      if (nextStatementNode.getLength() != 1) or (str(nextStatementNode) != "\n"):
+        curStatementNode.appendNewAstNodeAsChild(ArtificialToken("\n", TokenKind.newline))
+
+
+
+class SemicolonRemovalPass(FormattingPass):
+  # removes the semicolons of the statements that are children or grandchildren of blocks
+  # other than function blocks (e.g., "if a;" and "end;")
+
+  name = "removeSuperfluousSemicolons"
 
-    for statementNode in statementNodes:
-      if statementNode is None: continue
+  def acceptsClassName(self, className: str) -> bool:
+    return className == "semicolon"
 
-      while (semicolonNode := statementNode.goToDescendant("semicolon")) is not None:
-        semicolonNode.remove()
+  def visit(self, node: AstNode) -> bool:
+    statementNode = node.goToAncestor("statement")
+    if (statementNode is None) or (statementNode.parent is None): return True
+    blockNode: Optional[AstNode] = statementNode.parent
+    if not blockNode.className.endswith("Block"): blockNode = blockNode.parent
 
-    blockNode = blockNode.goToNext("Block")
+    if ((blockNode is not None) and blockNode.className.endswith("Block")
+          and (blockNode.className != "functionBlock")):
+      node.remove()
 
+    return False
 
 
-def indent(node: AstNode, settings: Settings) -> None:
-  if node.className == "statement":
+
+class IndentationPass(FormattingPass):
+  name = "indent"
+
+  def __init__(self, settings: Settings) -> None:
+    indentationCharacter = (" " if settings.indentWithSpace else "\t")
+    self._indentation = settings.indent * indentationCharacter
+
+  def acceptsClassName(self, className: str) -> bool:
+    return className == "statement"
+
+  def visit(self, node: AstNode) -> bool:
     if node.blockDepth is not None:
-      indentationCharacter = (" " if settings.indentWithSpace else "\t")
-      indentation = (node.blockDepth * settings.indent) * indentationCharacter
+      indentation = node.blockDepth * self._indentation
       index = (1 if (len(node.children) >= 1) and (node.children[0].className == "newline") else 0)
-      node.insertNewAstNodeAsChild(index, ArtificialToken(indentation, "whitespace"))
-  else:
-    for child in node.children: indent(child, settings)
+      node.insertNewAstNodeAsChild(index, ArtificialToken(indentation, TokenKind.whitespace))
+
+    return False
+
+
 
+class WhitespaceInsertionPass(FormattingPass):
+  name = "insertWhitespaces"
 
+  def __init__(self, settings: Settings) -> None:
+    self._settings = settings
 
-def insertWhitespaces(node: AstNode, settings: Settings) -> None:
-  if node.className.endswith("OperatorNode"):
-    insertSpaces = (node.children[0].className != "empty")
+  def acceptsClassName(self, className: str) -> bool:
+    return (className.endswith("OperatorNode")
+        or (className in ["commaSeparatedList", "keyword", "semicolon"]))
 
-    if insertSpaces and (node.className == "colonOperatorNode"):
-      insertSpaces = not (settings.omitSpaceAroundColon and checkMaximumLengthOfArguments(
-            node, settings.omitSpaceAroundColonMaxLength, "colonOperator"))
+  def visit(self, node: AstNode) -> bool:
+    settings = self._settings
 
-    if insertSpaces:
-      node.insertNewAstNodeAsChild(2, ArtificialToken(" ", "whitespace"))
-      node.insertNewAstNodeAsChild(1, ArtificialToken(" ", "whitespace"))
-  elif node.className == "commaSeparatedList":
-    insertSpaces = not (settings.omitSpaceAfterComma
-        and checkMaximumLengthOfArguments(node, settings.omitSpaceAfterCommaMaxLength, "comma"))
+    if node.className.endswith("OperatorNode"):
+      insertSpaces = (node.children[0].className != "empty")
 
-    if insertSpaces:
+      if insertSpaces and (node.className == "colonOperatorNode"):
+        insertSpaces = not (settings.omitSpaceAroundColon and checkMaximumLengthOfArguments(
+              node, settings.omitSpaceAroundColonMaxLength, "colonOperator"))
+
+      if insertSpaces:
+        node.insertNewAstNodeAsChild(2, ArtificialToken(" ", TokenKind.whitespace))
+        node.insertNewAstNodeAsChild(1, ArtificialToken(" ", TokenKind.whitespace))
+    elif node.className == "commaSeparatedList":
+      insertSpaces = not (settings.omitSpaceAfterComma
+          and checkMaximumLengthOfArguments(node, settings.omitSpaceAfterCommaMaxLength, "comma"))
+      if not insertSpaces: return False
       oldChildren = list(node.children)
 
       for i, child in enumerate(oldChildren[::-1]):
         if child.className == "comma":
           index = len(oldChildren) - i - 1
-          node.insertNewAstNodeAsChild(index + 1, ArtificialToken(" ", "whitespace"))
+          node.insertNewAstNodeAsChild(index + 1, ArtificialToken(" ", TokenKind.whitespace))
     else:
-      return
-  elif node.className in ["keyword", "semicolon"]:
-    node.appendNewAstNodeAsChild(ArtificialToken(" ", "whitespace"))
+      node.appendNewAstNodeAsChild(ArtificialToken(" ", TokenKind.whitespace))
+
+    return True
+
+
+
+def removeWhitespaces(ast: AstNode) -> None:
+  runFormattingPasses(ast, [WhitespaceRemovalPass()])
+
+
+
+def insertNewlinesBetweenStatements(ast: AstNode) -> None:
+  runFormattingPasses(ast, [NewlineInsertionPass()])
+
+
+
+def removeSuperfluousSemicolons(ast: AstNode) -> None:
+  runFormattingPasses(ast, [SemicolonRemovalPass()])
+
+
+
+def indent(ast: AstNode, settings: Settings) -> None:
+  runFormattingPasses(ast, [IndentationPass(settings)])
+
+
 
-  for child in node.children: insertWhitespaces(child, settings)
+def insertWhitespaces(ast: AstNode, settings: Settings) -> None:
+  runFormattingPasses(ast, [WhitespaceInsertionPass(settings)])
 
 
 
 def checkMaximumLengthOfArguments(node: AstNode, limit: int, excludeClassName: str) -> bool:
-  return all(len(str(child)) <= limit for child in node.children
+  return all(child.getLength() <= limit for child in node.children
       if child.className != excludeClassName)
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from __future__ import annotations
+import collections
+import contextlib
+import io
+from typing import Any, ContextManager, Dict, List, Optional, TextIO, Tuple
+
+from .formatter import formatDetachedStatement, TrailingWhitespaceRemover
+from .parser import (AstNode, checkIfFunctionsHaveEnd, computeBlockDepth, getBlockKeyword,
+    iterBuildBlockTree, parseStatement)
+from .settings import Settings
+from .stats import FormatStats
+from .tokenizer import Token, TokenKind
+
+
+
+class StatementMemo(object):
+  # Bounded LRU cache of the formatted code of statements, for codes that repeat the same
+  # statements many times (e.g., generated code). The key of a statement consists of its tokens
+  # (see getTokensKey) and of everything else that the formatting of the statement depends on:
+  # the settings, the block depth, the class names of the parent and the grandparent (see
+  # SemicolonRemovalPass), and whether a newline is appended (see NewlineInsertionPass).
+
+  maxNumberOfEntries = 65536
+  # removed by WhitespaceRemovalPass, so they do not change the formatted code
+  _ignoredTokenKinds = frozenset([TokenKind.whitespace, TokenKind.lineContinuationComment])
+
+  def __init__(self, maxNumberOfEntries: Optional[int] = None) -> None:
+    if maxNumberOfEntries is not None: self.maxNumberOfEntries = maxNumberOfEntries
+    self._entries: collections.OrderedDict[Tuple[Any, ...], str] = collections.OrderedDict()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, key: Tuple[Any, ...]) -> Optional[str]:
+    code = self._entries.get(key)
+    if code is not None: self._entries.move_to_end(key)
+    return code
+
+  def add(self, key: Tuple[Any, ...], code: str) -> None:
+    self._entries[key] = code
+    if len(self._entries) > self.maxNumberOfEntries: self._entries.popitem(last=False)
+
+  @staticmethod
+  def getTokensKey(tokens: List[Token]) -> Tuple[Any, ...]:
+    # the group depths of the other tokens follow from the kinds and the first group depth
+    keyTokens = [x for x in tokens if x.kind not in StatementMemo._ignoredTokenKinds]
+    return (tokens[0].groupDepth, tuple(x.kind for x in keyTokens),
+        tuple(x.code for x in keyTokens))
+
+  @staticmethod
+  def getSettingsKey(settings: Settings) -> Tuple[Any, ...]:
+    return tuple(sorted(vars(settings).items()))
+
+
+
+class MemoizedStatement(object):
+  # Statement as looked up in a StatementMemo by parseStatementsWithMemo: code is its formatted
+  # code if it was found, otherwise node is its parsed statement with parent and block depth.
+  # Both are None for statements that are equal to an earlier statement that was not found.
+  __slots__ = ("key", "appendNewline", "code", "node")
+
+  def __init__(self, key: Optional[Tuple[Any, ...]], appendNewline: bool,
+        code: Optional[str] = None, node: Optional[AstNode] = None) -> None:
+    # key is None if code is given, as it is not needed anymore
+    self.key = key
+    self.appendNewline = appendNewline
+    self.code = code
+    self.node = node
+
+
+
+def formatStatementsWithMemo(statements: List[List[Token]], settings: Settings,
+      memo: StatementMemo, stats: Optional[FormatStats] = None) -> str:
+  # Same as formatting the AST of the statements (see parseTokens and formatAst), but the
+  # formatted code of every statement is looked up in memo first, and only the statements that
+  # are not found are parsed (see parseStatementsWithMemo). If stats is given, the stages are
+  # measured, and the memo hits and misses and the AST nodes are counted.
+  stream = io.StringIO()
+  writeStatementsWithMemo(statements, settings, memo, stream, stats)
+  return stream.getvalue()
+
+
+
+def writeStatementsWithMemo(statements: List[List[Token]], settings: Settings,
+      memo: StatementMemo, stream: TextIO, stats: Optional[FormatStats] = None,
+      chunkSize: int = 256) -> None:
+  # same as formatStatementsWithMemo, but the code is written to stream in chunks of the code
+  # of chunkSize statements (see writeAst)
+  memoizedStatements = parseStatementsWithMemo(statements, settings, memo, stats)
+  writeMemoizedStatements(memoizedStatements, settings, memo, stream, stats, chunkSize)
+
+
+
+def parseStatementsWithMemo(statements: List[List[Token]], settings: Settings,
+      memo: StatementMemo, stats: Optional[FormatStats] = None) -> List[MemoizedStatement]:
+  # The block structure is built from statement nodes that only contain the keywords of their
+  # statements, which suffices for the block depths and for checkIfFunctionsHaveEnd. Then the
+  # formatted code of every statement is looked up in memo, and the statements that are not
+  # found are parsed. Looking up is part of the parse stage, as it replaces parsing.
+  def measure(stageName: str) -> ContextManager[None]:
+    return (stats.measure(stageName) if stats is not None else contextlib.nullcontext())
+
+  with measure("parse"):
+    keywordNodes = []
+
+    for statement in statements:
+      node = AstNode("statement")
+
+      for token in statement:
+        if token.kind == TokenKind.keyword: node.appendNewAstNodeAsChild(token)
+
+      keywordNodes.append(node)
+
+    ast = AstNode("statementSequence")
+
+    for node in iterBuildBlockTree(zip(keywordNodes, (getBlockKeyword(x) for x in statements))):
+      ast.appendChild(node)
+
+    functionsHaveEnd = checkIfFunctionsHaveEnd(ast)
+    if stats is not None: stats.numberOfAstNodes += sum(1 for _ in ast.iterPreOrder())
+
+  with measure("computeBlockDepth"):
+    computeBlockDepth(ast, functionsHaveEnd or False, settings)
+
+  with measure("parse"):
+    settingsKey = StatementMemo.getSettingsKey(settings)
+    memoizedStatements = []
+    # keys of the statements that were not found
+    missedKeys = set()
+    # see SessionStatement
+    isNewlineOnly = [[x.kind for x in statement if x.kind not in
+        [TokenKind.whitespace, TokenKind.lineContinuationComment]] == [TokenKind.newline]
+        for statement in statements]
+
+    for i, (statement, node) in enumerate(zip(statements, keywordNodes)):
+      appendNewline = ((i + 1 < len(statements)) and (not isNewlineOnly[i + 1])
+          and all(x.kind != TokenKind.newline for x in statement))
+      parent = node.parent
+      assert parent is not None
+      key = (StatementMemo.getTokensKey(statement), settingsKey, node.blockDepth,
+          parent.className, (parent.parent.className if parent.parent is not None else None),
+          appendNewline)
+      code = memo.get(key)
+
+      if code is not None:
+        memoizedStatements.append(MemoizedStatement(None, appendNewline, code=code))
+        if stats is not None: stats.numberOfMemoHits += 1
+      elif key in missedKeys:
+        memoizedStatements.append(MemoizedStatement(key, appendNewline))
+        if stats is not None: stats.numberOfMemoHits += 1
+      else:
+        statementNode = parseStatement(statement)
+        statementNode.parent = parent
+        statementNode.blockDepth = node.blockDepth
+        missedKeys.add(key)
+        memoizedStatements.append(MemoizedStatement(key, appendNewline, node=statementNode))
+
+        if stats is not None:
+          stats.numberOfMemoMisses += 1
+          # the statement nodes in the block structure are replaced by the parsed ones
+          stats.numberOfAstNodes += (sum(1 for _ in statementNode.iterPreOrder())
+              - len(node.children) - 1)
+
+      if (stats is not None) and (node.blockDepth is not None):
+        stats.maxBlockDepth = max(stats.maxBlockDepth, node.blockDepth)
+
+  return memoizedStatements
+
+
+
+def writeMemoizedStatements(memoizedStatements: List[MemoizedStatement], settings: Settings,
+      memo: StatementMemo, stream: TextIO, stats: Optional[FormatStats] = None,
+      chunkSize: int = 256) -> None:
+  # formats the statements of parseStatementsWithMemo that were not found in memo, adds them to
+  # memo, and writes the code of all statements to stream (see writeStatementsWithMemo)
+  with (stats.measure("format") if stats is not None else contextlib.nullcontext()):
+    trailingWhitespaceRemover = TrailingWhitespaceRemover()
+    codeParts: List[str] = []
+    # independent of memo, from which the codes might already have been evicted
+    missedCodes: Dict[Tuple[Any, ...], str] = {}
+
+    for memoizedStatement in memoizedStatements:
+      code = memoizedStatement.code
+
+      if code is None:
+        key = memoizedStatement.key
+        assert key is not None
+
+        if memoizedStatement.node is not None:
+          code = formatDetachedStatement(memoizedStatement.node, settings,
+              memoizedStatement.appendNewline, (stats.passTimes if stats is not None else None))
+          memo.add(key, code)
+          missedCodes[key] = code
+        else:
+          code = missedCodes[key]
+
+      codeParts.append(trailingWhitespaceRemover.process(code))
+
+      if len(codeParts) >= chunkSize:
+        stream.write("".join(codeParts))
+        codeParts.clear()
+
+    if settings.newlineAtEndOfFile: codeParts.append("\n")
+    stream.write("".join(codeParts))
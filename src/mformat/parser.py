@@ -7,10 +7,11 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 from __future__ import annotations
-from typing import cast, List, Optional, Tuple, Union
+from typing import cast, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import bisect
 
 from .settings import Settings
-from .tokenizer import Token
+from .tokenizer import closingTokenKinds, operatorTokenKinds, Token, TokenKind
 
 # from https://www.mathworks.com/help/matlab/matlab_prog/operator-precedence.html
 operatorPrecedence = {
@@ -50,31 +51,95 @@ class AstNode(object):
     self.parent = parent
     self.children: List[AstNode] = []
     self.blockDepth: Optional[int] = None
+    # index of the node in parent.children, checked before use as children might have
+    # been modified directly
+    self._indexInParent = 0
+    # cached length of str(self), None if unknown; if it is known, then the lengths of all
+    # descendants are known as well
+    self._length: Optional[int] = None
 
   def appendNewAstNodeAsChild(self, tokenOrClassName: Union[str, Token]) -> AstNode:
-    child = AstNode(tokenOrClassName, self)
-    self.children.append(child)
-    return child
+    return self.appendChild(AstNode(tokenOrClassName))
 
   def appendChild(self, node: AstNode) -> AstNode:
     node.parent = self
+    node._indexInParent = len(self.children)
     self.children.append(node)
+    self.invalidateLength()
     return node
 
   def insertNewAstNodeAsChild(self, index: int, tokenOrClassName: Union[str, Token]) -> AstNode:
-    child = AstNode(tokenOrClassName, self)
-    self.children.insert(index, child)
-    return child
+    return self.insertChild(index, AstNode(tokenOrClassName))
 
   def insertChild(self, index: int, node: AstNode) -> AstNode:
     node.parent = self
     self.children.insert(index, node)
+    self._updateIndicesInParent(index)
+    self.invalidateLength()
     return node
 
   def remove(self) -> None:
     assert self.parent is not None
-    parentChildren = self.parent.children
-    del parentChildren[parentChildren.index(self)]
+    index = self.getIndexInParent()
+    del self.parent.children[index]
+    self.parent._updateIndicesInParent(index)
+    self.parent.invalidateLength()
+
+  def getIndexInParent(self) -> int:
+    assert self.parent is not None
+    children = self.parent.children
+    index = self._indexInParent
+
+    if (index >= len(children)) or (children[index] is not self):
+      self.parent._updateIndicesInParent(0)
+      index = self._indexInParent
+
+    return index
+
+  def _updateIndicesInParent(self, startIndex: int) -> None:
+    children = self.children
+    for i in range(startIndex, len(children)): children[i]._indexInParent = i
+
+  def getLength(self) -> int:
+    if self._length is not None: return self._length
+    nodeStack = [self]
+
+    # post-order traversal, a node is popped the second time after all its children
+    while len(nodeStack) > 0:
+      node = nodeStack[-1]
+
+      if node._length is not None:
+        nodeStack.pop()
+        continue
+
+      unknownChildren = [x for x in node.children if x._length is None]
+
+      if len(unknownChildren) > 0:
+        nodeStack.extend(unknownChildren)
+      else:
+        node._length = ((len(node.token.code) if node.token is not None else 0)
+            + sum(x._length for x in node.children))
+        nodeStack.pop()
+
+    assert self._length is not None
+    return self._length
+
+  def invalidateLength(self) -> None:
+    node: Optional[AstNode] = self
+
+    while (node is not None) and (node._length is not None):
+      node._length = None
+      node = node.parent
+
+  def getDepth(self) -> int:
+    depth = 0
+    node = self
+
+    while node.parent is not None:
+      node = node.parent
+      depth += 1
+
+    return depth
 
   def goToAncestor(self, suffix: str) -> Optional[AstNode]:
     node = self
@@ -108,7 +173,7 @@ class AstNode(object):
     while node.parent is not None:
       prevNode = node
       node = node.parent
-      nodeIndex = node.children.index(prevNode)
+      nodeIndex = prevNode.getIndexInParent()
       childIndexRange = (range(nodeIndex - 1, -1, -1) if reverse
           else range(nodeIndex + 1, len(node.children)))
 
@@ -131,41 +196,61 @@ class AstNode(object):
   def isDescendant(self, other: AstNode) -> bool:
     return other.isAncestor(self)
 
-  def _getHierarchy(self) -> List[Tuple[AstNode, int]]:
-    hierarchy = []
-    node = self
+  def copy(self) -> AstNode:
+    # structural copy, tokens are shared as the formatter does not modify them
+    rootCopy = AstNode(self.className)
+    nodePairs = [(self, rootCopy)]
 
-    while node.parent is not None:
-      prevNode = node
-      node = node.parent
-      childIndex = node.children.index(prevNode)
-      hierarchy.append((node, childIndex))
+    while len(nodePairs) > 0:
+      node, nodeCopy = nodePairs.pop()
+      nodeCopy.token = node.token
+      nodeCopy.blockDepth = node.blockDepth
+      nodeCopy._length = node._length
+
+      for child in node.children:
+        childCopy = AstNode(child.className, nodeCopy)
+        childCopy._indexInParent = len(nodeCopy.children)
+        nodeCopy.children.append(childCopy)
+        nodePairs.append((child, childCopy))
 
-    hierarchy.reverse()
-    return hierarchy
+    return rootCopy
+
+  def iterPreOrder(self) -> Iterator[AstNode]:
+    nodeStack = [self]
+
+    while len(nodeStack) > 0:
+      node = nodeStack.pop()
+      yield node
+      nodeStack.extend(node.children[::-1])
+
+  def getRoot(self) -> AstNode:
+    node = self
+    while node.parent is not None: node = node.parent
+    return node
 
   def __lt__(self, other: AstNode) -> bool:
     if (self == other) or ((self.parent is None) and (other.parent is None)): return False
 
-    selfHierarchy = self._getHierarchy()
-    otherHierarchy = other._getHierarchy()
-
     if self.parent is None:
-      assert len(otherHierarchy) >= 1
-      return (otherHierarchy[0][0] == self)
+      return (other.getRoot() == self)
     elif other.parent is None:
-      assert len(selfHierarchy) >= 1
-      return (selfHierarchy[0][0] == other)
+      return (self.getRoot() == other)
 
-    assert len(selfHierarchy) >= 1
-    assert len(otherHierarchy) >= 1
-    if selfHierarchy[0][0] != otherHierarchy[0][0]: return False
+    selfDepth = self.getDepth()
+    otherDepth = other.getDepth()
+    selfAncestor = self
+    otherAncestor = other
 
-    for i in range(min(len(selfHierarchy), len(otherHierarchy))):
-      if selfHierarchy[i][1] != otherHierarchy[i][1]:
-        return selfHierarchy[i][1] < otherHierarchy[i][1]
+    for i in range(selfDepth - otherDepth): selfAncestor = cast(AstNode, selfAncestor.parent)
+    for i in range(otherDepth - selfDepth): otherAncestor = cast(AstNode, otherAncestor.parent)
+    if selfAncestor == otherAncestor: return selfDepth < otherDepth
 
-    return len(selfHierarchy) < len(otherHierarchy)
+    while selfAncestor.parent != otherAncestor.parent:
+      selfAncestor = cast(AstNode, selfAncestor.parent)
+      otherAncestor = cast(AstNode, otherAncestor.parent)
+
+    if selfAncestor.parent is None: return False
+    return selfAncestor.getIndexInParent() < otherAncestor.getIndexInParent()
 
   def __le__(self, other: AstNode) -> bool:
     return (self == other) or (self < other)
@@ -180,13 +265,11 @@ class AstNode(object):
     return result
 
   def __str__(self) -> str:
-    code = (self.token.code if self.token is not None else "")
-    code += "".join(str(x) for x in self.children)
-    return code
+    return "".join(x.token.code for x in self.iterPreOrder() if x.token is not None)
 
 
 
-def parseTokens(tokens: List[Token], settings: Settings) -> AstNode:
+def parseTokens(tokens: Iterable[Token], settings: Settings) -> AstNode:
   statements = splitIntoStatements(tokens)
   ast = parseStatements(statements)
   functionsHaveEnd = checkIfFunctionsHaveEnd(ast)
@@ -196,19 +279,61 @@ def parseTokens(tokens: List[Token], settings: Settings) -> AstNode:
 
 
 
-def splitIntoStatements(tokens: List[Token]) -> List[List[Token]]:
-  statements: List[List[Token]] = []
+def iterParseTokens(tokens: Iterable[Token], settings: Settings) -> Iterator[AstNode]:
+  # Parses the statements of tokens one after the other and yields their statement nodes as soon
+  # as their block depths are known (see BlockContextBuilder), so that the memory needed does not
+  # grow with the length of the code. This is not possible for a function in the first function,
+  # as it is only known at the end of the first function (or of the code) whether it is nested
+  # or local; the statements from there on are held back until then.
+  builder = BlockContextBuilder(settings)
+  # held back statements with their block keywords
+  pendingStatements: List[Tuple[List[Token], Optional[str]]] = []
+  numberOfOpenBlocks = 0
+
+  for statement in iterStatements(tokens):
+    keyword = getBlockKeyword(statement)
+
+    if (len(pendingStatements) == 0) and (not builder.dependsOnFunctionsHaveEnd(keyword)):
+      yield builder.add(parseStatement(statement), keyword)
+      continue
+
+    if len(pendingStatements) == 0: numberOfOpenBlocks = builder.getNumberOfOpenBlocks()
+    pendingStatements.append((statement, keyword))
+
+    if keyword in blockOpeningKeywords:
+      numberOfOpenBlocks += 1
+    elif keyword == "end":
+      numberOfOpenBlocks -= 1
+
+    if numberOfOpenBlocks == builder.firstFunctionLevel:
+      # end of the first function
+      builder.setFunctionsHaveEnd(True)
+      yield from (builder.add(parseStatement(x), y) for x, y in pendingStatements)
+      pendingStatements.clear()
+
+  builder.setFunctionsHaveEnd(False)
+  yield from (builder.add(parseStatement(x), y) for x, y in pendingStatements)
+
+
+
+def splitIntoStatements(tokens: Iterable[Token]) -> List[List[Token]]:
+  return list(iterStatements(tokens))
+
+
+
+def iterStatements(tokens: Iterable[Token],
+      prevToken: Optional[Token] = None) -> Iterator[List[Token]]:
+  # prevToken is the token before tokens, if tokens do not start at the beginning of the code
   curStatement = []
-  prevToken = None
 
   for token in tokens:
     curStatement.append(token)
 
-    if ((token.className == "semicolon")
-          or ((token.className == "comma") and (token.groupDepth == 0))
-          or ((token.className == "newline")
+    if ((token.kind == TokenKind.semicolon)
+          or ((token.kind == TokenKind.comma) and (token.groupDepth == 0))
+          or ((token.kind == TokenKind.newline)
             and (prevToken is not None)
-            and (prevToken.className != "lineContinuationComment"))):
+            and (prevToken.kind != TokenKind.lineContinuationComment))):
       # to join newlines with last statement
       #if ((token.className == "newline") and (len(curStatement) == 1)
       #      and (len(statements) > 0)):
@@ -216,43 +341,72 @@ def splitIntoStatements(tokens: List[Token]) -> List[List[Token]]:
       #else:
       #  statements.append(curStatement)
 
-      statements.append(curStatement)
+      yield curStatement
       curStatement = []
 
     prevToken = token
 
-  if len(curStatement) > 0: statements.append(curStatement)
+  if len(curStatement) > 0: yield curStatement
 
-  return statements
 
 
-
-def parseStatements(statements: List[List[Token]]) -> AstNode:
+def parseStatements(statements: Iterable[List[Token]]) -> AstNode:
   ast = AstNode("statementSequence")
-  curNode = ast
+  for node in iterParseStatements(statements): ast.appendChild(node)
+  return ast
+
+
+
+def iterParseStatements(statements: Iterable[List[Token]]) -> Iterator[AstNode]:
+  return iterBuildBlockTree((parseStatement(x), getBlockKeyword(x)) for x in statements)
 
-  for statement in statements:
-    firstNonWhitespaceToken = None
 
-    for token in statement:
-      if token.className != "whitespace":
-        firstNonWhitespaceToken = token
-        break
 
-    statementAstNode = parseStatement(statement)
-    keyword: str
+def getFirstNonWhitespaceToken(statement: List[Token]) -> Optional[Token]:
+  for token in statement:
+    if token.kind != TokenKind.whitespace: return token
 
-    if ((firstNonWhitespaceToken is not None)
-          and (firstNonWhitespaceToken.className == "keyword")
-          and ((keyword := cast(str, firstNonWhitespaceToken.value)) in
-            ["case", "catch", "classdef", "else", "elseif", "end", "for",
-            "function", "if", "otherwise", "parfor", "switch", "try", "while"])):
-      if keyword in ["classdef", "for", "function", "if", "parfor", "switch", "try", "while"]:
+  return None
+
+
+
+blockOpeningKeywords = frozenset(["classdef", "for", "function", "if", "parfor", "switch", "try",
+    "while"])
+blockContinuingKeywords = frozenset(["case", "catch", "else", "elseif", "otherwise"])
+
+
+
+def getBlockKeyword(statement: List[Token]) -> Optional[str]:
+  # returns the keyword that starts the statement if it opens, continues or closes a block
+  firstNonWhitespaceToken = getFirstNonWhitespaceToken(statement)
+  keyword: str
+
+  if ((firstNonWhitespaceToken is not None)
+        and (firstNonWhitespaceToken.kind == TokenKind.keyword)
+        and ((keyword := cast(str, firstNonWhitespaceToken.value)) in
+          ["case", "catch", "classdef", "else", "elseif", "end", "for",
+          "function", "if", "otherwise", "parfor", "switch", "try", "while"])):
+    return keyword
+  else:
+    return None
+
+
+
+def iterBuildBlockTree(
+      statementNodes: Iterable[Tuple[AstNode, Optional[str]]]) -> Iterator[AstNode]:
+  # arranges statement nodes and their block keywords (see getBlockKeyword) in blocks and
+  # yields the top-level nodes
+  ast = AstNode("statementSequence")
+  curNode = ast
+
+  for statementAstNode, keyword in statementNodes:
+    if keyword is not None:
+      if keyword in blockOpeningKeywords:
         curNode = curNode.appendNewAstNodeAsChild(f"{keyword}Block")
         curNode = curNode.appendNewAstNodeAsChild(keyword)
         curNode.appendChild(statementAstNode)
         curNode = curNode.appendNewAstNodeAsChild("statementSequence")
-      elif keyword in ["case", "catch", "else", "elseif", "otherwise"]:
+      elif keyword in blockContinuingKeywords:
         ancestor = curNode.goToAncestor("Block")
         assert ancestor is not None
         curNode = ancestor
@@ -269,10 +423,108 @@ def parseStatements(statements: List[List[Token]]) -> AstNode:
       else:
         raise ValueError(f"unknown keyword '{keyword}'")
     else:
-      statementAstNode.parent = curNode
-      curNode.children.append(statementAstNode)
+      curNode.appendChild(statementAstNode)
+
+    if curNode is ast:
+      yield from ast.children
+      ast.children.clear()
+
+  yield from ast.children
+
+
+
+class BlockContextBuilder(object):
+  # Same as iterBuildBlockTree followed by computeBlockDepth, but for one statement node after
+  # the other: every statement node gets the parent that it would have in the tree (with the
+  # same ancestors) and its block depth, but it is not added to the children of its parent, and
+  # only the open blocks are kept. The block depths in a function in the first function depend
+  # on whether functions have end, which has to be set before (see dependsOnFunctionsHaveEnd).
+
+  def __init__(self, settings: Settings) -> None:
+    # None if not known yet
+    self.functionsHaveEnd: Optional[bool] = None
+    # number of open blocks outside of the first function block, None if it has not started
+    self.firstFunctionLevel: Optional[int] = None
+    self._state = BlockDepthState(False, settings)
+    # open statement sequences and blocks with their block depths and function depths; the
+    # block of the i-th sequence is the (i - 1)-th block
+    self._sequences: List[Tuple[AstNode, int, int]] = [(AstNode("statementSequence"), 0, 0)]
+    self._blocks: List[Tuple[AstNode, int, int]] = []
+
+  def getNumberOfOpenBlocks(self) -> int:
+    return len(self._blocks)
+
+  def dependsOnFunctionsHaveEnd(self, keyword: Optional[str]) -> bool:
+    # whether the block depth of a statement with the block keyword would be computed with an
+    # unknown functionsHaveEnd
+    return ((self.functionsHaveEnd is None) and (keyword == "function")
+        and (self.firstFunctionLevel is not None))
+
+  def findFunctionsHaveEnd(self, keywords: Iterable[Optional[str]]) -> bool:
+    # determines whether functions have end from the block keywords of the statements from the
+    # next one on, which is only needed if dependsOnFunctionsHaveEnd (the first function has
+    # end if and only if it is closed)
+    numberOfOpenBlocks = len(self._blocks)
+
+    for keyword in keywords:
+      if keyword in blockOpeningKeywords:
+        numberOfOpenBlocks += 1
+      elif keyword == "end":
+        numberOfOpenBlocks -= 1
+        if numberOfOpenBlocks == self.firstFunctionLevel: return True
 
-  return ast
+    return False
+
+  def setFunctionsHaveEnd(self, functionsHaveEnd: bool) -> None:
+    if self.functionsHaveEnd is not None: return
+    self.functionsHaveEnd = functionsHaveEnd
+    self._state.functionsHaveEnd = functionsHaveEnd
+
+  def add(self, statementNode: AstNode, keyword: Optional[str]) -> AstNode:
+    # keyword is the block keyword of the statement (see getBlockKeyword)
+    sequenceNode, blockDepth, functionDepth = self._sequences[-1]
+
+    if keyword is None:
+      statementNode.parent = sequenceNode
+      statementNode.blockDepth = blockDepth
+    elif keyword in blockOpeningKeywords:
+      if (keyword == "function") and (self.firstFunctionLevel is None):
+        self.firstFunctionLevel = len(self._blocks)
+
+      self._blocks.append((AstNode(f"{keyword}Block", sequenceNode), blockDepth, functionDepth))
+      self._enterBlock(keyword, statementNode)
+    elif keyword in blockContinuingKeywords:
+      assert len(self._blocks) > 0
+      self._sequences.pop()
+      self._enterBlock(keyword, statementNode)
+    elif keyword == "end":
+      assert len(self._blocks) > 0
+      self._sequences.pop()
+      blockNode, blockDepth, functionDepth = self._blocks.pop()
+      statementNode.parent = blockNode
+      statementNode.blockDepth = blockDepth
+      self._state.enterChildOfBlock("statement", blockNode.className, blockDepth, functionDepth)
+
+      if ((blockNode.className == "functionBlock")
+            and (len(self._blocks) == self.firstFunctionLevel)):
+        self.setFunctionsHaveEnd(True)
+    else:
+      raise ValueError(f"unknown keyword '{keyword}'")
+
+    return statementNode
+
+  def _enterBlock(self, keyword: str, statementNode: AstNode) -> None:
+    # adds the node of keyword with statementNode and a new statement sequence to the last block
+    blockNode, blockDepth, functionDepth = self._blocks[-1]
+    keywordNode = AstNode(keyword, blockNode)
+    keywordNode.blockDepth = blockDepth
+    statementBlockDepth, childBlockDepth, childFunctionDepth = self._state.enterChildOfBlock(
+        keyword, blockNode.className, blockDepth, functionDepth)
+    statementNode.parent = keywordNode
+    statementNode.blockDepth = statementBlockDepth
+    sequenceNode = AstNode("statementSequence", keywordNode)
+    sequenceNode.blockDepth = childBlockDepth
+    self._sequences.append((sequenceNode, childBlockDepth, childFunctionDepth))
 
 
 
@@ -285,7 +537,7 @@ def parseStatement(statement: List[Token]) -> AstNode:
   relevantTokenIndexStart = None
 
   for i, token in enumerate(statement):
-    if token.isRelevant() and (token.className != "keyword"):
+    if token.isRelevant() and (token.kind != TokenKind.keyword):
       relevantTokenIndexStart = i
       break
 
@@ -296,7 +548,7 @@ def parseStatement(statement: List[Token]) -> AstNode:
   relevantTokensIndexEnd = len(statement)
 
   for i, token in enumerate(statement[::-1]):
-    if token.isRelevant() and (token.className != "semicolon"):
+    if token.isRelevant() and (token.kind != TokenKind.semicolon):
       relevantTokensIndexEnd = len(statement) - i
       break
 
@@ -315,139 +567,210 @@ def parseStatement(statement: List[Token]) -> AstNode:
 
 
 def parseStatementFragment(tokens: List[Token]) -> AstNode:
-  if len(tokens) == 0: return AstNode("empty")
-  groupDepthOffset = tokens[0].groupDepth
+  return StatementFragmentParser(tokens).parse(0, len(tokens))
+
+
+
+class StatementFragmentParser(object):
+  # The fragment parser works on index ranges [start, end) of one shared token list. For every
+  # group depth, it stores the sorted indices of commas, operators and relevant tokens, so
+  # that the tokens at the top-level group depth of a range can be found by binary search
+  # instead of by scanning and slicing the range at every recursion level.
 
-  node = divideAndConquerParseStatementFragmentWithClassName(tokens, "assignmentOperator")
-  if node is not None: return node
+  _groupingClassNamesWithIdentifier = {
+        "ParenthesisWithIdentifier" : ("functionCall", "calledFunction", "functionArguments"),
+        "BraceWithIdentifier" : ("cellReference", "referencedCell", "cellReferenceArguments"),
+      }
+
+  _groupingClassNamesWithoutIdentifier = {
+        "ParenthesisWithoutIdentifier" : ("parenthesisGroup", "groupContents"),
+        "BracketWithoutIdentifier" : ("bracketGroup", "groupContents"),
+        "BraceWithoutIdentifier" : ("braceGroup", "groupContents"),
+      }
 
-  if any((x.className == "comma") and (x.groupDepth == groupDepthOffset) for x in tokens):
-    node = AstNode("commaSeparatedList")
-    lastTopLevelCommaTokenIndex = -1
+  def __init__(self, tokens: List[Token]) -> None:
+    self._tokens = tokens
+    self._assignmentOperatorIndices: List[int] = []
+    self._commaIndices: Dict[Optional[int], List[int]] = {}
+    self._operatorIndices: Dict[Optional[int], List[int]] = {}
+    self._relevantTokenIndices: Dict[Optional[int], List[int]] = {}
 
     for i, token in enumerate(tokens):
-      if (token.className == "comma") and (token.groupDepth == groupDepthOffset):
-        node.appendChild(parseStatementFragment(tokens[lastTopLevelCommaTokenIndex+1:i]))
-        node.appendNewAstNodeAsChild(token)
-        lastTopLevelCommaTokenIndex = i
+      if token.kind == TokenKind.assignmentOperator: self._assignmentOperatorIndices.append(i)
 
-    if lastTopLevelCommaTokenIndex < len(tokens) - 1:
-      node.appendChild(parseStatementFragment(tokens[lastTopLevelCommaTokenIndex+1:]))
+      if token.kind == TokenKind.comma:
+        self._commaIndices.setdefault(token.groupDepth, []).append(i)
 
-    return node
+      if token.kind in operatorTokenKinds:
+        self._operatorIndices.setdefault(token.groupDepth, []).append(i)
 
-  topLevelOperatorTokenIndices = [i for i, token in enumerate(tokens)
-      if (token.groupDepth == groupDepthOffset) and token.className.endswith("Operator")]
+      if token.isRelevant(): self._relevantTokenIndices.setdefault(token.groupDepth, []).append(i)
 
-  if len(topLevelOperatorTokenIndices) > 0:
-    i = max(topLevelOperatorTokenIndices, key=lambda i: operatorPrecedence[tokens[i].className])
-    return divideAndConquerParseStatementFragment(tokens, i)
+  def parse(self, start: int, end: int) -> AstNode:
+    if start == end: return AstNode("empty")
+    tokens = self._tokens
+    groupDepthOffset = tokens[start].groupDepth
 
-  relevantTopLevelTokenIndices = [i for i, token in enumerate(tokens)
-      if (token.groupDepth == groupDepthOffset) and token.isRelevant()]
+    assignmentOperatorIndicesStart = bisect.bisect_left(self._assignmentOperatorIndices, start)
 
-  #while (len(relevantTopLevelTokenIndices) > 0) and (
-  #      tokens[relevantTopLevelTokenIndices[-1]].className in ["comma", "newline", "semicolon"]):
-  #  relevantTopLevelTokenIndices.pop()
+    if ((assignmentOperatorIndicesStart < len(self._assignmentOperatorIndices))
+          and (self._assignmentOperatorIndices[assignmentOperatorIndicesStart] < end)):
+      i = self._assignmentOperatorIndices[assignmentOperatorIndicesStart]
+      node = AstNode(f"{tokens[i].className}Node")
+      node.appendChild(self.parse(start, i))
+      node.appendNewAstNodeAsChild(tokens[i])
+      node.appendChild(self.parse(i + 1, end))
+      return node
 
-  if len(relevantTopLevelTokenIndices) == 0:
-    node = AstNode("irrelevantTokens")
-    for token in tokens: node.appendNewAstNodeAsChild(token)
-    return node
-  elif len(relevantTopLevelTokenIndices) == 1:
-    node = AstNode("relevantToken")
-    relevantTokenIndex = relevantTopLevelTokenIndices[0]
-    irrelevantTokensBeforeNode = node.appendNewAstNodeAsChild("irrelevantTokens")
-    node.appendNewAstNodeAsChild(tokens[relevantTokenIndex])
-    irrelevantTokensAfterNode = node.appendNewAstNodeAsChild("irrelevantTokens")
+    topLevelCommaTokenIndices = self._getIndicesInRange(
+        self._commaIndices.get(groupDepthOffset, []), start, end)
 
-    for token in tokens[:relevantTokenIndex]:
-      irrelevantTokensBeforeNode.appendNewAstNodeAsChild(token)
+    if len(topLevelCommaTokenIndices) > 0:
+      node = AstNode("commaSeparatedList")
+      lastTopLevelCommaTokenIndex = start - 1
 
-    for token in tokens[relevantTokenIndex+1:]:
-      irrelevantTokensAfterNode.appendNewAstNodeAsChild(token)
+      for i in topLevelCommaTokenIndices:
+        node.appendChild(self.parse(lastTopLevelCommaTokenIndex + 1, i))
+        node.appendNewAstNodeAsChild(tokens[i])
+        lastTopLevelCommaTokenIndex = i
 
-    return node
+      if lastTopLevelCommaTokenIndex < end - 1:
+        node.appendChild(self.parse(lastTopLevelCommaTokenIndex + 1, end))
 
-  lastRelevantTopLevelToken = tokens[relevantTopLevelTokenIndices[-1]]
-  secondToLastRelevantTopLevelToken = tokens[relevantTopLevelTokenIndices[-2]]
+      return node
 
-  groupingClassNamesWithIdentifier = {
-        "ParenthesisWithIdentifier" : ("functionCall", "calledFunction", "functionArguments"),
-        "BraceWithIdentifier" : ("cellReference", "referencedCell", "cellReferenceArguments"),
-      }
+    topLevelOperatorTokenIndices = self._getIndicesInRange(
+        self._operatorIndices.get(groupDepthOffset, []), start, end)
 
-  groupingClassNamesWithoutIdentifier = {
-        "ParenthesisWithoutIdentifier" : ("parenthesisGroup", "groupContents"),
-        "BracketWithoutIdentifier" : ("bracketGroup", "groupContents"),
-        "BraceWithoutIdentifier" : ("braceGroup", "groupContents"),
-      }
+    if len(topLevelOperatorTokenIndices) > 0:
+      return self._parseOperators(start, end, topLevelOperatorTokenIndices)
+
+    relevantTokenIndices = self._relevantTokenIndices.get(groupDepthOffset, [])
+    relevantTopLevelTokenIndicesEnd = bisect.bisect_left(relevantTokenIndices, end)
+    numberOfRelevantTopLevelTokens = (relevantTopLevelTokenIndicesEnd
+        - bisect.bisect_left(relevantTokenIndices, start))
+
+    if numberOfRelevantTopLevelTokens == 0:
+      node = AstNode("irrelevantTokens")
+      for token in tokens[start:end]: node.appendNewAstNodeAsChild(token)
+      return node
+
+    lastRelevantTopLevelTokenIndex = relevantTokenIndices[relevantTopLevelTokenIndicesEnd - 1]
+
+    if numberOfRelevantTopLevelTokens == 1:
+      node = AstNode("relevantToken")
+      irrelevantTokensBeforeNode = node.appendNewAstNodeAsChild("irrelevantTokens")
+      node.appendNewAstNodeAsChild(tokens[lastRelevantTopLevelTokenIndex])
+      irrelevantTokensAfterNode = node.appendNewAstNodeAsChild("irrelevantTokens")
+
+      for token in tokens[start:lastRelevantTopLevelTokenIndex]:
+        irrelevantTokensBeforeNode.appendNewAstNodeAsChild(token)
 
-  if (((lastRelevantTopLevelToken.className == "identifier")
-          and (secondToLastRelevantTopLevelToken.className == "period"))
-        or (lastRelevantTopLevelToken.className.startswith("closing")
+      for token in tokens[lastRelevantTopLevelTokenIndex+1:end]:
+        irrelevantTokensAfterNode.appendNewAstNodeAsChild(token)
+
+      return node
+
+    secondToLastRelevantTopLevelTokenIndex = (
+        relevantTokenIndices[relevantTopLevelTokenIndicesEnd - 2])
+    lastRelevantTopLevelToken = tokens[lastRelevantTopLevelTokenIndex]
+    secondToLastRelevantTopLevelToken = tokens[secondToLastRelevantTopLevelTokenIndex]
+
+    if (((lastRelevantTopLevelToken.kind == TokenKind.identifier)
+          and (secondToLastRelevantTopLevelToken.kind == TokenKind.period))
+        or ((lastRelevantTopLevelToken.kind in closingTokenKinds)
           and lastRelevantTopLevelToken.className.endswith("WithIdentifier"))):
-    if lastRelevantTopLevelToken.className == "identifier":
-      classNames = ("structReference", "referencedStruct", "structReferenceArguments")
-    else:
+      if lastRelevantTopLevelToken.kind == TokenKind.identifier:
+        classNames = ("structReference", "referencedStruct", "structReferenceArguments")
+      else:
+        groupingType = lastRelevantTopLevelToken.className[7:]
+        classNames = self._groupingClassNamesWithIdentifier[groupingType]
+        assert (secondToLastRelevantTopLevelToken.className == f"opening{groupingType}")
+
+      node = AstNode(classNames[0])
+      node.appendNewAstNodeAsChild(classNames[1]).appendChild(
+          self.parse(start, secondToLastRelevantTopLevelTokenIndex))
+      node.appendNewAstNodeAsChild(secondToLastRelevantTopLevelToken)
+      node.appendNewAstNodeAsChild(classNames[2]).appendChild(self.parse(
+          secondToLastRelevantTopLevelTokenIndex + 1, lastRelevantTopLevelTokenIndex))
+      node.appendNewAstNodeAsChild(lastRelevantTopLevelToken)
+      irrelevantTokens = node.appendNewAstNodeAsChild("irrelevantTokens")
+
+      for token in tokens[lastRelevantTopLevelTokenIndex+1:end]:
+        irrelevantTokens.appendNewAstNodeAsChild(token)
+
+      return node
+    elif lastRelevantTopLevelToken.kind in closingTokenKinds:
       groupingType = lastRelevantTopLevelToken.className[7:]
-      classNames = groupingClassNamesWithIdentifier[groupingType]
+      groupingClassName = self._groupingClassNamesWithoutIdentifier[groupingType]
+      assert numberOfRelevantTopLevelTokens == 2
       assert (secondToLastRelevantTopLevelToken.className == f"opening{groupingType}")
+      node = AstNode(groupingClassName[0])
+      irrelevantTokensBeforeNode = node.appendNewAstNodeAsChild("irrelevantTokens")
+      node.appendNewAstNodeAsChild(secondToLastRelevantTopLevelToken)
+      node.appendNewAstNodeAsChild(groupingClassName[1]).appendChild(self.parse(
+          secondToLastRelevantTopLevelTokenIndex + 1, lastRelevantTopLevelTokenIndex))
+      node.appendNewAstNodeAsChild(lastRelevantTopLevelToken)
+      irrelevantTokensAfterNode = node.appendNewAstNodeAsChild("irrelevantTokens")
 
-    node = AstNode(classNames[0])
-    node.appendNewAstNodeAsChild(classNames[1]).appendChild(parseStatementFragment(
-        tokens[:relevantTopLevelTokenIndices[-2]]))
-    node.appendNewAstNodeAsChild(secondToLastRelevantTopLevelToken)
-    node.appendNewAstNodeAsChild(classNames[2]).appendChild(parseStatementFragment(
-        tokens[relevantTopLevelTokenIndices[-2]+1:relevantTopLevelTokenIndices[-1]]))
-    node.appendNewAstNodeAsChild(lastRelevantTopLevelToken)
-    irrelevantTokens = node.appendNewAstNodeAsChild("irrelevantTokens")
+      for token in tokens[start:secondToLastRelevantTopLevelTokenIndex]:
+        irrelevantTokensBeforeNode.appendNewAstNodeAsChild(token)
 
-    for token in tokens[relevantTopLevelTokenIndices[-1]+1:]:
-      irrelevantTokens.appendNewAstNodeAsChild(token)
+      for token in tokens[lastRelevantTopLevelTokenIndex+1:end]:
+        irrelevantTokensAfterNode.appendNewAstNodeAsChild(token)
 
-    return node
-  elif lastRelevantTopLevelToken.className.startswith("closing"):
-    groupingType = lastRelevantTopLevelToken.className[7:]
-    groupingClassName = groupingClassNamesWithoutIdentifier[groupingType]
-    assert len(relevantTopLevelTokenIndices) == 2
-    assert (secondToLastRelevantTopLevelToken.className == f"opening{groupingType}")
-    node = AstNode(groupingClassName[0])
-    irrelevantTokensBeforeNode = node.appendNewAstNodeAsChild("irrelevantTokens")
-    node.appendNewAstNodeAsChild(secondToLastRelevantTopLevelToken)
-    node.appendNewAstNodeAsChild(groupingClassName[1]).appendChild(parseStatementFragment(
-        tokens[relevantTopLevelTokenIndices[-2]+1:relevantTopLevelTokenIndices[-1]]))
-    node.appendNewAstNodeAsChild(lastRelevantTopLevelToken)
-    irrelevantTokensAfterNode = node.appendNewAstNodeAsChild("irrelevantTokens")
-
-    for token in tokens[:relevantTopLevelTokenIndices[-2]]:
-      irrelevantTokensBeforeNode.appendNewAstNodeAsChild(token)
-
-    for token in tokens[relevantTopLevelTokenIndices[-1]+1:]:
-      irrelevantTokensAfterNode.appendNewAstNodeAsChild(token)
-
-    return node
-  else:
-    import pprint
-    pprint.pprint(tokens)
-    raise RuntimeError("unexpected last relevant top-level token "
-        f"'{lastRelevantTopLevelToken.className}'")
+      return node
+    else:
+      import pprint
+      pprint.pprint(tokens[start:end])
+      raise RuntimeError("unexpected last relevant top-level token "
+          f"'{lastRelevantTopLevelToken.className}'")
+
+  def _parseOperators(self, start: int, end: int, operatorTokenIndices: List[int]) -> AstNode:
+    # The fragment is split at the leftmost operator with the largest precedence value, and
+    # the parts to the left and right are split in the same way. The resulting tree is the
+    # Cartesian tree of the operator sequence, which is built with a stack in linear time.
+    tokens = self._tokens
+    groupDepthOffset = tokens[start].groupDepth
+    precedences = [operatorPrecedence[tokens[i].className] for i in operatorTokenIndices]
+    leftChildIndices: List[Optional[int]] = [None] * len(operatorTokenIndices)
+    rightChildIndices: List[Optional[int]] = [None] * len(operatorTokenIndices)
+    stack: List[int] = []
+
+    for j, precedence in enumerate(precedences):
+      leftChildIndex = None
+      while (len(stack) > 0) and (precedences[stack[-1]] < precedence): leftChildIndex = stack.pop()
+      leftChildIndices[j] = leftChildIndex
+      if len(stack) > 0: rightChildIndices[stack[-1]] = j
+      stack.append(j)
+
+    def buildOperatorNode(j: int, start: int, end: int) -> AstNode:
+      i = operatorTokenIndices[j]
+      node = AstNode(f"{tokens[i].className}Node")
+      leftChildIndex = leftChildIndices[j]
+      rightChildIndex = rightChildIndices[j]
+
+      if leftChildIndex is not None:
+        node.appendChild(buildOperatorNode(leftChildIndex, start, i))
+      else:
+        node.appendChild(self.parse(start, i))
 
+      node.appendNewAstNodeAsChild(tokens[i])
 
+      # the right part is only parsed as part of the tree if its top-level group depth
+      # (i.e., the group depth of its first token) is the same
+      if (rightChildIndex is not None) and (tokens[i + 1].groupDepth == groupDepthOffset):
+        node.appendChild(buildOperatorNode(rightChildIndex, i + 1, end))
+      else:
+        node.appendChild(self.parse(i + 1, end))
 
-def divideAndConquerParseStatementFragmentWithClassName(
-      tokens: List[Token], className: str) -> Optional[AstNode]:
-  for i in range(len(tokens)):
-    if tokens[i].className == className: return divideAndConquerParseStatementFragment(tokens, i)
+      return node
 
-  return None
+    return buildOperatorNode(stack[0], start, end)
 
-def divideAndConquerParseStatementFragment(tokens: List[Token], i: int) -> AstNode:
-  node = AstNode(f"{tokens[i].className}Node")
-  node.appendChild(parseStatementFragment(tokens[:i]))
-  node.appendNewAstNodeAsChild(tokens[i])
-  node.appendChild(parseStatementFragment(tokens[i+1:]))
-  return node
+  @staticmethod
+  def _getIndicesInRange(indices: List[int], start: int, end: int) -> List[int]:
+    return indices[bisect.bisect_left(indices, start):bisect.bisect_left(indices, end)]
 
 
 
@@ -470,48 +793,71 @@ def containsEnd(node: AstNode) -> bool:
 
 
 
-def computeBlockDepth(ast: AstNode, functionsHaveEnd: bool, settings: Settings) -> None:
-  nodeStack = [(ast, 0, 0)]
-  mainFunctionStarted = False
-  mainFunctionEnded = False
+class BlockDepthState(object):
+  # state of computeBlockDepth that depends on the blocks before the current one
 
-  while len(nodeStack) > 0:
-    node, blockDepth, functionDepth = nodeStack.pop()
-    node.blockDepth = blockDepth
+  def __init__(self, functionsHaveEnd: bool, settings: Settings) -> None:
+    self.functionsHaveEnd = functionsHaveEnd
+    self.settings = settings
+    self.mainFunctionStarted = False
+    self.mainFunctionEnded = False
 
-    if (node.parent is not None) and node.parent.className.endswith("Block"):
-      if (node.className in ["case", "otherwise"]) and settings.indentCaseOtherwise: blockDepth += 1
+  def enterChildOfBlock(self, className: str, blockClassName: str, blockDepth: int,
+        functionDepth: int) -> Tuple[int, int, int]:
+    # has to be called for the children of blocks in the order of the code; returns the block
+    # depth of the statement children of the child, the block depth of its other children, and
+    # the function depth of its children
+    settings = self.settings
+    functionsHaveEnd = self.functionsHaveEnd
+    if (className in ["case", "otherwise"]) and settings.indentCaseOtherwise: blockDepth += 1
 
-      parentIsFunction = (node.parent.className == "functionBlock")
+    parentIsFunction = (blockClassName == "functionBlock")
 
-      if parentIsFunction:
-        if not mainFunctionStarted:
-          mainFunctionStarted = True
-        elif (not functionsHaveEnd) or (functionDepth == 0):
-          mainFunctionEnded = True
+    if parentIsFunction:
+      if not self.mainFunctionStarted:
+        self.mainFunctionStarted = True
+      elif (not functionsHaveEnd) or (functionDepth == 0):
+        self.mainFunctionEnded = True
 
-      parentIsMainFunction = parentIsFunction and (not mainFunctionEnded) and (functionDepth == 0)
-      parentIsNestedFunction = parentIsFunction and functionsHaveEnd and (functionDepth >= 1)
-      parentIsLocalFunction = (parentIsFunction and (not parentIsMainFunction)
-          and (not parentIsNestedFunction))
-      childFunctionDepth = functionDepth
+    parentIsMainFunction = (parentIsFunction and (not self.mainFunctionEnded)
+        and (functionDepth == 0))
+    parentIsNestedFunction = parentIsFunction and functionsHaveEnd and (functionDepth >= 1)
+    parentIsLocalFunction = (parentIsFunction and (not parentIsMainFunction)
+        and (not parentIsNestedFunction))
+    childFunctionDepth = functionDepth
 
-      if parentIsLocalFunction: blockDepth = 0
+    if parentIsLocalFunction: blockDepth = 0
 
-      if parentIsFunction and (functionsHaveEnd or (functionDepth == 0)):
-        childFunctionDepth += 1
+    if parentIsFunction and (functionsHaveEnd or (functionDepth == 0)):
+      childFunctionDepth += 1
 
-      for child in node.children[::-1]:
-        childBlockDepth = blockDepth
+    childBlockDepth = blockDepth
+
+    if ((not parentIsFunction)
+          or (parentIsMainFunction and settings.indentMainFunction)
+          or (parentIsLocalFunction and settings.indentLocalFunction)
+          or (parentIsNestedFunction and settings.indentNestedFunction)):
+      childBlockDepth += 1
 
-        if ((child.className != "statement")
-              and ((not parentIsFunction)
-                or (parentIsMainFunction and settings.indentMainFunction)
-                or (parentIsLocalFunction and settings.indentLocalFunction)
-                or (parentIsNestedFunction and settings.indentNestedFunction))):
-          childBlockDepth += 1
+    return blockDepth, childBlockDepth, childFunctionDepth
 
-        nodeStack.append((child, childBlockDepth, childFunctionDepth))
+
+
+def computeBlockDepth(ast: AstNode, functionsHaveEnd: bool, settings: Settings) -> None:
+  state = BlockDepthState(functionsHaveEnd, settings)
+  nodeStack = [(ast, 0, 0)]
+
+  while len(nodeStack) > 0:
+    node, blockDepth, functionDepth = nodeStack.pop()
+    node.blockDepth = blockDepth
+
+    if (node.parent is not None) and node.parent.className.endswith("Block"):
+      statementBlockDepth, childBlockDepth, childFunctionDepth = state.enterChildOfBlock(
+          node.className, node.parent.className, blockDepth, functionDepth)
+
+      for child in node.children[::-1]:
+        nodeStack.append((child, (statementBlockDepth if child.className == "statement"
+            else childBlockDepth), childFunctionDepth))
     else:
       for child in node.children[::-1]:
         nodeStack.append((child, blockDepth, functionDepth))
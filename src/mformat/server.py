@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from __future__ import annotations
+import json
+import os
+import socket
+import stat
+import traceback
+from typing import Any, Dict, IO, Optional
+
+from . import formatCode, formatCodeOfFile, processFile
+from .memo import StatementMemo
+from .settings import Settings
+from .stats import FormatStats
+
+
+
+class RpcError(Exception):
+  def __init__(self, code: int, message: str) -> None:
+    super().__init__(message)
+    self.code = code
+    self.message = message
+
+
+
+class FormatServer(object):
+  # Formats code on behalf of clients, so that the interpreter startup, the imports and the
+  # compilation of the regular expressions of the tokenizer are only paid once, and the
+  # settings file cache and the StatementMemo of the server stay warm across requests.
+  # The protocol is JSON-RPC 2.0 with one message per line (over stdin/stdout or a Unix
+  # socket). Requests are handled one after the other, as the caches are not thread-safe and
+  # formatting is bound by the CPU anyway.
+  #
+  # Methods:
+  # - format: params {"code": str, "path": str, "settings": dict}, all optional, but one of
+  #   code and path is required; if only path is given, the file is read. If path is given,
+  #   the settings file of path is applied before the settings. Returns {"formattedCode": str}.
+  # - processFile: params {"path": str, "settings": dict, "useCache": bool, "mode": str,
+  #   "collectStats": bool, "memoryMap": bool}, see mformat.processFile. Returns
+  #   {"formattedCode": str or null, "changed": bool, "errorMessage": str or null,
+  #   "stats": dict or null} (see FileResult.toDict).
+  # - shutdown: stops the server after the response. Returns null.
+
+  parseErrorCode = -32700
+  invalidRequestCode = -32600
+  methodNotFoundCode = -32601
+  invalidParamsCode = -32602
+  formatErrorCode = -32000
+
+  def __init__(self) -> None:
+    self.running = True
+    self._memo = StatementMemo()
+
+  def handleMessage(self, message: str) -> Optional[str]:
+    # returns the response, or None for notifications
+    try:
+      request = json.loads(message)
+    except ValueError as e:
+      return FormatServer._createErrorResponse(None, FormatServer.parseErrorCode, str(e))
+
+    requestId = (request.get("id") if isinstance(request, dict) else None)
+
+    try:
+      if ((not isinstance(request, dict)) or (request.get("jsonrpc") != "2.0")
+            or (not isinstance(request.get("method"), str))):
+        raise RpcError(FormatServer.invalidRequestCode, "invalid request")
+
+      params = request.get("params", {})
+      if not isinstance(params, dict): raise RpcError(FormatServer.invalidParamsCode,
+          "params must be an object")
+      result = self._handleRequest(request["method"], params)
+    except RpcError as e:
+      return FormatServer._createErrorResponse(requestId, e.code, e.message)
+    except Exception as e:
+      return FormatServer._createErrorResponse(requestId, FormatServer.formatErrorCode,
+          traceback.format_exception_only(type(e), e)[-1].strip())
+
+    if "id" not in request: return None
+    return json.dumps({"jsonrpc": "2.0", "id": requestId, "result": result})
+
+  def _handleRequest(self, method: str, params: Dict[str, Any]) -> Any:
+    dictSettings = params.get("settings", {})
+    if not isinstance(dictSettings, dict): raise RpcError(FormatServer.invalidParamsCode,
+        "settings must be an object")
+
+    if method == "format":
+      code, path = params.get("code"), params.get("path")
+
+      if path is not None:
+        if code is None:
+          with open(path, "r") as f: code = f.read()
+
+        return {"formattedCode": formatCodeOfFile(code, path, dictSettings, memo=self._memo)}
+      elif code is not None:
+        settings = Settings()
+        settings.applyDict(dictSettings)
+        return {"formattedCode": formatCode(code, settings, memo=self._memo)}
+      else:
+        raise RpcError(FormatServer.invalidParamsCode, "code or path is required")
+    elif method == "processFile":
+      if "path" not in params: raise RpcError(FormatServer.invalidParamsCode, "path is required")
+      stats = (FormatStats() if params.get("collectStats", False) else None)
+      fileResult = processFile(params["path"], dictSettings, bool(params.get("useCache", False)),
+          params.get("mode", "print"), stats, bool(params.get("memoryMap", False)), self._memo)
+      return fileResult.toDict()
+    elif method == "shutdown":
+      self.running = False
+      return None
+    else:
+      raise RpcError(FormatServer.methodNotFoundCode, f"method not found: {method}")
+
+  @staticmethod
+  def _createErrorResponse(requestId: Any, code: int, message: str) -> str:
+    return json.dumps({"jsonrpc": "2.0", "id": requestId,
+        "error": {"code": code, "message": message}})
+
+  def serveStream(self, inputStream: IO[str], outputStream: IO[str]) -> None:
+    # serves until end of input or shutdown
+    for message in inputStream:
+      if message.strip() == "": continue
+      response = self.handleMessage(message)
+
+      if response is not None:
+        outputStream.write(response + "\n")
+        outputStream.flush()
+
+      if not self.running: break
+
+  def serveSocket(self, socketPath: str) -> None:
+    # serves the connections to a Unix socket one after the other until shutdown
+    FormatServer._removeStaleSocket(socketPath)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as serverSocket:
+      # if binding fails, socketPath is not ours to remove
+      serverSocket.bind(socketPath)
+
+      try:
+        serverSocket.listen()
+
+        while self.running:
+          connection, _ = serverSocket.accept()
+
+          with connection, connection.makefile("r") as inputStream, \
+                connection.makefile("w") as outputStream:
+            try:
+              self.serveStream(inputStream, outputStream)
+            except OSError:
+              # the client went away
+              pass
+      finally:
+        FormatServer._removeSocket(socketPath)
+
+  @staticmethod
+  def _removeStaleSocket(socketPath: str) -> None:
+    try:
+      if not stat.S_ISSOCK(os.stat(socketPath).st_mode): return
+    except OSError:
+      return
+
+    if FormatClient.connect(socketPath) is not None:
+      raise RuntimeError(f"a server is already listening on '{socketPath}'")
+
+    os.remove(socketPath)
+
+  @staticmethod
+  def _removeSocket(socketPath: str) -> None:
+    # socketPath might have been replaced by something else while serving
+    try:
+      if stat.S_ISSOCK(os.lstat(socketPath).st_mode): os.remove(socketPath)
+    except FileNotFoundError:
+      pass
+
+
+
+class FormatClient(object):
+  # Sends requests to a FormatServer listening on a Unix socket.
+
+  def __init__(self, clientSocket: socket.socket) -> None:
+    self._socket = clientSocket
+    self._inputStream = clientSocket.makefile("r")
+    self._outputStream = clientSocket.makefile("w")
+    self._nextId = 0
+
+  @staticmethod
+  def connect(socketPath: str) -> Optional[FormatClient]:
+    # returns None if no server is listening on socketPath
+    clientSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+      clientSocket.connect(socketPath)
+    except OSError:
+      clientSocket.close()
+      return None
+
+    return FormatClient(clientSocket)
+
+  def request(self, method: str, params: Dict[str, Any] = {}) -> Any:
+    requestId = self._nextId
+    self._nextId += 1
+    self._outputStream.write(json.dumps({"jsonrpc": "2.0", "id": requestId, "method": method,
+        "params": params}) + "\n")
+    self._outputStream.flush()
+    message = self._inputStream.readline()
+    if message == "": raise ConnectionError("server closed the connection")
+    response = json.loads(message)
+    assert response.get("id") == requestId
+    if "error" in response: raise RpcError(response["error"]["code"], response["error"]["message"])
+    return response["result"]
+
+  def close(self) -> None:
+    self._inputStream.close()
+    self._outputStream.close()
+    self._socket.close()
+
+  def __enter__(self) -> FormatClient:
+    return self
+
+  def __exit__(self, *args: Any) -> None:
+    self.close()
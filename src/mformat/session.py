@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from __future__ import annotations
+import bisect
+import itertools
+from typing import List, Optional, Tuple
+
+from .formatter import formatStatementCopy, TrailingWhitespaceRemover
+from .parser import (AstNode, checkIfFunctionsHaveEnd, computeBlockDepth, getBlockKeyword,
+    iterBuildBlockTree, iterStatements, parseStatement)
+from .settings import Settings
+from .tokenizer import Token, Tokenizer, TokenizerState, TokenKind
+
+
+
+class SessionStatement(object):
+  __slots__ = ("tokens", "entryState", "length", "blockKeyword", "node", "containsNewline",
+      "isNewlineOnly", "formattedCode", "formattedCodeKey", "pendingWhitespace")
+
+  def __init__(self, tokens: List[Token], entryState: TokenizerState) -> None:
+    self.tokens = tokens
+    # state of the tokenizer before the first token
+    self.entryState = entryState
+    self.length = sum(len(x.code) for x in tokens)
+    self.blockKeyword = getBlockKeyword(tokens)
+    # not modified by formatting, as copies are formatted
+    self.node = parseStatement(tokens)
+    self.containsNewline = any(x.kind == TokenKind.newline for x in tokens)
+    self.isNewlineOnly = ([x.kind for x in tokens if x.kind not in
+        [TokenKind.whitespace, TokenKind.lineContinuationComment]] == [TokenKind.newline])
+    # formatted code and the context it depends on (see FormatSession.format)
+    self.formattedCode = ""
+    self.formattedCodeKey: Optional[Tuple[bool, Optional[int], str, Optional[str]]] = None
+    # whitespace held back by the TrailingWhitespaceRemover after the statement in the last
+    # format, None if the statement has not been formatted yet
+    self.pendingWhitespace: Optional[str] = None
+
+
+
+class FormatSession(object):
+  # Keeps the tokens, the AST and the formatted code of every statement of a code, so that after
+  # an edit, only the statements around the edit have to be tokenized, parsed and formatted
+  # again. Tokenizing restarts at the statement that contains the start of the edit with the
+  # saved state of the tokenizer, and it stops as soon as a statement ends at the old start of a
+  # statement after the edit with the same state, since the rest is tokenized as before. If the
+  # edit neither changes nor involves statements that open, continue or close blocks, the new
+  # statements replace the old ones in the tree, and format only formats them and the statement
+  # before them again; otherwise, the blocks are rebuilt from the statement nodes, and format
+  # checks all statements.
+
+  def __init__(self, code: str = "", settings: Optional[Settings] = None) -> None:
+    self.settings = (settings if settings is not None else Settings())
+    self._tokenizer = Tokenizer()
+    self._code = ""
+    self._statements: List[SessionStatement] = []
+    self._statementStartPositions: Optional[List[int]] = None
+    self._ast = AstNode("statementSequence")
+    # code of the statements after the removal of trailing whitespace in the last format (None
+    # if all statements have to be checked), and the formatted code
+    self._formattedParts: Optional[List[str]] = None
+    self._formattedCode = ""
+    # statements that have to be formatted again, None if there are none
+    self._dirtyRange: Optional[Tuple[int, int]] = None
+    self.setCode(code)
+
+  @property
+  def code(self) -> str:
+    return self._code
+
+  def setCode(self, code: str) -> None:
+    self._code = code
+    self._statementStartPositions = None
+    self._statements = []
+    entryState = TokenizerState()
+
+    for tokens in iterStatements(self._tokenizer.resumeTokens(code, 0, entryState)):
+      self._statements.append(SessionStatement(tokens, entryState))
+      entryState = self._tokenizer.getState()
+
+    self._rebuildBlockTree()
+
+  def edit(self, startPos: int, endPos: int, newCode: str) -> None:
+    # replaces code[startPos:endPos] with newCode
+    oldCode = self._code
+    assert 0 <= startPos <= endPos <= len(oldCode)
+    code = oldCode[:startPos] + newCode + oldCode[endPos:]
+    newEndPos = startPos + len(newCode)
+
+    # the match of a block comment extends to the last "%}" at the start of a line of the
+    # whole code, so edits of such lines may change tokens before the edit
+    if ((len(self._statements) == 0)
+          or FormatSession._containsBlockCommentEnd(oldCode, startPos, endPos)
+          or FormatSession._containsBlockCommentEnd(code, startPos, newEndPos)):
+      self.setCode(code)
+      return
+
+    statements = self._statements
+    startPositions = self._getStatementStartPositions()
+    firstIndex = max(bisect.bisect_right(startPositions, startPos) - 1, 0)
+    entryState = statements[firstIndex].entryState
+    prevToken = (statements[firstIndex - 1].tokens[-1] if firstIndex > 0 else None)
+    pos = startPositions[firstIndex]
+    tokens = self._tokenizer.resumeTokens(code, pos, entryState)
+    newStatements = []
+    resumeIndex = len(statements)
+
+    for statementTokens in iterStatements(tokens, prevToken):
+      newStatement = SessionStatement(statementTokens, entryState)
+      newStatements.append(newStatement)
+      pos += newStatement.length
+      entryState = self._tokenizer.getState()
+      if pos < newEndPos: continue
+      oldPos = pos - len(newCode) + (endPos - startPos)
+      index = bisect.bisect_left(startPositions, oldPos)
+
+      if ((index < len(statements)) and (startPositions[index] == oldPos)
+            and (statements[index].entryState == entryState)):
+        resumeIndex = index
+        break
+
+    oldStatements = statements[firstIndex:resumeIndex]
+    statements[firstIndex:resumeIndex] = newStatements
+    self._code = code
+    self._statementStartPositions = None
+
+    if self._formattedParts is not None:
+      self._formattedParts[firstIndex:resumeIndex] = len(newStatements) * [""]
+      # whether a newline is appended to the statement before depends on the next statement
+      self._markDirty(max(firstIndex - 1, 0), resumeIndex, firstIndex + len(newStatements))
+
+    # the new statements take the place of the old ones or, if there are none, are inserted
+    # before the statement after them
+    nextIndex = firstIndex + len(newStatements)
+    referenceStatement = (oldStatements[0] if len(oldStatements) > 0
+        else (statements[nextIndex] if nextIndex < len(statements) else None))
+
+    if ((referenceStatement is not None) and (referenceStatement.blockKeyword is None)
+          and all(x.blockKeyword is None for x in itertools.chain(oldStatements, newStatements))):
+      # the statements are consecutive children of the same node
+      parent = referenceStatement.node.parent
+      assert parent is not None
+      index = referenceStatement.node.getIndexInParent()
+      blockDepth = referenceStatement.node.blockDepth
+      for oldStatement in oldStatements: oldStatement.node.remove()
+
+      for i, newStatement in enumerate(newStatements):
+        newStatement.node.blockDepth = blockDepth
+        parent.insertChild(index + i, newStatement.node)
+    else:
+      self._rebuildBlockTree()
+
+  def format(self) -> str:
+    statements = self._statements
+
+    if self._formattedParts is None:
+      self._formattedParts = len(statements) * [""]
+      startIndex, endIndex = 0, len(statements)
+    elif self._dirtyRange is not None:
+      startIndex, endIndex = self._dirtyRange
+    else:
+      return self._formattedCode
+
+    formattedParts = self._formattedParts
+    pendingWhitespace = (statements[startIndex - 1].pendingWhitespace if startIndex > 0 else "")
+    assert pendingWhitespace is not None
+    trailingWhitespaceRemover = TrailingWhitespaceRemover(pendingWhitespace)
+
+    for i in range(startIndex, len(statements)):
+      statement = statements[i]
+      if i < endIndex: self._updateFormattedCode(i)
+      formattedParts[i] = trailingWhitespaceRemover.process(statement.formattedCode)
+      pendingWhitespace = trailingWhitespaceRemover.getPendingWhitespace()
+      # the removal of trailing whitespace of the following statements is the same as before
+      if (i >= endIndex - 1) and (statement.pendingWhitespace == pendingWhitespace): break
+      statement.pendingWhitespace = pendingWhitespace
+
+    self._formattedCode = "".join(formattedParts)
+    if self.settings.newlineAtEndOfFile: self._formattedCode += "\n"
+    self._dirtyRange = None
+    return self._formattedCode
+
+  def _updateFormattedCode(self, index: int) -> None:
+    statements = self._statements
+    statement = statements[index]
+    # same as NewlineInsertionPass
+    appendNewline = ((not statement.containsNewline) and (index + 1 < len(statements))
+        and (not statements[index + 1].isNewlineOnly))
+    node = statement.node
+    parent = node.parent
+    assert parent is not None
+    # SemicolonRemovalPass depends on the parent and the grandparent
+    key = (appendNewline, node.blockDepth, parent.className,
+        (parent.parent.className if parent.parent is not None else None))
+
+    if statement.formattedCodeKey != key:
+      statement.formattedCode = formatStatementCopy(node, self.settings, appendNewline)
+      statement.formattedCodeKey = key
+
+  def _markDirty(self, startIndex: int, oldEndIndex: int, newEndIndex: int) -> None:
+    # the statements [startIndex, oldEndIndex) have been replaced by [startIndex, newEndIndex)
+    if self._dirtyRange is None:
+      self._dirtyRange = (startIndex, newEndIndex)
+      return
+
+    dirtyStartIndex, dirtyEndIndex = self._dirtyRange
+
+    if dirtyEndIndex >= oldEndIndex:
+      dirtyEndIndex += newEndIndex - oldEndIndex
+    elif dirtyEndIndex > startIndex:
+      dirtyEndIndex = newEndIndex
+
+    self._dirtyRange = (min(dirtyStartIndex, startIndex), max(dirtyEndIndex, newEndIndex))
+
+  def _getStatementStartPositions(self) -> List[int]:
+    if self._statementStartPositions is None:
+      self._statementStartPositions = list(itertools.accumulate(
+          itertools.chain([0], (x.length for x in self._statements[:-1]))))
+
+    return self._statementStartPositions
+
+  def _rebuildBlockTree(self) -> None:
+    # the block depths and parents of all statements might have changed
+    self._formattedParts = None
+    self._ast = AstNode("statementSequence")
+
+    for node in iterBuildBlockTree((x.node, x.blockKeyword) for x in self._statements):
+      self._ast.appendChild(node)
+
+    functionsHaveEnd = checkIfFunctionsHaveEnd(self._ast)
+    computeBlockDepth(self._ast, functionsHaveEnd or False, self.settings)
+
+  @staticmethod
+  def _containsBlockCommentEnd(code: str, startPos: int, endPos: int) -> bool:
+    lineStartPos = code.rfind("\n", 0, startPos) + 1
+    lineEndPos = code.find("\n", endPos)
+    if lineEndPos == -1: lineEndPos = len(code)
+    return "%}" in code[lineStartPos:lineEndPos]
@@ -7,9 +7,9 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 from __future__ import annotations
-import json
 import os
-from typing import Any, Dict, Optional
+import time
+from typing import Any, Dict, Optional, Tuple
 
 
 
@@ -72,25 +72,25 @@ class Settings(object):
     self.omitSpaceAroundColonMaxLength = 5
     self.newlineAtEndOfFile = True
 
-  def searchAndLoad(self, codeFilePath: str) -> bool:
-    curDirPath = os.path.dirname(os.path.abspath(codeFilePath))
-    prevDirPath = None
-    settingsFileName = ".mformat.json"
+  def searchAndLoad(self, codeFilePath: str) -> Optional[str]:
+    # returns the path of the loaded settings file
+    settingsFilePath = Settings.search(codeFilePath)
+    if settingsFilePath is None: return None
+    self.applyDict(settingsFileCache.load(settingsFilePath))
+    return settingsFilePath
 
-    while not os.path.isfile(settingsFilePath := os.path.join(curDirPath, settingsFileName)):
-      prevDirPath = curDirPath
-      curDirPath = os.path.dirname(curDirPath)
-      if curDirPath == prevDirPath: return False
-
-    self.load(settingsFilePath)
-    return True
+  @staticmethod
+  def search(codeFilePath: str) -> Optional[str]:
+    return settingsFileCache.search(os.path.dirname(os.path.abspath(codeFilePath)))
 
   def load(self, filePath: str) -> None:
+    import json
     with open(filePath, "r") as f: jsonSettings = json.load(f)
     assert isinstance(jsonSettings, dict)
     self.applyDict(jsonSettings)
 
   def save(self, filePath: str) -> None:
+    import json
     selfSettings = vars(self)
     with open(filePath, "w") as f: json.dump(selfSettings, f)
 
@@ -99,3 +99,76 @@ class Settings(object):
 
     for name, value in dictSettings.items():
       if name in selfSettings: setattr(self, name, value)
+
+
+
+class SettingsFileCache(object):
+  # Memoizes for every directory whether it contains a settings file and the contents of the
+  # settings files, so that formatting many files of the same tree does not search and parse
+  # the same settings file again. Every lookup checks the modification time of the directory or
+  # file (which is cheap compared with reading it), so long-lived processes such as the server
+  # never use outdated settings; as adding or removing a file changes the modification time of
+  # its directory, this detects new settings files as well. Modification times are only
+  # trusted if they are older than timestampResolution seconds when the entry is created, as a
+  # change right after it might not change the modification time on file systems with coarse
+  # timestamps.
+
+  settingsFileName = ".mformat.json"
+  timestampResolution = 2.0
+
+  def __init__(self) -> None:
+    # directory path -> (whether the directory contains a settings file, mtime, whether the
+    # mtime is trusted)
+    self._dirEntries: Dict[str, Tuple[bool, Optional[int], bool]] = {}
+    # settings file path -> (JSON contents, mtime, whether the mtime is trusted)
+    self._fileEntries: Dict[str, Tuple[Dict[str, Any], Optional[int], bool]] = {}
+
+  def search(self, dirPath: str) -> Optional[str]:
+    # returns the path of the settings file in dirPath or its nearest ancestor
+    while True:
+      if self._containsSettingsFile(dirPath):
+        return os.path.join(dirPath, self.settingsFileName)
+
+      parentDirPath = os.path.dirname(dirPath)
+      if parentDirPath == dirPath: return None
+      dirPath = parentDirPath
+
+  def _containsSettingsFile(self, dirPath: str) -> bool:
+    entry = self._dirEntries.get(dirPath)
+    checkTime = time.time_ns()
+    mtime = SettingsFileCache._getModificationTime(dirPath)
+    if (entry is not None) and entry[2] and (mtime == entry[1]): return entry[0]
+    containsSettingsFile = os.path.isfile(os.path.join(dirPath, self.settingsFileName))
+    self._dirEntries[dirPath] = (containsSettingsFile, mtime, self._isTrusted(mtime, checkTime))
+    return containsSettingsFile
+
+  def load(self, filePath: str) -> Dict[str, Any]:
+    entry = self._fileEntries.get(filePath)
+    checkTime = time.time_ns()
+    mtime = SettingsFileCache._getModificationTime(filePath)
+    if (entry is not None) and entry[2] and (mtime == entry[1]): return entry[0]
+    # imported here, as most files are formatted without settings file
+    import json
+    with open(filePath, "r") as f: jsonSettings = json.load(f)
+    assert isinstance(jsonSettings, dict)
+    self._fileEntries[filePath] = (jsonSettings, mtime, self._isTrusted(mtime, checkTime))
+    return jsonSettings
+
+  def _isTrusted(self, mtime: Optional[int], checkTime: int) -> bool:
+    return (mtime is not None) and (mtime < checkTime - 1e9 * self.timestampResolution)
+
+  def clear(self) -> None:
+    self._dirEntries.clear()
+    self._fileEntries.clear()
+
+  @staticmethod
+  def _getModificationTime(path: str) -> Optional[int]:
+    try:
+      return os.stat(path).st_mtime_ns
+    except OSError:
+      return None
+
+
+
+# shared by all formatting functions of a process
+settingsFileCache = SettingsFileCache()
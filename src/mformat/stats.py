@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+# Copyright (C) 2020 Julian Valentin
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from __future__ import annotations
+import contextlib
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+  import cProfile
+
+
+
+class FormatStats(object):
+  # Wall times of the stages of formatting and sizes of their results, summed over all codes
+  # formatted with the same instance. Only filled if passed to the formatting functions, which
+  # otherwise do not measure anything. If profile is True, every stage is also run under its
+  # own cProfile profiler (which makes the times meaningless).
+
+  stageNames = ["tokenize", "splitIntoStatements", "parse", "computeBlockDepth", "format"]
+  counterNames = ["numberOfFiles", "numberOfCacheHits", "numberOfMemoHits", "numberOfMemoMisses",
+      "numberOfTokens", "numberOfStatements", "numberOfAstNodes", "numberOfBytesIn",
+      "numberOfBytesOut"]
+  maximumNames = ["maxBlockDepth", "maxGroupDepth"]
+  counterDescriptions = {
+        "numberOfFiles" : "Files",
+        "numberOfCacheHits" : "Cache hits",
+        "numberOfMemoHits" : "Statement memo hits",
+        "numberOfMemoMisses" : "Statement memo misses",
+        "numberOfTokens" : "Tokens",
+        "numberOfStatements" : "Statements",
+        "numberOfAstNodes" : "AST nodes",
+        "numberOfBytesIn" : "Bytes in",
+        "numberOfBytesOut" : "Bytes out",
+        "maxBlockDepth" : "Max block depth",
+        "maxGroupDepth" : "Max bracket depth",
+      }
+
+  def __init__(self, profile: bool = False) -> None:
+    # stage name -> seconds
+    self.stageTimes: Dict[str, float] = {x : 0.0 for x in FormatStats.stageNames}
+    # pass name -> seconds (parts of the format stage, see formatAst)
+    self.passTimes: Dict[str, float] = {}
+    self.numberOfFiles = 0
+    self.numberOfCacheHits = 0
+    # statements whose formatted code was (not) found in a StatementMemo
+    self.numberOfMemoHits = 0
+    self.numberOfMemoMisses = 0
+    self.numberOfTokens = 0
+    self.numberOfStatements = 0
+    self.numberOfAstNodes = 0
+    self.numberOfBytesIn = 0
+    self.numberOfBytesOut = 0
+    self.maxBlockDepth = 0
+    self.maxGroupDepth = 0
+    self.profiles: Optional[Dict[str, cProfile.Profile]] = None
+
+    if profile:
+      import cProfile
+      self.profiles = {x : cProfile.Profile() for x in FormatStats.stageNames}
+
+  @contextlib.contextmanager
+  def measure(self, stageName: str) -> Iterator[None]:
+    profile = (self.profiles[stageName] if self.profiles is not None else None)
+    startTime = time.perf_counter()
+    if profile is not None: profile.enable()
+
+    try:
+      yield
+    finally:
+      if profile is not None: profile.disable()
+      self.stageTimes[stageName] += time.perf_counter() - startTime
+
+  def add(self, other: FormatStats) -> None:
+    # adds the stats of other to self (profiles are not added)
+    for stageName, stageTime in other.stageTimes.items():
+      self.stageTimes[stageName] = self.stageTimes.get(stageName, 0.0) + stageTime
+
+    for passName, passTime in other.passTimes.items():
+      self.passTimes[passName] = self.passTimes.get(passName, 0.0) + passTime
+
+    for name in FormatStats.counterNames:
+      setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    for name in FormatStats.maximumNames:
+      setattr(self, name, max(getattr(self, name), getattr(other, name)))
+
+  def toDict(self) -> Dict[str, Any]:
+    # JSON-serializable representation without profiles
+    return {"stageTimes" : dict(self.stageTimes), "passTimes" : dict(self.passTimes),
+        **{x : getattr(self, x) for x in FormatStats.counterNames + FormatStats.maximumNames}}
+
+  @staticmethod
+  def fromDict(dictStats: Dict[str, Any]) -> FormatStats:
+    stats = FormatStats()
+    stats.stageTimes.update(dictStats["stageTimes"])
+    stats.passTimes.update(dictStats["passTimes"])
+
+    for name in FormatStats.counterNames + FormatStats.maximumNames:
+      setattr(stats, name, dictStats[name])
+
+    return stats
+
+  def dumpProfiles(self, dirPath: str) -> List[str]:
+    # writes the profile of every stage to dirPath/<stage>.prof (readable with pstats) and
+    # returns the paths of the files
+    assert self.profiles is not None
+    os.makedirs(dirPath, exist_ok=True)
+    filePaths = []
+
+    for stageName, profile in self.profiles.items():
+      filePath = os.path.join(dirPath, f"{stageName}.prof")
+      profile.dump_stats(filePath)
+      filePaths.append(filePath)
+
+    return filePaths
+
+  def formatTable(self) -> str:
+    totalTime = sum(self.stageTimes.values())
+    lines = [f"{'Stage':<36}{'Time [ms]':>12}{'Share':>9}"]
+
+    def appendTimeLine(name: str, seconds: float) -> None:
+      share = (seconds / totalTime if totalTime > 0 else 0.0)
+      lines.append(f"{name:<36}{1000 * seconds:>12.1f}{share:>9.1%}")
+
+    for stageName in FormatStats.stageNames:
+      appendTimeLine(stageName, self.stageTimes[stageName])
+
+      if stageName == "format":
+        for passName, passTime in self.passTimes.items(): appendTimeLine(f"  {passName}", passTime)
+
+    appendTimeLine("total", totalTime)
+    lines.append("")
+
+    for name in FormatStats.counterNames + FormatStats.maximumNames:
+      lines.append(f"{FormatStats.counterDescriptions[name]:<36}{getattr(self, name):>12}")
+
+    return "\n".join(lines)
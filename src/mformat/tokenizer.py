@@ -7,16 +7,106 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 from __future__ import annotations
-from typing import List, Optional, Union
+from typing import Any, cast, Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING, Union
 
+import bisect
+import enum
 import re
 
+if TYPE_CHECKING:
+  import mmap
+
+
+
+class TokenKind(enum.IntEnum):
+  unknown = 0
+  blockComment = enum.auto()
+  lineComment = enum.auto()
+  lineContinuationComment = enum.auto()
+  keyword = enum.auto()
+  singleQuotedString = enum.auto()
+  identifier = enum.auto()
+  number = enum.auto()
+  openingParenthesisWithIdentifier = enum.auto()
+  openingParenthesisWithoutIdentifier = enum.auto()
+  closingParenthesis = enum.auto()
+  closingParenthesisWithIdentifier = enum.auto()
+  closingParenthesisWithoutIdentifier = enum.auto()
+  openingBracketWithoutIdentifier = enum.auto()
+  closingBracket = enum.auto()
+  closingBracketWithIdentifier = enum.auto()
+  closingBracketWithoutIdentifier = enum.auto()
+  openingBraceWithIdentifier = enum.auto()
+  openingBraceWithoutIdentifier = enum.auto()
+  closingBrace = enum.auto()
+  closingBraceWithIdentifier = enum.auto()
+  closingBraceWithoutIdentifier = enum.auto()
+  eqOperator = enum.auto()
+  neOperator = enum.auto()
+  assignmentOperator = enum.auto()
+  shortCircuitLogicalAndOperator = enum.auto()
+  logicalAndOperator = enum.auto()
+  shortCircuitLogicalOrOperator = enum.auto()
+  logicalOrOperator = enum.auto()
+  logicalNotOperator = enum.auto()
+  lteOperator = enum.auto()
+  ltOperator = enum.auto()
+  gteOperator = enum.auto()
+  gtOperator = enum.auto()
+  additionOperator = enum.auto()
+  subtractionOperator = enum.auto()
+  multiplicationOperator = enum.auto()
+  matrixMultiplicationOperator = enum.auto()
+  rightDivisionOperator = enum.auto()
+  leftDivisionOperator = enum.auto()
+  matrixRightDivisionOperator = enum.auto()
+  matrixLeftDivisionOperator = enum.auto()
+  powerOperator = enum.auto()
+  matrixPowerOperator = enum.auto()
+  transposeOperator = enum.auto()
+  conjugateTransposeOperator = enum.auto()
+  colonOperator = enum.auto()
+  period = enum.auto()
+  comma = enum.auto()
+  semicolon = enum.auto()
+  tilde = enum.auto()
+  whitespace = enum.auto()
+  newline = enum.auto()
+
+
+
+tokenKindNames = [x.name for x in TokenKind]
+
+irrelevantTokenKinds = frozenset([TokenKind.blockComment, TokenKind.lineComment,
+    TokenKind.lineContinuationComment, TokenKind.newline, TokenKind.whitespace])
+openingTokenKinds = frozenset(x for x in TokenKind if x.name.startswith("opening"))
+closingTokenKinds = frozenset(x for x in TokenKind if x.name.startswith("closing"))
+operatorTokenKinds = frozenset(x for x in TokenKind if x.name.endswith("Operator"))
+
+_relevantTokenKindFlags = [x not in irrelevantTokenKinds for x in TokenKind]
+
 
 
 class TokenClass(object):
-  def __init__(self, name: str, pattern: Union[re.Pattern[str], str]) -> None:
+  def __init__(self, name: str, patternString: str) -> None:
     self.name = name
-    self.pattern = (re.compile(pattern) if isinstance(pattern, str) else pattern)
+    self.kind = TokenKind[name]
+    self.patternString = patternString
+    # compiled on first use, as compiling all patterns at import slows down the startup
+    self._pattern: Optional[re.Pattern[str]] = None
+    self._bytesPattern: Optional[re.Pattern[bytes]] = None
+
+  @property
+  def pattern(self) -> re.Pattern[str]:
+    if self._pattern is None: self._pattern = re.compile(self.patternString)
+    return self._pattern
+
+  @property
+  def bytesPattern(self) -> re.Pattern[bytes]:
+    # the patterns only contain ASCII characters, so they match UTF-8 encoded code in the same
+    # way as the code itself
+    if self._bytesPattern is None: self._bytesPattern = re.compile(self.patternString.encode())
+    return self._bytesPattern
 
   def __repr__(self) -> str:
     return self.name
@@ -24,26 +114,39 @@ class TokenClass(object):
 
 
 class Token(object):
-  def __init__(self, code: str, startPos: int, className: str) -> None:
+  __slots__ = ("code", "startPos", "kind", "groupDepth", "_value")
+
+  def __init__(self, code: str, startPos: int, kind: Union[TokenKind, str]) -> None:
     self.code = code
     self.startPos = startPos
-    self.className = className
-    self.value: Union[str, int, float] = code
+    self.kind = (TokenKind[kind] if isinstance(kind, str) else kind)
     self.groupDepth: Optional[int] = None
-    self.evaluate()
+    self._value: Union[str, int, float, None] = None
+
+  @property
+  def className(self) -> str:
+    return tokenKindNames[self.kind]
+
+  @className.setter
+  def className(self, className: str) -> None:
+    self.kind = TokenKind[className]
+
+  @property
+  def value(self) -> Union[str, int, float]:
+    if self._value is None: self.evaluate()
+    return cast(Union[str, int, float], self._value)
 
   def evaluate(self) -> None:
-    if self.className == "singleQuotedString":
-      self.value = self.code[1:-1].replace("''", "'")
-    elif self.className == "number":
-      self.value = float(self.code)
-      if self.value == int(self.value): self.value = int(self.value)
+    if self.kind == TokenKind.singleQuotedString:
+      self._value = self.code[1:-1].replace("''", "'")
+    elif self.kind == TokenKind.number:
+      value = float(self.code)
+      self._value = (int(value) if value == int(value) else value)
     else:
-      self.value = self.code
+      self._value = self.code
 
   def isRelevant(self) -> bool:
-    return (self.className not in [
-        "blockComment", "lineComment", "lineContinuationComment", "newline", "whitespace"])
+    return _relevantTokenKindFlags[self.kind]
 
   def __repr__(self) -> str:
     indent = (self.groupDepth * "  " if self.groupDepth is not None else "")
@@ -52,6 +155,81 @@ class Token(object):
 
 
 
+class BufferToken(Token):
+  # Token of a ByteTokenizer, which stores the length of its code in the UTF-8 encoded buffer
+  # instead of a copy of the code. The code is decoded whenever it is accessed.
+  __slots__ = ("buffer", "length")
+
+  def __init__(self, buffer: Union[bytes, mmap.mmap], startPos: int, length: int,
+        kind: TokenKind) -> None:
+    self.buffer = buffer
+    self.startPos = startPos
+    self.length = length
+    self.kind = kind
+    self.groupDepth: Optional[int] = None
+    self._value: Union[str, int, float, None] = None
+
+  @property
+  def code(self) -> str:
+    return self.buffer[self.startPos:self.startPos + self.length].decode()
+
+
+
+class LineIndex(object):
+  def __init__(self, code: Union[str, bytes, mmap.mmap]) -> None:
+    # for bytes, the positions are byte offsets
+    newline = ("\n" if isinstance(code, str) else b"\n")
+    self.lineStartPositions = [0]
+    newlinePos = code.find(newline)
+
+    while newlinePos != -1:
+      self.lineStartPositions.append(newlinePos + 1)
+      newlinePos = code.find(newline, newlinePos + 1)
+
+  def getNumberOfLines(self) -> int:
+    return len(self.lineStartPositions)
+
+  def getLineStartPos(self, line: int) -> int:
+    return self.lineStartPositions[line]
+
+  def getLineAndColumn(self, pos: int) -> Tuple[int, int]:
+    line = bisect.bisect_right(self.lineStartPositions, pos) - 1
+    return line, pos - self.lineStartPositions[line]
+
+
+
+def compileMasterPattern(tokenClasses: List[TokenClass],
+      forBytes: bool = False) -> Tuple[re.Pattern[Any], Dict[int, TokenClass]]:
+  # the group indices are looked up by name, so that the patterns of the token classes do not
+  # have to be compiled separately to count their groups
+  patternString = "|".join(f"(?P<{x.name}>{x.patternString})" for x in tokenClasses)
+  masterPattern = re.compile(patternString.encode() if forBytes else patternString)
+  groupIndexTokenClasses = {masterPattern.groupindex[x.name] : x for x in tokenClasses}
+  return masterPattern, groupIndexTokenClasses
+
+
+
+class TokenizerState(object):
+  # state of the tokenizer between two tokens, which determines together with the remaining
+  # code how the remaining code is tokenized
+  __slots__ = ("onlyWhitespaceLeftOfPosInCurLine", "lastRelevantToken", "groupingStack")
+
+  def __init__(self, onlyWhitespaceLeftOfPosInCurLine: bool = True,
+        lastRelevantToken: Optional[Token] = None, groupingStack: Tuple[bool, ...] = ()) -> None:
+    self.onlyWhitespaceLeftOfPosInCurLine = onlyWhitespaceLeftOfPosInCurLine
+    self.lastRelevantToken = lastRelevantToken
+    self.groupingStack = groupingStack
+
+  def __eq__(self, other: object) -> bool:
+    # only the kind of the last relevant token is used by the tokenizer
+    return (isinstance(other, TokenizerState)
+        and (self.onlyWhitespaceLeftOfPosInCurLine == other.onlyWhitespaceLeftOfPosInCurLine)
+        and ((self.lastRelevantToken.kind if self.lastRelevantToken is not None else None)
+          == (other.lastRelevantToken.kind if other.lastRelevantToken is not None else None))
+        and (self.groupingStack == other.groupingStack))
+
+
+
 class Tokenizer(object):
   _blockCommentTokenClass = TokenClass("blockComment", r"%\{(\n(.|\n)*\n|\n)[ \t]*%\}(?=\n|$)")
   _conjugateTransposeOperatorTokenClass = TokenClass("conjugateTransposeOperator", r"'")
@@ -109,89 +287,184 @@ class Tokenizer(object):
         TokenClass("newline", r"\n"),
       ]
 
+  _compiledMasterPattern: Optional[Tuple[re.Pattern[Any], Dict[int, TokenClass]]] = None
+
+  # the closing token kinds of the grouping stack, not the ones after _appendToken has
+  # appended "WithIdentifier" or "WithoutIdentifier", can precede a conjugate transpose
+  _transposableTokenKinds = frozenset([TokenKind.identifier, TokenKind.number,
+      TokenKind.closingParenthesis, TokenKind.closingBracket, TokenKind.closingBrace])
+  _openingWithIdentifierTokenKinds = frozenset([TokenKind.openingParenthesisWithIdentifier,
+      TokenKind.openingBraceWithIdentifier])
+  _closingTokenKinds = {(x, y) : TokenKind[f"{x.name}{'With' if y else 'Without'}Identifier"]
+      for x in [TokenKind.closingParenthesis, TokenKind.closingBracket, TokenKind.closingBrace]
+      for y in [False, True]}
+
   def __init__(self) -> None:
     self._code = ""
-    self._tokens: List[Token] = []
     self._pos = 0
-    self._curLine = ""
-    self._posInCurLine = 0
     self._onlyWhitespaceLeftOfPosInCurLine = True
     self._lastRelevantToken: Optional[Token] = None
-    self._groupingStack: List[str] = []
+    self._groupingStack: List[bool] = []
+    self.lineIndex = LineIndex("")
+    self._masterPattern, self._masterPatternTokenClasses = self._getMasterPattern()
+
+  @staticmethod
+  def _getMasterPattern() -> Tuple[re.Pattern[Any], Dict[int, TokenClass]]:
+    # compiled when the first tokenizer is created instead of at import
+    if Tokenizer._compiledMasterPattern is None:
+      Tokenizer._compiledMasterPattern = compileMasterPattern(Tokenizer._tokenClasses)
+
+    return Tokenizer._compiledMasterPattern
 
   def tokenizeCode(self, code: str) -> List[Token]:
+    return list(self.iterTokens(code))
+
+  def iterTokens(self, code: str) -> Iterator[Token]:
+    self.lineIndex = LineIndex(code)
+    return self.resumeTokens(code, 0, TokenizerState())
+
+  def resumeTokens(self, code: str, startPos: int, state: TokenizerState) -> Iterator[Token]:
+    # tokenizes code[startPos:] as if code[:startPos] had been tokenized, resulting in state;
+    # lineIndex is not updated
     self._code = code
-    self._tokens = []
-    self._pos = 0
-    self._lastRelevantToken = None
-    self._groupingStack = []
+    self._pos = startPos
+    self._onlyWhitespaceLeftOfPosInCurLine = state.onlyWhitespaceLeftOfPosInCurLine
+    self._lastRelevantToken = state.lastRelevantToken
+    self._groupingStack = list(state.groupingStack)
+    return self._iterTokens()
 
-    while self._pos < len(self._code):
-      self._updateLineInfo()
-
-      if (self._onlyWhitespaceLeftOfPosInCurLine
-            and self._matchTokenClass(self._blockCommentTokenClass)):
-        continue
-      elif ((self._lastRelevantToken is not None)
-            and (self._lastRelevantToken.className in ["identifier", "number",
-              "closingParenthesis", "closingBracket", "closingBrace"])
-            and self._matchTokenClass(self._conjugateTransposeOperatorTokenClass)):
-        continue
-      elif ((self._lastRelevantToken is not None)
-            and (self._lastRelevantToken.className == "identifier")
-            and (self._matchTokenClass(self._openingParenthesisWithIdentifierTokenClass)
-              or self._matchTokenClass(self._openingBraceWithIdentifierTokenClass))):
-        continue
-
-      tokenClassMatched = False
-      tokenClass = None
-
-      for tokenClass in self._tokenClasses:
-        if self._matchTokenClass(tokenClass):
-          tokenClassMatched = True
-          break
-
-      if not tokenClassMatched:
-        self._appendToken(Token(self._code[self._pos], self._pos, "unknown"))
-
-    return self._tokens
-
-  def _updateLineInfo(self) -> None:
-    lineEndPos = self._pos
-    while (lineEndPos < len(self._code)) and (self._code[lineEndPos] != "\n"): lineEndPos += 1
-
-    lineStartPos = self._pos - 1
-    while (lineStartPos >= 0) and (self._code[lineStartPos] != "\n"): lineStartPos -= 1
-    lineStartPos += 1
-
-    self._curLine = self._code[lineStartPos:lineEndPos]
-    self._posInCurLine = self._pos - lineStartPos
-    self._onlyWhitespaceLeftOfPosInCurLine = True
+  def getState(self) -> TokenizerState:
+    return TokenizerState(self._onlyWhitespaceLeftOfPosInCurLine, self._lastRelevantToken,
+        tuple(self._groupingStack))
 
-    for i in range(self._posInCurLine):
-      if (self._curLine[i] != " ") and (self._curLine[i] != "\t"):
-        self._onlyWhitespaceLeftOfPosInCurLine = False
-        break
+  def _iterTokens(self) -> Iterator[Token]:
+    while self._pos < len(self._code):
+      token = self._matchNextToken()
+      self._appendToken(token)
+      yield token
+
+  def _matchNextToken(self) -> Token:
+    firstCharacter = self._code[self._pos]
+    token = None
+
+    if firstCharacter == "%":
+      if self._onlyWhitespaceLeftOfPosInCurLine:
+        token = self._matchTokenClass(self._blockCommentTokenClass)
+    elif firstCharacter == "'":
+      if ((self._lastRelevantToken is not None)
+            and (self._lastRelevantToken.kind in self._transposableTokenKinds)):
+        token = self._matchTokenClass(self._conjugateTransposeOperatorTokenClass)
+    elif (firstCharacter == "(") or (firstCharacter == "{"):
+      if ((self._lastRelevantToken is not None)
+            and (self._lastRelevantToken.kind == TokenKind.identifier)):
+        token = self._matchTokenClass(self._openingParenthesisWithIdentifierTokenClass
+            if firstCharacter == "(" else self._openingBraceWithIdentifierTokenClass)
+
+    if token is not None: return token
+
+    # alternatives of the master pattern are tried in the order of _tokenClasses,
+    # so the first token class that matches wins just as if they were tried one by one
+    if (match := self._masterPattern.match(self._code, self._pos)) is not None:
+      tokenClass = self._masterPatternTokenClasses[cast(int, match.lastindex)]
+      return Token(match.group(), self._pos, tokenClass.kind)
+    else:
+      return Token(self._code[self._pos], self._pos, TokenKind.unknown)
 
-  def _matchTokenClass(self, tokenClass: TokenClass) -> bool:
-    if (match := re.match(tokenClass.pattern, self._code[self._pos:])) is not None:
-      matchString = match.group()
-      self._appendToken(Token(matchString, self._pos, tokenClass.name))
-      return True
+  def _matchTokenClass(self, tokenClass: TokenClass) -> Optional[Token]:
+    if (match := tokenClass.pattern.match(self._code, self._pos)) is not None:
+      return Token(match.group(), self._pos, tokenClass.kind)
     else:
-      return False
+      return None
 
   def _appendToken(self, token: Token) -> None:
-    self._tokens.append(token)
     self._pos += len(token.code)
-    if token.isRelevant(): self._lastRelevantToken = token
+    self._updateOnlyWhitespaceLeftOfPosInCurLine(token.code)
+    self._updateGroupingStack(token)
+
+  def _updateGroupingStack(self, token: Token) -> None:
+    if _relevantTokenKindFlags[token.kind]: self._lastRelevantToken = token
     token.groupDepth = len(self._groupingStack)
 
-    if token.className.startswith("opening"):
-      self._groupingStack.append(token.className[7:])
-    elif token.className.startswith("closing"):
-      token.className += ("WithIdentifier"
-          if (len(self._groupingStack) > 0) and "WithIdentifier" in self._groupingStack[-1]
-          else "WithoutIdentifier")
+    if token.kind in openingTokenKinds:
+      self._groupingStack.append(token.kind in self._openingWithIdentifierTokenKinds)
+    elif token.kind in closingTokenKinds:
+      withIdentifier = (len(self._groupingStack) > 0) and self._groupingStack[-1]
+      token.kind = self._closingTokenKinds[token.kind, withIdentifier]
       self._groupingStack.pop()
       token.groupDepth -= 1
+
+  def _updateOnlyWhitespaceLeftOfPosInCurLine(self, code: str) -> None:
+    newlinePos = code.rfind("\n")
+
+    if newlinePos != -1:
+      self._onlyWhitespaceLeftOfPosInCurLine = (code[newlinePos+1:].strip(" \t") == "")
+    elif self._onlyWhitespaceLeftOfPosInCurLine:
+      self._onlyWhitespaceLeftOfPosInCurLine = (code.strip(" \t") == "")
+
+
+
+class ByteTokenizer(Tokenizer):
+  # Tokenizes UTF-8 encoded code in a bytes-like buffer (e.g., a memory-mapped file) instead of
+  # a string, with the same token classes. The tokens are BufferTokens, which do not copy their
+  # code, so that the memory needed for very large files is dominated by the tokens instead of
+  # their code. Start positions and the positions of lineIndex are byte offsets. The buffer
+  # must stay open as long as the code of the tokens is accessed.
+
+  # non-ASCII characters that are not part of a token are unknown tokens as a whole (and not
+  # every byte of them), so that their code can be decoded
+  _unknownTokenClass = TokenClass("unknown", r"[\xc0-\xff][\x80-\xbf]*|.")
+  # the tokens that can contain newlines or consist of whitespace
+  _multilineTokenKinds = frozenset([TokenKind.blockComment, TokenKind.lineContinuationComment,
+      TokenKind.whitespace, TokenKind.newline])
+
+  _compiledMasterPattern: Optional[Tuple[re.Pattern[Any], Dict[int, TokenClass]]] = None
+
+  @staticmethod
+  def _getMasterPattern() -> Tuple[re.Pattern[Any], Dict[int, TokenClass]]:
+    if ByteTokenizer._compiledMasterPattern is None:
+      ByteTokenizer._compiledMasterPattern = compileMasterPattern(
+          Tokenizer._tokenClasses, forBytes=True)
+
+    return ByteTokenizer._compiledMasterPattern
+
+  def _matchNextToken(self) -> Token:
+    firstCharacter = self._code[self._pos:self._pos + 1]
+    token = None
+
+    if firstCharacter == b"%":
+      if self._onlyWhitespaceLeftOfPosInCurLine:
+        token = self._matchTokenClass(self._blockCommentTokenClass)
+    elif firstCharacter == b"'":
+      if ((self._lastRelevantToken is not None)
+            and (self._lastRelevantToken.kind in self._transposableTokenKinds)):
+        token = self._matchTokenClass(self._conjugateTransposeOperatorTokenClass)
+    elif (firstCharacter == b"(") or (firstCharacter == b"{"):
+      if ((self._lastRelevantToken is not None)
+            and (self._lastRelevantToken.kind == TokenKind.identifier)):
+        token = self._matchTokenClass(self._openingParenthesisWithIdentifierTokenClass
+            if firstCharacter == b"(" else self._openingBraceWithIdentifierTokenClass)
+
+    if token is not None: return token
+
+    if (match := self._masterPattern.match(self._code, self._pos)) is not None:
+      tokenClass = self._masterPatternTokenClasses[cast(int, match.lastindex)]
+      return BufferToken(self._code, self._pos, match.end() - self._pos, tokenClass.kind)
+    else:
+      return cast(Token, self._matchTokenClass(self._unknownTokenClass))
+
+  def _matchTokenClass(self, tokenClass: TokenClass) -> Optional[Token]:
+    if (match := tokenClass.bytesPattern.match(self._code, self._pos)) is not None:
+      return BufferToken(self._code, self._pos, match.end() - self._pos, tokenClass.kind)
+    else:
+      return None
+
+  def _appendToken(self, token: Token) -> None:
+    self._pos += cast(BufferToken, token).length
+
+    # the other tokens would be decoded for nothing
+    if token.kind in ByteTokenizer._multilineTokenKinds:
+      self._updateOnlyWhitespaceLeftOfPosInCurLine(token.code)
+    else:
+      self._onlyWhitespaceLeftOfPosInCurLine = False
+
+    self._updateGroupingStack(token)
@@ -7,9 +7,29 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 from __future__ import annotations
+import contextlib
+import copy
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from typing import Dict, List
 import unittest
+import unittest.mock
 
 import mformat
+from mformat.benchmark import (compareResults, CorpusParameters, generateCode, runBenchmark,
+    stageNames)
+from mformat.cache import ResultCache
+from mformat.memo import StatementMemo
+from mformat.parser import AstNode
+from mformat.server import FormatClient, FormatServer
+from mformat.settings import Settings, SettingsFileCache
+from mformat.stats import FormatStats
+from mformat.tokenizer import Tokenizer, TokenKind
 
 
 
@@ -22,6 +42,12 @@ class MformatTestCase(unittest.TestCase):
     self.assertFormat("x=a+(b*(c+d))+e;", expectedCode)
     self.assertFormat("x  =  a  +  (  b  *  (  c  +  d  )  )  +  e  ;", expectedCode)
 
+  def testLongStatements(self) -> None:
+    self.assertFormat("x=" + "+".join(300 * ["a*b"]) + ";",
+        "x = " + " + ".join(300 * ["a * b"]) + ";\n")
+    self.assertFormat("x=f(" + ",".join(300 * ["ab"]) + ");",
+        "x = f(" + ", ".join(300 * ["ab"]) + ");\n")
+
   def testBlocks(self) -> None:
     self.assertFormat("if a;b;end;", "if a\n  b;\nend\n")
     self.assertFormat("if a;b; if c ; d; end;end;", "if a\n  b;\n  if c\n    d;\n  end\nend\n")
@@ -69,6 +95,540 @@ E = m * c * c;
 """.lstrip())
 
 
+  def testIterFormatCode(self) -> None:
+    code = "x=1;if a;b;end;  \nfunction f\ny=a:b ;\nend\n\nz = [1,2]  % c\n\n"
+    chunks = list(mformat.iterFormatCode(code))
+    self.assertGreater(len(chunks), 1)
+    self.assertEqual("".join(chunks), mformat.formatCode(code))
+
+    # statements are yielded one by one, also in functions
+    code = "function f\n" + 100 * "x=1;\n"
+    chunks = list(mformat.iterFormatCode(code))
+    self.assertGreater(len(chunks), 100)
+    self.assertEqual("".join(chunks), mformat.formatCode(code))
+
+    for code in ["function f\nx=1;\nfunction g\ny=2;\nend\nz=3;\nend\nfunction h\nw=4;\nend\n",
+          "function f\nx=1;\nfunction g\ny=2;\nif a\nb\nend\n"]:
+      self.assertEqual("".join(mformat.iterFormatCode(code)), mformat.formatCode(code))
+
+  def testFormatRange(self) -> None:
+    code = "function f\nx=1;if a;b;end;  \nswitch q\ncase 1\nr=2;\notherwise\nr=3;\nend\n\n"
+    lines = code.splitlines(True)
+    self.assertEqual(mformat.formatRange(code, 4, 5), (4, 5, "    r = 2;\n"))
+    self.assertEqual(mformat.formatRange(code, 0, len(lines))[2], mformat.formatCode(code))
+
+    for startLine in range(len(lines)):
+      rangeStartLine, rangeEndLine, formattedCode = mformat.formatRange(
+          code, startLine, startLine + 1)
+      self.assertLessEqual(rangeStartLine, startLine)
+      code2 = "".join(lines[:rangeStartLine]) + formattedCode + "".join(lines[rangeEndLine:])
+      self.assertEqual(mformat.formatCode(code2), mformat.formatCode(code))
+
+  def testFormatSession(self) -> None:
+    code = "function f\nx=1;if a;b;end;  \nswitch q\ncase 1\nr=2;\notherwise\nr=3;\nend\n"
+    session = mformat.FormatSession(code)
+    self.assertEqual(session.format(), mformat.formatCode(code))
+
+    # (line, number of replaced lines, new code)
+    edits = [(1, 0, "y=2;\n"), (2, 1, "x=1;if a;b;\n"), (3, 0, "end\n"), (0, 0, "\n\n"),
+        (5, 1, "case 2\n"), (4, 0, "%{\nx\n%}\n"), (7, 0, "a...\n+b;"), (9, 2, "")]
+
+    for line, numberOfLines, newCode in edits:
+      lineStartPositions = [0] + [i + 1 for i, x in enumerate(code) if x == "\n"]
+      startPos = lineStartPositions[line]
+      endPos = lineStartPositions[line + numberOfLines]
+      code = code[:startPos] + newCode + code[endPos:]
+      session.edit(startPos, endPos, newCode)
+      self.assertEqual(session.code, code)
+      self.assertEqual(session.format(), mformat.formatCode(code))
+
+    # several edits before formatting, including ones that change trailing whitespace
+    code = "x=1;\ny=2;  \n\nz=3;\nw=4;\n"
+    session = mformat.FormatSession(code)
+    self.assertEqual(session.format(), mformat.formatCode(code))
+
+    for startPos, endPos, newCode in [(0, 4, "a=1;  "), (7, 9, ""), (4, 4, "b=2;\n"),
+          (len(code) - 1, len(code) - 1, "  ")]:
+      code = code[:startPos] + newCode + code[endPos:]
+      session.edit(startPos, endPos, newCode)
+
+    self.assertEqual(session.code, code)
+    self.assertEqual(session.format(), mformat.formatCode(code))
+
+  def testFormatAstCopy(self) -> None:
+    settings = mformat.Settings()
+    ast = mformat.parseTokens(Tokenizer().tokenizeCode("x=1;  y=2"), settings)
+    astRepr = repr(ast)
+    self.assertEqual(mformat.formatAst(ast, settings), "x = 1;\ny = 2\n")
+    self.assertEqual(repr(ast), astRepr)
+    self.assertEqual(mformat.formatAst(ast, settings, inPlace=True), "x = 1;\ny = 2\n")
+
+  def testFormatAstPassTimes(self) -> None:
+    settings = mformat.Settings()
+    ast = mformat.parseTokens(Tokenizer().tokenizeCode("x=1;  % c  \ny=2  "), settings)
+    passTimes: Dict[str, float] = {}
+    self.assertEqual(mformat.formatAst(ast, settings, passTimes=passTimes),
+        "x = 1;\n% c\ny = 2\n")
+    self.assertEqual(set(passTimes), {"copy", "removeWhitespaces",
+        "insertNewlinesBetweenStatements", "removeSuperfluousSemicolons", "indent",
+        "insertWhitespaces", "traversal", "render"})
+
+  def testMainWithJobs(self) -> None:
+    # nothing is printed for files that fail after many statements have been formatted
+    codes = ["x=1;", 600 * "x=1;\n" + "y = a ^ b;\n", "end", "y=2;", "z=3;"]
+    expectedCode = {"0.m" : "x = 1;\n\n", "3.m" : "y = 2;\n\n", "4.m" : "z = 3;\n\n"}
+
+    for numberOfJobs in [1, 2]:
+      with tempfile.TemporaryDirectory() as dirPath:
+        for i, code in enumerate(codes):
+          with open(os.path.join(dirPath, f"{i}.m"), "w") as f: f.write(code)
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+
+        with (unittest.mock.patch("sys.argv", ["mformat", "--jobs", str(numberOfJobs), dirPath]),
+              contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr),
+              self.assertRaises(SystemExit)):
+          mformat.main()
+
+        fileNames = os.listdir(dirPath)
+
+      self.assertEqual(stdout.getvalue(), "".join(expectedCode.get(x, "") for x in fileNames))
+
+      for i in [1, 2]:
+        self.assertIn(f"Error while processing '{os.path.join(dirPath, f'{i}.m')}'",
+            stderr.getvalue())
+
+  def testMainInplaceAndCheck(self) -> None:
+    with tempfile.TemporaryDirectory() as dirPath:
+      filePaths = [os.path.join(dirPath, x) for x in ["a.m", "b.m"]]
+      for filePath, code in zip(filePaths, ["x=1;", "y = 2;\n"]):
+        with open(filePath, "w") as f: f.write(code)
+      os.utime(filePaths[1], ns=(0, 0))
+
+      for mode, expectedExitCode in [("--check", 1), ("--inplace", None), ("--check", None)]:
+        with (unittest.mock.patch("sys.argv", ["mformat", mode, dirPath]),
+              contextlib.redirect_stdout(io.StringIO()) as stdout,
+              contextlib.redirect_stderr(io.StringIO())):
+          if expectedExitCode is None:
+            mformat.main()
+          else:
+            self.assertRaises(SystemExit, mformat.main)
+
+        self.assertEqual(stdout.getvalue(), "")
+
+      with open(filePaths[0], "r") as f: self.assertEqual(f.read(), "x = 1;\n")
+      self.assertEqual(os.stat(filePaths[1]).st_mtime_ns, 0)
+      self.assertEqual(sorted(os.listdir(dirPath)), ["a.m", "b.m"])
+
+  def testFormatServer(self) -> None:
+    requests = [
+          {"jsonrpc": "2.0", "id": 1, "method": "format",
+            "params": {"code": "x=1;", "settings": {"newlineAtEndOfFile": False}}},
+          {"jsonrpc": "2.0", "method": "format", "params": {"code": "x=1;"}},
+          {"jsonrpc": "2.0", "id": 2, "method": "format", "params": {}},
+          {"jsonrpc": "2.0", "id": 3, "method": "unknown"},
+          {"jsonrpc": "2.0", "id": 4, "method": "format", "params": {"path": "/nonexistent.m"}},
+          {"jsonrpc": "2.0", "id": 5, "method": "shutdown"},
+          {"jsonrpc": "2.0", "id": 6, "method": "format", "params": {"code": "x=1;"}},
+        ]
+    inputStream = io.StringIO("".join(json.dumps(x) + "\n" for x in requests) + "{\n")
+    outputStream = io.StringIO()
+    FormatServer().serveStream(inputStream, outputStream)
+    responses = [json.loads(x) for x in outputStream.getvalue().splitlines()]
+
+    self.assertEqual([x["id"] for x in responses], [1, 2, 3, 4, 5])
+    self.assertEqual(responses[0]["result"], {"formattedCode": "x = 1;"})
+    self.assertEqual(responses[1]["error"]["code"], FormatServer.invalidParamsCode)
+    self.assertEqual(responses[2]["error"]["code"], FormatServer.methodNotFoundCode)
+    self.assertEqual(responses[3]["error"]["code"], FormatServer.formatErrorCode)
+    self.assertIn("FileNotFoundError", responses[3]["error"]["message"])
+    self.assertIsNone(responses[4]["result"])
+
+    outputStream = io.StringIO()
+    FormatServer().serveStream(io.StringIO("{\n"), outputStream)
+    self.assertEqual(json.loads(outputStream.getvalue())["error"]["code"],
+        FormatServer.parseErrorCode)
+
+    # processFile shares the StatementMemo of the server
+    with tempfile.TemporaryDirectory() as dirPath:
+      filePath = os.path.join(dirPath, "a.m")
+      with open(filePath, "w") as f: f.write("x=1;\ny=2;\n")
+      server = FormatServer()
+      message = json.dumps({"jsonrpc": "2.0", "id": 1, "method": "processFile",
+          "params": {"path": filePath, "collectStats": True}})
+      results = [json.loads(server.handleMessage(message) or "")["result"] for _ in range(2)]
+
+    self.assertEqual([x["formattedCode"] for x in results], 2 * ["x = 1;\ny = 2;\n"])
+    self.assertGreater(results[0]["stats"]["numberOfMemoMisses"], 0)
+    self.assertEqual(results[1]["stats"]["numberOfMemoMisses"], 0)
+    self.assertEqual(results[1]["stats"]["numberOfMemoHits"],
+        results[1]["stats"]["numberOfStatements"])
+
+  def testMainWithServer(self) -> None:
+    with tempfile.TemporaryDirectory() as dirPath:
+      socketPath = os.path.join(dirPath, "socket")
+      filePath = os.path.join(dirPath, "a.m")
+      with open(filePath, "w") as f: f.write("x=1;")
+      server = FormatServer()
+      thread = threading.Thread(target=server.serveSocket, args=(socketPath,))
+      thread.start()
+
+      try:
+        for _ in range(100):
+          if os.path.exists(socketPath): break
+          thread.join(0.01)
+
+        with unittest.mock.patch.object(FormatServer, "_handleRequest", autospec=True,
+              side_effect=FormatServer._handleRequest) as handleRequest:
+          with (unittest.mock.patch("sys.argv", ["mformat", "--socket", socketPath, "--inplace",
+                  dirPath]),
+                contextlib.redirect_stderr(io.StringIO())):
+            mformat.main()
+
+          self.assertEqual(handleRequest.call_count, 1)
+
+        with open(filePath, "r") as f: self.assertEqual(f.read(), "x = 1;\n")
+      finally:
+        client = FormatClient.connect(socketPath)
+        assert client is not None
+        with client: client.request("shutdown")
+        thread.join()
+
+      self.assertFalse(os.path.exists(socketPath))
+      self.assertIsNone(FormatClient.connect(socketPath))
+
+      # files that are not sockets are neither replaced nor removed
+      with open(socketPath, "w") as f: f.write("x")
+      self.assertRaises(OSError, FormatServer().serveSocket, socketPath)
+      with open(socketPath, "r") as f: self.assertEqual(f.read(), "x")
+
+  def testStartupImports(self) -> None:
+    # mformat is often started once per file, so importing it and showing the help must not
+    # import modules that are only needed by some options or compile the tokenizer patterns
+    # (checked instead of the startup time, which depends on the load of the machine)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(mformat.__file__)))
+    lazyModuleNames = ["argparse", "hashlib", "json", "mmap", "multiprocessing", "shutil",
+        "socket", "sqlite3", "subprocess", "tempfile", "traceback"]
+
+    def checkImports(code: str, moduleNames: List[str]) -> None:
+      checkCode = (f"import sys\n{code}\nprint(sorted(set({moduleNames}) & set(sys.modules)), "
+          "sys.modules['mformat'].Tokenizer._compiledMasterPattern is None)")
+      output = subprocess.run([sys.executable, "-c", checkCode], env=env, check=True,
+          stdout=subprocess.PIPE, text=True).stdout
+      self.assertEqual(output.splitlines()[-1], "[] True")
+
+    checkImports("import mformat", lazyModuleNames)
+    # argparse needs shutil for the width of the terminal
+    checkImports("import mformat\nsys.argv = ['mformat', '--help']\n"
+        "try: mformat.main()\nexcept SystemExit: pass",
+        [x for x in lazyModuleNames if x not in ["argparse", "shutil"]])
+
+  def testBenchmarkCorpus(self) -> None:
+    for numberOfFunctions, nestedFunctions in [(0, False), (3, False), (3, True)]:
+      parameters = CorpusParameters(200, maxBlockDepth=4, expressionWidth=6, commentDensity=0.3,
+          numberOfFunctions=numberOfFunctions, nestedFunctions=nestedFunctions, seed=1)
+      code = generateCode(parameters)
+      self.assertEqual(generateCode(parameters), code)
+      formattedCode = mformat.formatCode(code)
+      self.assertNotEqual(formattedCode, code)
+      self.assertEqual(mformat.formatCode(formattedCode), formattedCode)
+
+    self.assertNotEqual(generateCode(CorpusParameters(200, seed=2)),
+        generateCode(CorpusParameters(200, seed=3)))
+    self.assertLess(len(generateCode(CorpusParameters(100))),
+        len(generateCode(CorpusParameters(200))))
+
+  def testBenchmarkComparison(self) -> None:
+    results = runBenchmark([20, 40], repetitions=1)
+    self.assertEqual([x["numberOfStatements"] for x in results["results"]], [20, 40])
+    self.assertEqual(list(results["results"][0]["stages"]), stageNames)
+    self.assertEqual(compareResults(results, results), [])
+
+    # make the formatter quadratic
+    regressedResults = copy.deepcopy(results)
+    minNumberOfCharacters = results["results"][0]["numberOfCharacters"]
+
+    for entry in regressedResults["results"]:
+      entry["stages"]["format"]["time"] *= entry["numberOfCharacters"] / minNumberOfCharacters
+
+    regressions = compareResults(regressedResults, results, timeTolerance=0)
+    self.assertEqual(len(regressions), 1)
+    self.assertTrue(regressions[0].startswith("format time grows with exponent"))
+    self.assertEqual(len(compareResults(regressedResults, results)), 2)
+
+    regressedResults["corpus"]["seed"] += 1
+    self.assertRaises(ValueError, compareResults, regressedResults, results)
+
+  def testFormatCodeStats(self) -> None:
+    code = "function f\nif a;x=g(h(1));end;  \n"
+    stats = FormatStats()
+    self.assertEqual(mformat.formatCode(code, stats=stats), mformat.formatCode(code))
+    self.assertEqual(mformat.formatCode(code, stats=stats), mformat.formatCode(code))
+
+    self.assertEqual(set(stats.stageTimes), set(FormatStats.stageNames))
+    self.assertTrue(all(x > 0 for x in stats.stageTimes.values()))
+    self.assertIn("indent", stats.passTimes)
+    self.assertEqual(stats.numberOfFiles, 2)
+    self.assertEqual(stats.numberOfTokens, 2 * len(Tokenizer().tokenizeCode(code)))
+    self.assertEqual(stats.numberOfStatements, 2 * 5)
+    self.assertEqual(stats.numberOfBytesIn, 2 * len(code))
+    self.assertEqual(stats.numberOfBytesOut, 2 * len(mformat.formatCode(code)))
+    self.assertEqual(stats.maxBlockDepth, 1)
+    self.assertEqual(stats.maxGroupDepth, 2)
+
+    copiedStats = FormatStats.fromDict(json.loads(json.dumps(stats.toDict())))
+    copiedStats.add(stats)
+    self.assertEqual(copiedStats.numberOfTokens, 2 * stats.numberOfTokens)
+    self.assertEqual(copiedStats.maxGroupDepth, 2)
+    self.assertAlmostEqual(copiedStats.stageTimes["parse"], 2 * stats.stageTimes["parse"])
+
+  def testMainWithStatsAndProfile(self) -> None:
+    with tempfile.TemporaryDirectory() as dirPath:
+      for fileName in ["a.m", "b.m", "c.m"]:
+        with open(os.path.join(dirPath, fileName), "w") as f: f.write("x=(1);")
+
+      for args in [["--stats"], ["--stats", "--jobs", "2"], ["--profile", dirPath]]:
+        with (unittest.mock.patch("sys.argv", ["mformat", "--check", *args, dirPath]),
+              contextlib.redirect_stderr(io.StringIO()) as stderr):
+          self.assertRaises(SystemExit, mformat.main)
+
+        if "--stats" in args:
+          self.assertRegex(stderr.getvalue(), r"\nTokens +18\n")
+          self.assertRegex(stderr.getvalue(), r"\nparse +[0-9.]+ +[0-9.]+%\n")
+        else:
+          self.assertNotIn("Tokens", stderr.getvalue())
+
+      self.assertEqual(sorted(x for x in os.listdir(dirPath) if x.endswith(".prof")),
+          sorted(f"{x}.prof" for x in FormatStats.stageNames))
+
+  def testGetChangedFilePaths(self) -> None:
+    with tempfile.TemporaryDirectory() as dirPath:
+      runGit = lambda *args: subprocess.run(["git", "-C", dirPath, "-c", "user.name=a",
+          "-c", "user.email=a@b", *args], check=True, stdout=subprocess.DEVNULL)
+      runGit("init", "-q")
+
+      for fileName in ["a.m", "b.m", "c.m", "d.txt"]:
+        with open(os.path.join(dirPath, fileName), "w") as f: f.write("x = 1;\n")
+
+      runGit("add", "a.m", "b.m", "c.m")
+      runGit("commit", "-q", "-m", "x")
+      with open(os.path.join(dirPath, "a.m"), "w") as f: f.write("x = 2;\n")
+      os.remove(os.path.join(dirPath, "c.m"))
+      os.mkdir(os.path.join(dirPath, "e"))
+      with open(os.path.join(dirPath, "e", "f.m"), "w") as f: f.write("x = 1;\n")
+
+      self.assertEqual(mformat.getChangedFilePaths(dirPath, "HEAD"),
+          [os.path.realpath(os.path.join(dirPath, x)) for x in ["a.m", os.path.join("e", "f.m")]])
+      self.assertEqual(mformat.getChangedFilePaths(os.path.join(dirPath, "e"), "HEAD"),
+          [os.path.realpath(os.path.join(dirPath, "e", "f.m"))])
+
+  def testFormatFileCache(self) -> None:
+    with tempfile.TemporaryDirectory() as dirPath:
+      mformat.Settings().save(os.path.join(dirPath, ".mformat.json"))
+      filePath = os.path.join(dirPath, "a.m")
+      with open(filePath, "w") as f: f.write("x = 1;\n")
+      self.assertEqual(mformat.formatFile(filePath, useCache=True), "x = 1;\n")
+      self.assertTrue(os.path.isfile(os.path.join(dirPath, ".mformat-cache")))
+
+      with unittest.mock.patch.object(Tokenizer, "tokenizeCode", side_effect=RuntimeError):
+        self.assertEqual(mformat.formatFile(filePath, useCache=True), "x = 1;\n")
+        self.assertRaises(RuntimeError, mformat.formatFile, filePath, {"indent" : 4}, True)
+
+  def testResultCacheEviction(self) -> None:
+    with tempfile.TemporaryDirectory() as dirPath:
+      cache = ResultCache(os.path.join(dirPath, ResultCache.fileName))
+      cache.maxNumberOfEntries = 8
+
+      for i in range(20):
+        cache.add(str(i))
+        self.assertLessEqual(cache._countEntries(), 8)
+
+      self.assertTrue(cache.contains("19"))
+      self.assertFalse(cache.contains("0"))
+
+  def testByteTokenizer(self) -> None:
+    code = ("%{\nä\n%}\nx = a' + b.' * {c}' ... €\n  ;y(1)='ü''s' % ö\n"
+        "if ä, z = [1 2]'; end\n%}\n")
+    tokens = Tokenizer().tokenizeCode(code)
+    byteTokens = mformat.ByteTokenizer().tokenizeCode(code.encode())
+    self.assertEqual([(x.code, x.kind, x.groupDepth) for x in byteTokens],
+        [(x.code, x.kind, x.groupDepth) for x in tokens])
+    self.assertEqual([x.startPos for x in byteTokens],
+        [len(code[:x.startPos].encode()) for x in tokens])
+
+  def testFormatMappedFile(self) -> None:
+    with tempfile.TemporaryDirectory() as dirPath:
+      mformat.Settings().save(os.path.join(dirPath, ".mformat.json"))
+      filePath = os.path.join(dirPath, "a.m")
+      code = "x=1;if a;b='ä';end % ü\n"
+      with open(filePath, "w", encoding="utf-8") as f: f.write(code)
+      formattedCode = mformat.formatFile(filePath)
+      self.assertEqual(mformat.formatFile(filePath, memoryMap=True), formattedCode)
+      self.assertEqual(mformat.formatMappedFile(filePath), (formattedCode, True))
+      self.assertTrue(mformat.processFile(filePath, mode="check", memoryMap=True).changed)
+      mformat.processFile(filePath, mode="inplace", memoryMap=True)
+      self.assertEqual(mformat.formatMappedFile(filePath, useCache=True), (formattedCode, False))
+
+      with unittest.mock.patch.object(Tokenizer, "tokenizeCode", side_effect=RuntimeError):
+        self.assertEqual(mformat.formatMappedFile(filePath, useCache=True),
+            (formattedCode, False))
+
+      # files that cannot be mapped or contain carriage returns are read
+      for code in ["", "x=1\r\ny=2\r\n"]:
+        with open(filePath, "w", newline="") as f: f.write(code)
+        self.assertIsNone(mformat.formatMappedFile(filePath))
+        self.assertEqual(mformat.formatFile(filePath, memoryMap=True),
+            mformat.formatFile(filePath))
+
+  def testWriteFormattedCode(self) -> None:
+    code = "x=1;if a;b;end  \n% c  \n\n  y=[1,2]  \n"
+    stream = io.StringIO()
+    mformat.writeFormattedCode(code, stream)
+    self.assertEqual(stream.getvalue(), mformat.formatCode(code))
+
+    settings = mformat.Settings()
+    ast = mformat.parseTokens(Tokenizer().tokenizeCode(code), settings)
+    expectedCode = mformat.formatAst(ast, settings, inPlace=True)[:-1]
+    stream = unittest.mock.Mock(wraps=io.StringIO())
+    mformat.formatter.writeAst(ast, mformat.formatter.TrailingWhitespaceRemover(), stream, 4)
+    self.assertGreater(stream.write.call_count, 2)
+    self.assertEqual("".join(x.args[0] for x in stream.write.call_args_list), expectedCode)
+
+    with tempfile.TemporaryDirectory() as dirPath:
+      filePaths = [os.path.join(dirPath, x) for x in ["a.m", "b.m"]]
+
+      for filePath in filePaths:
+        with open(filePath, "w") as f: f.write(code)
+
+      for memoryMap in [False, True]:
+        stream = io.StringIO()
+        mformat.writeFormattedFile(filePaths[0], stream, {"indent" : 4}, memoryMap=memoryMap)
+        self.assertEqual(stream.getvalue(), mformat.formatFile(filePaths[0], {"indent" : 4}))
+
+      with (unittest.mock.patch("sys.argv", ["mformat", dirPath]),
+            contextlib.redirect_stdout(io.StringIO()) as stdout,
+            contextlib.redirect_stderr(io.StringIO())):
+        mformat.main()
+
+      self.assertEqual(stdout.getvalue(), 2 * (mformat.formatCode(code) + "\n"))
+
+  def testFormatManyAndFormatFiles(self) -> None:
+    codes = ["x=1;if a;b;end", "function f\ny=2", "  z = [1,2]  "]
+    formattedCodes = mformat.formatMany(iter(codes + [None]))
+    for code in codes: self.assertEqual(next(formattedCodes), mformat.formatCode(code))
+
+    with tempfile.TemporaryDirectory() as dirPath:
+      os.makedirs(os.path.join(dirPath, "a"))
+      with open(os.path.join(dirPath, "a", ".mformat.json"), "w") as f: json.dump({"indent" : 4}, f)
+      filePaths = [os.path.join(dirPath, x) for x in ["b.m", os.path.join("a", "c.m"),
+          os.path.join("a", "d.m")]]
+
+      for filePath in filePaths:
+        with open(filePath, "w") as f: f.write("if a\nb\nend\n")
+
+      self.assertEqual(list(mformat.formatFiles(filePaths)),
+          [mformat.formatFile(x) for x in filePaths])
+      self.assertEqual(list(mformat.formatFiles(filePaths, {"indent" : 3})),
+          ["if a\n   b\nend\n"] * 3)
+
+  def testStatementMemo(self) -> None:
+    for numberOfFunctions, nestedFunctions in [(0, False), (3, False), (3, True)]:
+      code = generateCode(CorpusParameters(200, maxBlockDepth=4, commentDensity=0.3,
+          numberOfFunctions=numberOfFunctions, nestedFunctions=nestedFunctions, seed=1))
+      settings = Settings()
+      formattedCode = mformat.formatAst(mformat.parseTokens(Tokenizer().tokenizeCode(code),
+          settings), settings)
+      self.assertEqual(mformat.formatCode(code), formattedCode)
+
+    code = "if a\n  x=1;\nend\nx  =  1;\nswitch x\ncase 1\nx=1;\nend\nx=1 ;\n"
+    stats = FormatStats()
+    memo = StatementMemo()
+    self.assertEqual(mformat.formatCode(code, stats=stats, memo=memo),
+        "if a\n  x = 1;\nend\nx = 1;\nswitch x\n  case 1\n    x = 1;\nend\nx = 1;\n")
+    numberOfHits, numberOfMisses = stats.numberOfMemoHits, stats.numberOfMemoMisses
+    self.assertGreater(numberOfHits, 0)
+    self.assertEqual(numberOfHits + numberOfMisses, stats.numberOfStatements)
+    settings = Settings()
+    settings.indent = 4
+    self.assertEqual(mformat.formatCode(code, settings, stats, memo),
+        "if a\n    x = 1;\nend\nx = 1;\nswitch x\n    case 1\n        x = 1;\nend\nx = 1;\n")
+    self.assertEqual((stats.numberOfMemoHits, stats.numberOfMemoMisses),
+        (2 * numberOfHits, 2 * numberOfMisses))
+    mformat.formatCode(code, stats=stats, memo=memo)
+    self.assertEqual((stats.numberOfMemoHits, stats.numberOfMemoMisses),
+        (3 * numberOfHits + numberOfMisses, 2 * numberOfMisses))
+
+    memo = StatementMemo(2)
+    mformat.formatCode("a\nb\nc\n", memo=memo)
+    self.assertEqual(len(memo), 2)
+    stats = FormatStats()
+    mformat.formatCode("c\na\n", stats=stats, memo=memo)
+    self.assertEqual((stats.numberOfMemoHits, stats.numberOfMemoMisses), (1, 1))
+
+  def testSettingsFileCache(self) -> None:
+    settingsFileCache = SettingsFileCache()
+
+    with tempfile.TemporaryDirectory() as dirPath:
+      subdirPath = os.path.join(dirPath, "a", "b")
+      os.makedirs(subdirPath)
+      settingsFilePath = os.path.join(dirPath, "a", ".mformat.json")
+      self.assertIsNone(settingsFileCache.search(subdirPath))
+
+      # changes are noticed immediately, even if the modification time does not change
+      with open(settingsFilePath, "w") as f: json.dump({"indent" : 4}, f)
+      self.assertEqual(settingsFileCache.search(subdirPath), settingsFilePath)
+      self.assertEqual(settingsFileCache.load(settingsFilePath), {"indent" : 4})
+      mtime = os.stat(settingsFilePath).st_mtime_ns
+      with open(settingsFilePath, "w") as f: json.dump({"indent" : 3}, f)
+      os.utime(settingsFilePath, ns=(mtime, mtime))
+      self.assertEqual(settingsFileCache.load(settingsFilePath), {"indent" : 3})
+
+      # old modification times are trusted
+      os.utime(settingsFilePath, ns=(0, 0))
+      self.assertEqual(settingsFileCache.load(settingsFilePath), {"indent" : 3})
+      with open(settingsFilePath, "w") as f: json.dump({"indent" : 2}, f)
+      os.utime(settingsFilePath, ns=(0, 0))
+      self.assertEqual(settingsFileCache.load(settingsFilePath), {"indent" : 3})
+      os.utime(settingsFilePath)
+      self.assertEqual(settingsFileCache.load(settingsFilePath), {"indent" : 2})
+
+  def testAstNodeOrder(self) -> None:
+    root = AstNode("root")
+    first = root.appendNewAstNodeAsChild("first")
+    last = root.appendNewAstNodeAsChild("last")
+    middle = root.insertNewAstNodeAsChild(1, "middle")
+    child = middle.appendNewAstNodeAsChild("child")
+    self.assertEqual([x.getIndexInParent() for x in root.children], [0, 1, 2])
+    self.assertTrue(first < child < last)
+    self.assertFalse(last < middle)
+    self.assertEqual(first.goToNext("child"), child)
+    first.remove()
+    self.assertEqual([x.getIndexInParent() for x in root.children], [0, 1])
+    self.assertEqual(last.goToPrev("child"), child)
+
+  def testAstNodeLength(self) -> None:
+    ast = mformat.parseTokens(Tokenizer().tokenizeCode("x = f(a, b);"), mformat.Settings())
+    node = ast.goToDescendant("commaSeparatedList")
+    self.assertEqual(ast.getLength(), 12)
+    node.children[0].remove()
+    self.assertEqual((node.getLength(), ast.getLength()), (3, 11))
+    self.assertEqual(len(str(ast)), ast.getLength())
+
+  def testLineIndex(self) -> None:
+    tokenizer = Tokenizer()
+    tokens = tokenizer.tokenizeCode("a = 1;\n\n  b = 2;\n")
+    self.assertEqual([tokenizer.lineIndex.getLineAndColumn(x.startPos) for x in tokens
+        if x.className == "identifier"], [(0, 0), (2, 2)])
+    self.assertEqual(tokenizer.lineIndex.getNumberOfLines(), 4)
+
+  def testTokens(self) -> None:
+    tokens = Tokenizer().tokenizeCode("x = f(2e1, 'a''b');")
+    self.assertEqual(tokens[6].value, 20)
+    self.assertEqual(tokens[9].value, "a'b")
+    self.assertEqual(tokens[10].kind, TokenKind.closingParenthesisWithIdentifier)
+    self.assertEqual(tokens[10].className, "closingParenthesisWithIdentifier")
+
+
 
 if __name__ == "__main__":
   unittest.main(verbosity=2)